@@ -0,0 +1,456 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+
+Benchmarks the numerical kernels of the conversion scripts on synthetic
+ERA5-like model level data of configurable size.
+
+The synthetic fields follow a standard atmosphere with a latitude
+dependent tropopause, a jet and moisture decreasing with height on the
+L137 hybrid levels taken from the GRIB test data. Model level NetCDF
+data uses lev levels spread over the full column, the GRIB input of the
+geopotential computation the lowest lev levels.
+
+Example:
+    python _benchmark/benchmark_kernels.py --size 1x137x91x180 --size 4x137x91x180 \\
+        --output bench.json --compare bench_main.json
+"""
+import argparse
+import contextlib
+import datetime
+import fnmatch
+import io
+import json
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time as timer
+import warnings
+
+import numpy as np
+import xarray as xr
+
+BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(BASE, "bin"))
+import add_ancillary  # noqa: E402
+import interpolate_model  # noqa: E402
+# eccodes must be imported after MetPy
+import compute_geopotential_on_ml  # noqa: E402
+from eccodes import (  # noqa: E402
+    codes_clone, codes_get, codes_get_array, codes_grib_new_from_file, codes_release, codes_set,
+    codes_set_values, codes_write)
+
+TEMPLATE = os.path.join(BASE, "_test", "grib", "2021-01-29T00:00:00.an.")
+
+TARGETS = [("pres", "hPa", [850, 500, 400, 300, 200, 150, 120, 100, 80, 65, 50, 40, 30, 20, 10, 5, 1]),
+           ("pt", "K", [330, 350, 370, 395, 475]),
+           ("z", "m", list(range(0, 20001, 500)))]
+
+VARIABLE_ATTRIBUTES = {
+    "t": ("air_temperature", "K"), "u": ("eastward_wind", "m s**-1"), "v": ("northward_wind", "m s**-1"),
+    "w": ("lagrangian_tendency_of_air_pressure", "Pa s**-1"), "q": ("specific_humidity", "kg kg**-1"),
+    "cc": ("cloud_area_fraction_in_atmosphere_layer", "dimensionless"),
+    "clwc": ("specific_cloud_liquid_water_content", "kg kg**-1"),
+    "ciwc": ("specific_cloud_ice_water_content", "kg kg**-1"), "d": ("divergence_of_wind", "s**-1"),
+    "o3": ("mass_fraction_of_ozone_in_air", "kg kg**-1"), "z": ("geopotential_height", "m**2 s**-2"),
+}
+
+
+def read_templates():
+    """
+    Returns template messages of t, q, z and lnsp and the hybrid coefficients.
+    """
+    templates = {}
+    for kind in ["ml", "ml2"]:
+        with open(TEMPLATE + kind + ".grib", "rb") as fin:
+            while True:
+                gid = codes_grib_new_from_file(fin)
+                if gid is None:
+                    break
+                name = codes_get(gid, "shortName")
+                if name in ["t", "q", "z", "lnsp"] and name not in templates:
+                    templates[name] = gid
+                else:
+                    codes_release(gid)
+    pv = codes_get_array(templates["z"], "pv")
+    return templates, pv[:len(pv) // 2], pv[len(pv) // 2:]
+
+
+def synthetic_data(ntime, nlev, nlat, nlon, hyai, hybi, seed=0):
+    """
+    Returns model level and surface datasets as produced by convert.read_grib
+    with nlev levels spread over the L137 column.
+    """
+    rng = np.random.default_rng(seed)
+    lev = np.unique(np.linspace(1, 137, nlev).round().astype(int))
+    lat = np.linspace(90, -90, nlat)
+    lon = np.linspace(0, 360, nlon, endpoint=False)
+    time = np.datetime64("2021-01-29T00:00", "ns") + np.arange(ntime) * np.timedelta64(6, "h")
+    hyam, hybm = (hyai[1:] + hyai[:-1]) / 2, (hybi[1:] + hybi[:-1]) / 2
+
+    phi = np.deg2rad(lat)[np.newaxis, np.newaxis, :, np.newaxis]
+    lam = np.deg2rad(lon)[np.newaxis, np.newaxis, np.newaxis, :]
+    tim = np.arange(ntime)[:, np.newaxis, np.newaxis, np.newaxis]
+    sp = (101000 + 1500 * np.cos(2 * phi) * np.sin(3 * lam + tim) -
+          8000 * np.maximum(0, np.sin(2 * lam) * np.cos(phi)) ** 4)
+    pres = hyam[lev - 1][np.newaxis, :, np.newaxis, np.newaxis] + hybm[lev - 1][np.newaxis, :, np.newaxis, np.newaxis] * sp
+    height = 7 * np.log(101325 / pres)
+    sin2 = np.sin(phi) ** 2
+    tropopause, surface = 16 - 7 * sin2, 300 - 45 * sin2
+    temp = np.where(height < tropopause, surface - 6.5 * height, surface - 6.5 * tropopause +
+                    1.5 * np.maximum(height - 20, 0))
+    temp = temp + 3 * np.sin(lam + tim) * np.cos(phi) + rng.normal(0, 0.3, temp.shape)
+
+    def noise(scale):
+        return rng.normal(0, scale, pres.shape)
+
+    fields = {
+        "t": temp,
+        "u": 40 * np.exp(-((height - tropopause + 1) / 4) ** 2) * np.cos(phi) + 5 * np.sin(lam) + noise(1),
+        "v": 10 * np.sin(2 * lam) * np.cos(phi) * np.exp(-((height - 10) / 6) ** 2) + noise(1),
+        "w": noise(0.1),
+        "q": 0.018 * np.exp(-height / 2.5) * np.cos(phi) ** 2 + 1e-6,
+        "cc": np.clip(noise(0.3), 0, 1),
+        "clwc": np.clip(noise(1e-5), 0, None),
+        "ciwc": np.clip(noise(1e-5), 0, None),
+        "d": noise(1e-5),
+        "o3": 8e-6 * np.exp(-((height - 25) / 8) ** 2),
+        "z": 9.80665 * 1000 * height + noise(1),
+    }
+    dims = ("time", "lev", "lat", "lon")
+    ml = xr.Dataset(coords={"time": ("time", time), "lev": ("lev", lev.astype(float)),
+                            "lat": ("lat", lat), "lon": ("lon", lon)})
+    for name, values in fields.items():
+        ml[name] = (dims, values.astype(np.float32), {
+            "standard_name": VARIABLE_ATTRIBUTES[name][0], "units": VARIABLE_ATTRIBUTES[name][1]})
+    ml["hyam"] = (("nhym",), hyam)
+    ml["hybm"] = (("nhym",), hybm)
+    ml["lat"].attrs = {"standard_name": "latitude", "units": "degrees_north", "axis": "Y"}
+    ml["lon"].attrs = {"standard_name": "longitude", "units": "degrees_east", "axis": "X"}
+    ml["lev"].attrs = {"standard_name": "atmosphere_hybrid_sigma_pressure_coordinate", "units": "level",
+                       "positive": "down", "axis": "Z"}
+    ml["time"].attrs = {"standard_name": "time", "axis": "T"}
+    sfc = xr.Dataset(coords={x: ml[x] for x in ["time", "lat", "lon"]})
+    sfc["lnsp"] = (("time", "lat", "lon"), np.log(sp[:, 0]).astype(np.float32), {"units": "~"})
+    return ml, sfc
+
+
+def write_grib(ml, sfc, templates, nlev, tq_filename, zlnsp_filename):
+    """
+    Writes t and q on the lowest nlev model levels and surface z and lnsp
+    of the synthetic data as GRIB files for compute_geopotential_on_ml.
+    """
+    lat, lon = ml["lat"].values, ml["lon"].values
+    grid = {"Ni": len(lon), "Nj": len(lat),
+            "latitudeOfFirstGridPointInDegrees": lat[0], "latitudeOfLastGridPointInDegrees": lat[-1],
+            "longitudeOfFirstGridPointInDegrees": lon[0], "longitudeOfLastGridPointInDegrees": lon[-1],
+            "iDirectionIncrementInDegrees": lon[1] - lon[0], "jDirectionIncrementInDegrees": lat[0] - lat[1]}
+    # the column of the synthetic data is stretched over the lowest levels
+    column = np.interp(np.linspace(0, 1, nlev), np.linspace(0, 1, ml.sizes["lev"]), np.arange(ml.sizes["lev"]))
+    levels = np.arange(138 - nlev, 138)
+    with open(tq_filename, "wb") as tq_out, open(zlnsp_filename, "wb") as zlnsp_out:
+        for iti, time in enumerate(ml["time"].values):
+            date = str(time)[:10].replace("-", "")
+            hour = int(str(time)[11:13]) * 100
+            fields = [("z", zlnsp_out, 1, ml["z"].values[iti, -1] - 9.80665 * 100),
+                      ("lnsp", zlnsp_out, 1, sfc["lnsp"].values[iti])]
+            for level, idx in zip(levels, column.round().astype(int)):
+                fields += [("t", tq_out, level, ml["t"].values[iti, idx]),
+                           ("q", tq_out, level, ml["q"].values[iti, idx])]
+            for name, fout, level, values in fields:
+                gid = codes_clone(templates[name])
+                for key, value in grid.items():
+                    codes_set(gid, key, value)
+                codes_set(gid, "dataDate", int(date))
+                codes_set(gid, "dataTime", hour)
+                codes_set(gid, "level", int(level))
+                codes_set_values(gid, values.astype(float).ravel())
+                codes_write(gid, fout)
+                codes_release(gid)
+
+
+def options(*flags):
+    """
+    Returns the options of add_ancillary.py with the given flags set.
+    """
+    return optparse.Values({name: "--" + name.replace("_", "-") in flags
+                            for name in ["pressure", "theta", "pv", "n2", "tropopause", "low_memory", "fused"]})
+
+
+class Context:
+    """
+    Synthetic input data of one size shared by all kernels.
+    """
+
+    def __init__(self, size, directory, templates, hyai, hybi):
+        self.size = size
+        self.directory = directory
+        ntime, nlev, nlat, nlon = size
+        self.ml, self.sfc = synthetic_data(ntime, nlev, nlat, nlon, hyai, hybi)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self.full, self.full_sfc = add_ancillary.add_ancillary(
+                self.ml.copy(), self.sfc.copy(), options("--pressure", "--theta", "--pv", "--n2"), verbose=False)
+        self.files = {name: os.path.join(directory, name) for name in [
+            "ml.nc", "sfc.nc", "full.nc", "tq.grib", "zlnsp.grib", "out"]}
+        self.ml.to_netcdf(self.files["ml.nc"], format="NETCDF4_CLASSIC")
+        self.sfc.to_netcdf(self.files["sfc.nc"], format="NETCDF4_CLASSIC")
+        self.full.drop_vars(["hyam", "hybm"]).to_netcdf(self.files["full.nc"], format="NETCDF4_CLASSIC")
+        write_grib(self.ml, self.sfc, templates, nlev, self.files["tq.grib"], self.files["zlnsp.grib"])
+
+
+KERNELS = {}
+
+
+def kernel(name):
+    def register(func):
+        KERNELS[name] = func
+        return func
+    return register
+
+
+def ancillary_kernel(name, prerequisites, *flags):
+    """
+    Times add_ancillary for flags on data already holding prerequisites.
+    """
+    @kernel("add_ancillary." + name)
+    def run(ctx):
+        ml = ctx.ml.assign({var: ctx.full[var] for var in prerequisites})
+        option = options(*flags)
+        return lambda: add_ancillary.add_ancillary(ml.copy(), ctx.sfc.copy(), option, verbose=False)
+
+
+ancillary_kernel("pressure", [], "--pressure")
+ancillary_kernel("theta", ["pres"], "--theta")
+# the PV block also computes the potential temperature
+ancillary_kernel("pv", ["pres"], "--pv")
+ancillary_kernel("n2", ["pres", "pt"], "--n2")
+for _name, _prerequisites, _flag in [("pressure", [], "--pressure"), ("theta", ["pres"], "--theta"),
+                                     ("pv", ["pres"], "--pv"), ("n2", ["pres", "pt"], "--n2")]:
+    ancillary_kernel(_name + ".low_memory", _prerequisites, _flag, "--low-memory")
+ancillary_kernel("fused", [], "--pressure", "--theta", "--pv", "--n2", "--fused")
+ancillary_kernel("fused.low_memory", [], "--pressure", "--theta", "--pv", "--n2", "--fused", "--low-memory")
+
+
+@kernel("find_tropopause")
+def find_tropopause(ctx):
+    """
+    The single column search applied to 100 columns.
+    """
+    gph = add_ancillary.my_geopotential_to_height(ctx.full["z"]).data.to("km").m[:, ::-1]
+    temp = ctx.full["t"].values[:, ::-1]
+    columns = [(iti, ilat, ilon) for iti in range(ctx.size[0]) for ilat in range(ctx.size[2])
+               for ilon in range(ctx.size[3])][:100]
+    return lambda: [add_ancillary.find_tropopause(gph[iti, :, ilat, ilon], temp[iti, :, ilat, ilon])
+                    for iti, ilat, ilon in columns]
+
+
+@kernel("find_tropopauses")
+def find_tropopauses(ctx):
+    gph = add_ancillary.my_geopotential_to_height(ctx.full["z"]).data.to("km").m[:, ::-1]
+    temp, press, theta = (ctx.full[x].values[:, ::-1] for x in ["t", "pres", "pt"])
+    return lambda: add_ancillary.find_tropopauses(gph, temp, press, theta)
+
+
+@kernel("add_tropopauses")
+def add_tropopauses(ctx):
+    return lambda: add_ancillary.add_tropopauses(ctx.full, ctx.full_sfc.copy())
+
+
+def add_ancillary_main(*flags):
+    """
+    Reading, computing all quantities and writing as done by the script.
+    """
+    def prepare(ctx):
+        ml_file, sfc_file = (os.path.join(ctx.directory, x) for x in ["main_ml.nc", "main_sfc.nc"])
+
+        def setup():
+            shutil.copyfile(ctx.files["ml.nc"], ml_file)
+            shutil.copyfile(ctx.files["sfc.nc"], sfc_file)
+        return run_main(add_ancillary, [sfc_file, ml_file, "--pressure", "--theta", "--pv", "--n2", "--tropopause",
+                                        *flags]), setup
+    return prepare
+
+
+kernel("add_ancillary.main")(add_ancillary_main())
+kernel("add_ancillary.main.low_memory")(add_ancillary_main("--low-memory"))
+kernel("add_ancillary.main.fused")(add_ancillary_main("--fused"))
+
+
+@kernel("geopotential.production_step")
+def geopotential_production_step(ctx):
+    """
+    The original level by level computation through compute_z_level.
+    """
+    return run_main(compute_geopotential_on_ml, [ctx.files["tq.grib"], ctx.files["zlnsp.grib"], "-o", ctx.files["out"]])
+
+
+@kernel("geopotential.vectorized")
+def geopotential_vectorized(ctx):
+    return run_main(compute_geopotential_on_ml, [
+        ctx.files["tq.grib"], ctx.files["zlnsp.grib"], "-v", "-o", ctx.files["out"]])
+
+
+for _target in TARGETS:
+    @kernel("interpolate_vertical." + _target[0])
+    def interpolate_vertical(ctx, target=_target):
+        return lambda: interpolate_model.interpolate_vertical(ctx.files["full.nc"], ctx.files["out"], *target)
+
+
+@kernel("interpolate_targets")
+def interpolate_targets(ctx):
+    """
+    All targets interpolated in memory from one model level dataset.
+    """
+    return lambda: interpolate_model.interpolate_targets(ctx.full, TARGETS)
+
+
+def run_main(module, args):
+    """
+    Returns a function calling the main function of module with args.
+    """
+    def run():
+        argv = sys.argv
+        sys.argv = [module.__file__] + args
+        try:
+            module.main()
+        finally:
+            sys.argv = argv
+    return run
+
+
+def memory_status():
+    """
+    Returns the current and peak resident set size (bytes) of this process
+    or None where /proc is not available.
+    """
+    try:
+        with open("/proc/self/status") as fin:
+            status = dict(line.split(":", 1) for line in fin)
+    except OSError:
+        return None
+    return tuple(int(status[name].split()[0]) * 1024 for name in ["VmRSS", "VmHWM"])
+
+
+def reset_peak_memory():
+    """
+    Resets the peak resident set size of this process to the current one.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fout:
+            fout.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def measure(run, repeat, setup=None):
+    """
+    Returns the wall times of repeat calls of run and the largest growth of
+    the resident set size above the size before the call, if measurable.
+    """
+    times, peak = [], None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with warnings.catch_warnings(), contextlib.redirect_stdout(io.StringIO()):
+            warnings.simplefilter("ignore")
+            before = memory_status() if reset_peak_memory() else None
+            start = timer.perf_counter()
+            run()
+            times.append(timer.perf_counter() - start)
+            after = memory_status()
+        if before is not None and after is not None:
+            peak = max(peak or 0, after[1] - before[0])
+    return times, peak
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=BASE, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import metpy
+    return {"commit": commit, "date": datetime.datetime.now().isoformat(), "host": platform.node(),
+            "cpus": os.cpu_count(), "python": platform.python_version(), "numpy": np.__version__,
+            "xarray": xr.__version__, "metpy": metpy.__version__}
+
+
+def run_benchmarks(sizes, patterns, repeat):
+    templates, hyai, hybi = read_templates()
+    results = []
+    try:
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as directory:
+                ctx = Context(size, directory, templates, hyai, hybi)
+                for name, func in KERNELS.items():
+                    if not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                        continue
+                    prepared = func(ctx)
+                    run, setup = prepared if isinstance(prepared, tuple) else (prepared, None)
+                    times, peak = measure(run, repeat, setup)
+                    results.append({"kernel": name, "size": dict(zip(["time", "lev", "lat", "lon"], size)),
+                                    "times": times, "best": min(times), "median": float(np.median(times)),
+                                    "peak_rss_bytes": peak})
+                    print(f"{name:35s} {'x'.join(str(x) for x in size):>16s} {min(times):10.4f}s "
+                          f"{peak / 2 ** 20 if peak is not None else float('nan'):10.1f} MiB", flush=True)
+    finally:
+        for gid in templates.values():
+            codes_release(gid)
+    return results
+
+
+def compare(results, baseline):
+    """
+    Prints the speedup of results over the results of a previous run.
+    """
+    reference = {(x["kernel"], tuple(x["size"].values())): x for x in baseline["results"]}
+    print(f"\nComparison with {baseline['environment'].get('commit')}")
+    print(f"{'kernel':35s} {'size':>16s} {'before':>10s} {'after':>10s} {'speedup':>8s} {'peak MiB':>19s}")
+    for entry in results:
+        key = (entry["kernel"], tuple(entry["size"].values()))
+        if key in reference:
+            before = reference[key]
+            peaks = [x.get("peak_rss_bytes") for x in (before, entry)]
+            peaks = " -> ".join(f"{x / 2 ** 20:.1f}" if x is not None else "-" for x in peaks)
+            print(f"{key[0]:35s} {'x'.join(str(x) for x in key[1]):>16s} {before['best']:10.4f} "
+                  f"{entry['best']:10.4f} {before['best'] / entry['best']:8.2f} {peaks:>19s}")
+
+
+def parse_size(size):
+    values = tuple(int(x) for x in size.split("x"))
+    if len(values) != 4:
+        raise argparse.ArgumentTypeError("size must be given as TIMExLEVxLATxLON")
+    return values
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-s", "--size", type=parse_size, action="append",
+                        help="data size as TIMExLEVxLATxLON, may be repeated (default: 1x137x91x180)")
+    parser.add_argument("-k", "--kernels", nargs="+", default=["*"],
+                        help="glob patterns of the kernels to run, one of " + ", ".join(KERNELS))
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="repetitions per kernel (default: 3)")
+    parser.add_argument("-o", "--output", help="write the results as JSON to this file")
+    parser.add_argument("-c", "--compare", help="JSON results of a previous run to compare with")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = run_benchmarks(args.size or [(1, 137, 91, 180)], args.kernels, args.repeat)
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump({"environment": environment(), "results": results}, fout, indent=1)
+    if args.compare:
+        with open(args.compare) as fin:
+            compare(results, json.load(fin))
+
+
+if __name__ == "__main__":
+    main()
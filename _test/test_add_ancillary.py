@@ -0,0 +1,169 @@
+import os
+import sys
+
+import numpy as np
+import xarray
+from metpy.calc import first_derivative
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import add_ancillary  # noqa: E402
+
+
+def test_find_tropopauses():
+    base = os.path.dirname(__file__)
+    ml = xarray.load_dataset(os.path.join(base, "mss", "2021-01-29T00:00:00.an.ml.nc"))
+    rng = np.random.default_rng(0)
+
+    temp = np.concatenate([ml["t"].data + rng.normal(0, i, ml["t"].shape).astype(np.float32)
+                           for i in range(4)])
+    temp[1, 20:23, 0, :] = np.nan
+    gph = np.concatenate([add_ancillary.my_geopotential_to_height(ml["z"]).data.to("km").m] * 4)
+    press = np.concatenate([ml["pres"].data] * 4)
+    theta = np.concatenate([ml["pt"].data] * 4)
+    gph, temp, press, theta = [x[:, ::-1] for x in (gph, temp, press, theta)]
+
+    result = add_ancillary.find_tropopauses(gph, temp, press, theta)
+
+    for iti in range(gph.shape[0]):
+        for ila in range(gph.shape[2]):
+            for ilo in range(gph.shape[3]):
+                col = (iti, slice(None), ila, ilo)
+                tropopauses = [x for x in add_ancillary.find_tropopause(gph[col], temp[col]) if 5 < x < 22]
+                first = min(tropopauses) if tropopauses else np.nan
+                second = min([x for x in tropopauses if x > first], default=np.nan)
+                expected = [
+                    first, second,
+                    np.exp(np.interp(first, gph[col], np.log(press[col]))),
+                    np.exp(np.interp(second, gph[col], np.log(press[col]))),
+                    np.interp(first, gph[col], theta[col]),
+                    np.interp(second, gph[col], theta[col])]
+                for res, exp in zip(result, expected):
+                    assert np.array_equal(res[iti, ila, ilo], exp, equal_nan=True)
+    assert np.isfinite(result[0]).sum() > 0
+    assert np.isfinite(result[1]).sum() > 0
+
+
+def test_add_ancillary_parallel():
+    base = os.path.dirname(__file__)
+    ml = xarray.load_dataset(os.path.join(base, "mss", "2021-01-29T00:00:00.an.ml.nc"))
+    sfc = xarray.load_dataset(os.path.join(base, "mss", "2021-01-29T00:00:00.an.sfc.nc"))
+    ml = ml.drop_vars(["pt", "pv", "n2"])
+    ml = xarray.concat([ml, ml.assign_coords(time=ml["time"] + np.timedelta64(6, "h"))], "time")
+    sfc = xarray.concat([sfc, sfc.assign_coords(time=sfc["time"] + np.timedelta64(6, "h"))], "time")
+    option, _, _ = add_ancillary.parse_args(
+        ["--theta", "--pv", "--n2", "--tropopause", "--processes", "5", base, base])
+
+    serial = add_ancillary.add_ancillary(ml.copy(deep=True), sfc.copy(deep=True), option)
+    parallel = add_ancillary.add_ancillary_parallel(ml, sfc, option, option.processes)
+
+    for ref, fut in zip(serial, parallel):
+        assert list(ref.data_vars) == list(fut.data_vars)
+        for var in ref.variables:
+            assert ref[var].dims == fut[var].dims
+            assert ref[var].attrs == fut[var].attrs
+            assert np.array_equal(ref[var].values, fut[var].values, equal_nan=True)
+
+
+def test_add_ancillary_chunked(tmpdir):
+    base = os.path.dirname(__file__)
+    ml = xarray.load_dataset(os.path.join(base, "mss", "2021-01-29T00:00:00.an.ml.nc"))
+    sfc = xarray.load_dataset(os.path.join(base, "mss", "2021-01-29T00:00:00.an.sfc.nc"))
+    ml = ml.drop_vars(["pt", "pv", "n2"])
+    ml = xarray.concat([ml, ml.assign_coords(time=ml["time"] + np.timedelta64(6, "h"))], "time")
+    sfc = xarray.concat([sfc, sfc.assign_coords(time=sfc["time"] + np.timedelta64(6, "h"))], "time")
+    sfc = sfc.drop_vars([x for x in sfc.data_vars if x.startswith("TROPOPAUSE")])
+    for name in ["serial", "chunked"]:
+        ml.to_netcdf(tmpdir / f"{name}.ml.nc", format="NETCDF4_CLASSIC")
+        sfc.to_netcdf(tmpdir / f"{name}.sfc.nc", format="NETCDF4_CLASSIC")
+    option, _, _ = add_ancillary.parse_args(
+        ["--theta", "--pv", "--n2", "--tropopause", "--max-memory", "1", base, base])
+
+    assert len(add_ancillary.memory_tiles(ml, 100)) == 2
+    assert len(add_ancillary.memory_tiles(ml, 0)) == 2 * 3
+    serial = add_ancillary.add_ancillary(ml, sfc, option)
+    for xin, kind in zip(serial, ["ml", "sfc"]):
+        xin.to_netcdf(tmpdir / f"serial.{kind}.nc", format="NETCDF4_CLASSIC")
+    add_ancillary.add_ancillary_chunked(
+        tmpdir / "chunked.sfc.nc", tmpdir / "chunked.ml.nc", option, 0)
+
+    for kind in ["ml", "sfc"]:
+        ref = xarray.load_dataset(tmpdir / f"serial.{kind}.nc")
+        fut = xarray.load_dataset(tmpdir / f"chunked.{kind}.nc")
+        fut.attrs = ref.attrs
+        assert ref.identical(fut)
+
+
+def test_add_ancillary_low_memory():
+    base = os.path.dirname(__file__)
+    ml = xarray.load_dataset(os.path.join(base, "mss", "2021-01-29T00:00:00.an.ml.nc"))
+    sfc = xarray.load_dataset(os.path.join(base, "mss", "2021-01-29T00:00:00.an.sfc.nc"))
+    ml = ml.drop_vars(["pt", "pv", "n2"])
+    sfc = sfc.drop_vars([x for x in sfc.data_vars if x.startswith("TROPOPAUSE")])
+    flags = ["--theta", "--pv", "--n2", "--tropopause", base, base]
+    option, _, _ = add_ancillary.parse_args(flags)
+    low_option, _, _ = add_ancillary.parse_args(["--low-memory"] + flags)
+
+    ref_ml, ref_sfc = add_ancillary.add_ancillary(ml.copy(deep=True), sfc.copy(deep=True), option)
+    low_ml, low_sfc = add_ancillary.add_ancillary(ml, sfc, low_option)
+
+    for ref, low in [(ref_ml, low_ml), (ref_sfc, low_sfc)]:
+        assert list(ref.data_vars) == list(low.data_vars)
+        for var in ref.data_vars:
+            assert ref[var].dims == low[var].dims
+            assert ref[var].attrs == low[var].attrs
+    for var, rtol in [("pt", 1e-6), ("pv", 1e-4), ("n2", 1e-3)]:
+        assert low_ml[var].dtype == np.float32
+        scale = np.abs(ref_ml[var].values).max()
+        assert np.allclose(low_ml[var].values, ref_ml[var].values, rtol=rtol, atol=rtol * scale)
+    for var in [x for x in ref_sfc.data_vars if x.startswith("TROPOPAUSE")]:
+        assert np.allclose(low_sfc[var].values, ref_sfc[var].values, rtol=1e-4, equal_nan=True)
+
+
+def test_pressure_single():
+    rng = np.random.default_rng(0)
+    ml = xarray.Dataset({"hyam": ("nhym", np.linspace(0, 2000, 10)), "hybm": ("nhym", np.linspace(0, 1, 10))},
+                        coords={"lev": [2, 5, 9]})
+    sp = rng.uniform(9e4, 1.05e5, (2, 4, 5))
+    pres = add_ancillary.pressure_single(ml, sp)
+    assert pres.dtype == np.float32 and pres.shape == (2, 3, 4, 5)
+    expected = (ml["hyam"].data[[1, 4, 8], None, None] + ml["hybm"].data[[1, 4, 8], None, None] * sp[:, None]) / 100
+    assert np.allclose(pres, expected, rtol=1e-6)
+
+
+def test_level_blocks():
+    for nlev in [3, 4, 16, 17, 33, 137]:
+        covered = []
+        for levels, interior in add_ancillary.level_blocks(nlev):
+            assert levels.stop - levels.start >= 3
+            covered.extend(range(levels.start + interior.start, levels.start + interior.stop))
+        assert covered == list(range(nlev))
+
+
+def test_derivative():
+    rng = np.random.default_rng(0)
+    f = rng.normal(size=(2, 7, 5))
+    x = np.cumsum(rng.uniform(0.5, 2, size=(2, 7, 5)), axis=1)
+    weights = add_ancillary.derivative_weights(np.diff(x, axis=1), 1)
+    expected = first_derivative(f, x=x, axis=1)
+    assert np.allclose(add_ancillary.derivative(weights, f, 1), expected, rtol=1e-12)
+
+
+def test_add_ancillary_fused():
+    base = os.path.dirname(__file__)
+    ml = xarray.load_dataset(os.path.join(base, "mss", "2021-01-29T00:00:00.an.ml.nc"))
+    sfc = xarray.load_dataset(os.path.join(base, "mss", "2021-01-29T00:00:00.an.sfc.nc"))
+    ml = ml.drop_vars(["pt", "pv", "n2"])
+    flags = ["--theta", "--pv", "--n2", base, base]
+
+    ref_ml, _ = add_ancillary.add_ancillary(
+        ml.copy(deep=True), sfc.copy(deep=True), add_ancillary.parse_args(flags)[0])
+    for extra, rtol in [([], 1e-10), (["--low-memory"], 1e-4)]:
+        option, _, _ = add_ancillary.parse_args(["--fused"] + extra + flags)
+        fused_ml, _ = add_ancillary.add_ancillary(ml.copy(deep=True), sfc.copy(deep=True), option)
+        assert list(ref_ml.data_vars) == list(fused_ml.data_vars)
+        for var in ["pt", "pv", "n2"]:
+            assert ref_ml[var].dims == fused_ml[var].dims
+            for att in ["units", "standard_name"]:
+                assert ref_ml[var].attrs[att] == fused_ml[var].attrs[att]
+            scale = np.abs(ref_ml[var].values).max()
+            assert np.allclose(fused_ml[var].values, ref_ml[var].values, rtol=rtol, atol=rtol * scale)
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import netCDF4
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import append_steps  # noqa: E402
+
+ENCODING = {"time": {"units": "hours since 2021-01-29T00:00:00", "dtype": "float64"}}
+
+
+def steps(hours, value):
+    return xr.Dataset(
+        {"t": (("time", "lev", "lat", "lon"), np.full((len(hours), 2, 3, 4), value) + np.array(hours)[:, None, None, None]),
+         "sp": (("time", "lat", "lon"), np.full((len(hours), 3, 4), value))},
+        coords={"time": np.datetime64("2021-01-29T00") + np.array(hours, dtype="m8[h]"),
+                "lev": [1., 2.], "lat": np.arange(3.), "lon": np.arange(4.)})
+
+
+def test_append(tmpdir):
+    filename = str(tmpdir / "a.ml.nc")
+    append_steps.write(steps([0, 6], 100), filename, ENCODING)
+    with netCDF4.Dataset(filename) as ncfile:
+        assert ncfile.dimensions["time"].isunlimited()
+
+    # appends a later step, inserts an earlier one and overwrites one in place
+    append_steps.write(steps([12], 200), filename, ENCODING)
+    append_steps.write(steps([3, 6], 300), filename, ENCODING)
+
+    with xr.load_dataset(filename) as ds:
+        assert np.array_equal(ds["time"].values, np.datetime64("2021-01-29T00") + np.array([0, 3, 6, 12], "m8[h]"))
+        assert ds["sp"].values[:, 0, 0].tolist() == [100, 300, 300, 200]
+        assert ds["t"].values[:, 1, 2, 3].tolist() == [100, 303, 306, 212]
+        assert "history" in ds.attrs
+
+
+def test_clip_packed(tmpdir):
+    filename = str(tmpdir / "a.pl.nc")
+    encoding = dict(ENCODING, sp={"dtype": "int16", "scale_factor": 0.01, "add_offset": 100., "_FillValue": -32768})
+    append_steps.write(steps([0], 100.), filename, encoding)
+    append_steps.write(steps([6], 1000.), filename, encoding)
+    with xr.load_dataset(filename) as ds:
+        assert np.allclose(ds["sp"].values[:, 0, 0], [100, 100 + 327.67])
@@ -0,0 +1,91 @@
+import datetime
+import os
+import shutil
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import backfill_cds  # noqa: E402
+
+FAKE = """
+import os, sys
+stage = os.environ["BACKFILL_STAGE"]
+with open(sys.argv[1], "a") as fout:
+    fout.write(f"{stage} {sys.argv[2]}T{sys.argv[3]}\\n")
+if sys.argv[2:] == ["2021-01-29", "12:00:00"] and stage == "convert":
+    sys.exit(1)
+"""
+
+
+def test_backfill(tmpdir):
+    (tmpdir / "fake.py").write_text(FAKE, "utf-8")
+    record = str(tmpdir / "record.txt")
+    times = backfill_cds.analysis_times(
+        datetime.datetime(2021, 1, 29), datetime.datetime(2021, 1, 30), 6)
+    assert len(times) == 5
+
+    backfill = backfill_cds.Backfill(
+        [sys.executable, str(tmpdir / "fake.py"), record], str(tmpdir / "state"),
+        downloads=2, conversions=2, prefetch=3)
+    status = backfill.run(times)
+    assert [x["state"] for x in status.values()] == ["done", "done", "convert failed", "done", "done"]
+    with open(record) as fin:
+        lines = fin.read().splitlines()
+    assert len(lines) == 10
+    for time in times:
+        name = time.strftime("%Y-%m-%dT%H:%M:%S")
+        assert lines.index(f"download {name}") < lines.index(f"convert {name}")
+    assert "convert failed" in backfill.summary()
+
+    # a restart only processes the failed time
+    os.remove(record)
+    backfill = backfill_cds.Backfill(
+        [sys.executable, str(tmpdir / "fake.py"), record], str(tmpdir / "state"))
+    status = backfill.run(times)
+    assert [x["state"] for x in status.values()] == ["skipped", "skipped", "convert failed", "skipped", "skipped"]
+    with open(record) as fin:
+        assert fin.read().splitlines() == ["download 2021-01-29T12:00:00", "convert 2021-01-29T12:00:00"]
+
+
+DOWNLOAD = """
+import os
+with open(os.environ["RECORD"], "a") as fout:
+    fout.write(f"download {os.environ['BASE']}\\n")
+open(os.path.join("grib", os.environ["BASE"] + ".ml.grib"), "w").close()
+"""
+
+CONVERT = """
+[[ -f grib/${BASE}.ml.grib ]] || exit 1
+echo convert ${BASE} >> $RECORD
+"""
+
+
+def test_backfill_get_cds(tmpdir, monkeypatch):
+    # runs the flag handling of the real get_cds.sh with the settings sourced by it
+    bindir = tmpdir / "bin"
+    bindir.mkdir()
+    shutil.copy(os.path.join(os.path.dirname(__file__), "..", "bin", "get_cds.sh"), str(bindir))
+    shutil.copy(os.path.join(os.path.dirname(__file__), "..", "settings.default"), str(tmpdir))
+    (bindir / "download_cds.py").write_text(DOWNLOAD, "utf-8")
+    (bindir / "convert.sh").write_text(CONVERT, "utf-8")
+    (tmpdir / "settings.config").write_text(
+        f"export PYTHON={sys.executable}\nexport CLEANUP=yes\nexport DOWNLOAD_ONLY=no\n", "utf-8")
+    record = str(tmpdir / "record.txt")
+    monkeypatch.setenv("RECORD", record)
+    for name in ["DOWNLOAD_ONLY", "CONVERT_ONLY", "BACKFILL_STAGE"]:
+        monkeypatch.delenv(name, raising=False)
+
+    times = backfill_cds.analysis_times(
+        datetime.datetime(2021, 1, 29), datetime.datetime(2021, 1, 29, 6), 6)
+    backfill = backfill_cds.Backfill(
+        ["bash", str(bindir / "get_cds.sh")], str(tmpdir / "state"), downloads=2, conversions=2)
+    status = backfill.run(times)
+    assert [x["state"] for x in status.values()] == ["done", "done"]
+    with open(record) as fin:
+        lines = fin.read().splitlines()
+    assert sorted(lines) == [
+        "convert 2021-01-29T00:00:00.an", "convert 2021-01-29T06:00:00.an",
+        "download 2021-01-29T00:00:00.an", "download 2021-01-29T06:00:00.an"]
+    for time in times:
+        base = backfill.base(time)
+        assert lines.index(f"download {base}") < lines.index(f"convert {base}")
+    assert os.listdir(str(tmpdir / "grib")) == []
@@ -0,0 +1,24 @@
+import json
+import os
+import subprocess
+import sys
+
+
+def test_benchmark(tmpdir):
+    script = os.path.join(os.path.dirname(__file__), "..", "_benchmark", "benchmark_kernels.py")
+    output = str(tmpdir / "bench.json")
+    args = [sys.executable, script, "--size", "1x30x10x20", "--size", "2x30x10x20", "--repeat", "2",
+            "--kernels", "find_tropopause*", "geopotential.*", "interpolate_targets"]
+    subprocess.run(args + ["--output", output], check=True)
+    with open(output) as fin:
+        results = json.load(fin)
+    assert "commit" in results["environment"]
+    assert [x["kernel"] for x in results["results"]] == [
+        "find_tropopause", "find_tropopauses", "geopotential.production_step", "geopotential.vectorized",
+        "interpolate_targets"] * 2
+    assert results["results"][-1]["size"] == {"time": 2, "lev": 30, "lat": 10, "lon": 20}
+    assert all(len(x["times"]) == 2 and x["best"] > 0 for x in results["results"])
+
+    result = subprocess.run(args[:6] + ["--kernels", "interpolate_targets", "--repeat", "1", "--compare", output],
+                            check=True, capture_output=True, text=True)
+    assert "speedup" in result.stdout
@@ -1,8 +1,13 @@
 import os
 import glob
+import shutil
+import sys
 
 import xarray
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import compare_products  # noqa: E402
+
 
 def test_get_cds(tmpdir):
     base = os.path.dirname(__file__) + "/../"
@@ -11,7 +16,7 @@ def test_get_cds(tmpdir):
         config = tf.read().format(tmpdir=str(tmpdir), bindir=base + "bin")
     with open(base + "settings.config", "w") as tf:
         tf.write(config)
-    os.symlink(base + "_test/grib", tmpdir / "grib")
+    shutil.copytree(base + "_test/grib", str(tmpdir / "grib"))
     os.symlink(base + "_test/mss", tmpdir / "mss.ref")
     os.chdir(base)
     os.system("bash bin/get_cds.sh 2021-01-29 00:00:00")
@@ -32,3 +37,12 @@ def test_get_cds(tmpdir):
                         print(var, att, ref[var].attrs[att], fut[var].attrs[att])
                         assert att in fut[var].attrs
                         assert ref[var].attrs[att] == fut[var].attrs[att]
+
+    config = compare_products.load_config(base + "_test/golden.json")
+    table, failures = compare_products.report(compare_products.compare_products("mss.ref", "mss", config["tolerances"]))
+    print(table)
+    assert failures == 0
+    budget_failures = compare_products.check_budgets(
+        compare_products.metrics.read_records("metrics.jsonl"), config["budgets"])
+    print("\n".join(budget_failures))
+    assert budget_failures == []
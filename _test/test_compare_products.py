@@ -0,0 +1,37 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import compare_products  # noqa: E402
+
+
+def test_tolerance():
+    tolerances = {"*": {"rtol": 1e-6, "scaled_atol": 1e-4}, "*.pv": {"scaled_atol": 0.05}}
+    assert compare_products.tolerance(tolerances, "ml", "t")["scaled_atol"] == 1e-4
+    tol = compare_products.tolerance(tolerances, "pl", "pv")
+    assert tol["scaled_atol"] == 0.05 and tol["rtol"] == 1e-6 and tol["atol"] == 0
+
+
+def test_compare_variable():
+    tol = dict(compare_products.DEFAULT_TOLERANCE, scaled_atol=1e-3)
+    ref = np.array([1., 100., np.nan])
+    result = compare_products.compare_variable(ref, ref + [0.05, 0, np.nan], tol)
+    assert result["failures"] == []
+    assert np.isclose(result["max_abs"], 0.05) and np.isclose(result["rms"], 0.05 / np.sqrt(2))
+    result = compare_products.compare_variable(ref, np.array([1., 100., 0.]), tol)
+    assert result["failures"] == ["1 NaN mismatches"]
+    result = compare_products.compare_variable(ref, ref + [0.2, 0, np.nan], tol)
+    assert len(result["failures"]) == 1 and "exceed" in result["failures"][0]
+    result = compare_products.compare_variable(ref, ref + [0.05, 0, np.nan], dict(tol, rms=0.01))
+    assert len(result["failures"]) == 1 and "RMS" in result["failures"][0]
+    assert compare_products.compare_variable(ref, ref[:2], tol)["failures"] != []
+
+
+def test_check_budgets():
+    records = [{"base": "a", "stage": "convert", "wall_seconds": 3, "max_rss_bytes": 100},
+               {"base": "b", "stage": "convert", "wall_seconds": 4, "max_rss_bytes": 200}]
+    assert compare_products.check_budgets(records, {"convert": {"wall_seconds": 8}, "other": {"wall_seconds": 0}}) == []
+    failures = compare_products.check_budgets(records, {"convert": {"wall_seconds": 5, "max_rss_bytes": 150}})
+    assert len(failures) == 2
@@ -0,0 +1,96 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import xarray
+from eccodes import codes_get, codes_grib_new_from_file, codes_release, codes_set, codes_write
+
+
+def test_vectorized(tmpdir):
+    base = os.path.dirname(__file__) + "/../"
+    grib = str(tmpdir / "in.")
+    for name in ["ml", "ml2"]:
+        shutil.copyfile(base + f"_test/grib/2021-01-29T00:00:00.an.{name}.grib", grib + name + ".grib")
+    outputs = []
+    for mode in [[], ["-v", "-j", "2"]]:
+        outputs.append(str(tmpdir / "z{}.grib".format(len(outputs))))
+        subprocess.check_call(
+            [sys.executable, base + "bin/compute_geopotential_on_ml.py", grib + "ml.grib", grib + "ml2.grib",
+             "-o", outputs[-1]] + mode)
+
+    with open(outputs[0], "rb") as ref, open(outputs[1], "rb") as fut:
+        assert ref.read() == fut.read()
+
+
+def test_step_order(tmpdir):
+    base = os.path.dirname(__file__) + "/../"
+    grib = base + "_test/grib/2021-01-29T00:00:00.an."
+    for name in ["ml", "ml2"]:
+        with open(str(tmpdir / (name + ".grib")), "wb") as fout:
+            for step in [3, 0, 12]:
+                with open(grib + name + ".grib", "rb") as fin:
+                    while True:
+                        gid = codes_grib_new_from_file(fin)
+                        if gid is None:
+                            break
+                        codes_set(gid, "step", step)
+                        codes_write(gid, fout)
+                        codes_release(gid)
+    outputs = []
+    for mode in [[], ["-v", "-j", "2"]]:
+        outputs.append(str(tmpdir / "z{}.grib".format(len(outputs))))
+        subprocess.check_call(
+            [sys.executable, base + "bin/compute_geopotential_on_ml.py", str(tmpdir / "ml.grib"),
+             str(tmpdir / "ml2.grib"), "-o", outputs[-1]] + mode)
+
+    steps = []
+    with open(outputs[0], "rb") as fin:
+        while True:
+            gid = codes_grib_new_from_file(fin)
+            if gid is None:
+                break
+            steps.append(codes_get(gid, "step", str))
+            codes_release(gid)
+    # steps are sorted as strings like the values of an eccodes index
+    assert [x for i, x in enumerate(steps) if i == 0 or steps[i - 1] != x] == ["0", "12", "3"]
+    with open(outputs[0], "rb") as ref, open(outputs[1], "rb") as fut:
+        assert ref.read() == fut.read()
+
+
+def test_missing_z(tmpdir):
+    base = os.path.dirname(__file__) + "/../"
+    grib = str(tmpdir / "in.")
+    shutil.copyfile(base + "_test/grib/2021-01-29T00:00:00.an.ml.grib", grib + "ml.grib")
+    with open(base + "_test/grib/2021-01-29T00:00:00.an.ml2.grib", "rb") as fin, open(grib + "ml2.grib", "wb") as fout:
+        while True:
+            gid = codes_grib_new_from_file(fin)
+            if gid is None:
+                break
+            if codes_get(gid, "shortName") != "z":
+                codes_write(gid, fout)
+            codes_release(gid)
+    result = subprocess.run(
+        [sys.executable, base + "bin/compute_geopotential_on_ml.py", grib + "ml.grib", grib + "ml2.grib",
+         "-v", "-o", str(tmpdir / "z.grib")], capture_output=True, text=True)
+    assert result.returncode != 0
+    assert "ValueError: {}ml2.grib contains no z on level 1".format(grib) in result.stderr
+
+
+def test_netcdf(tmpdir):
+    base = os.path.dirname(__file__) + "/../"
+    grib = str(tmpdir / "in.")
+    for name in ["ml", "ml2"]:
+        shutil.copyfile(base + f"_test/grib/2021-01-29T00:00:00.an.{name}.grib", grib + name + ".grib")
+    ref = xarray.load_dataset(base + "_test/mss/2021-01-29T00:00:00.an.ml.nc")
+    ref.drop_vars("z").to_netcdf(str(tmpdir / "ml.nc"), format="NETCDF4_CLASSIC")
+    subprocess.check_call(
+        [sys.executable, base + "bin/compute_geopotential_on_ml.py", grib + "ml.grib", grib + "ml2.grib",
+         "-n", str(tmpdir / "ml.nc")])
+
+    fut = xarray.load_dataset(str(tmpdir / "ml.nc"))
+    assert fut["z"].dims == ref["z"].dims
+    for att in ["units", "standard_name"]:
+        assert fut["z"].attrs[att] == ref["z"].attrs[att]
+    # reference went through GRIB packing
+    assert abs(fut["z"] - ref["z"]).max() < 1
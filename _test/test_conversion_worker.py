@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+import time
+
+import xarray
+
+BIN = os.path.join(os.path.dirname(__file__), "..", "bin")
+sys.path.insert(0, BIN)
+import interpolate_model  # noqa: E402
+
+
+def run(socket, *args):
+    return subprocess.run(
+        [sys.executable, os.path.join(BIN, "conversion_worker.py"), "--socket", socket, "run"] + list(args),
+        capture_output=True)
+
+
+def test_conversion_worker(tmpdir):
+    ml_fn = os.path.join(os.path.dirname(__file__), "mss", "2021-01-29T00:00:00.an.ml.nc")
+    socket = str(tmpdir / "worker.sock")
+    ref = interpolate_model.interpolate_targets(xarray.load_dataset(ml_fn), [("pres", "hPa", [850, 500])])[0]
+
+    # without worker, the script is run directly
+    result = run(socket, "interpolate_model", ml_fn, str(tmpdir / "direct.nc"), "pres", "hPa", "850/500")
+    assert result.returncode == 0, result.stdout
+
+    worker = subprocess.Popen(
+        [sys.executable, os.path.join(BIN, "conversion_worker.py"), "--socket", socket, "serve"])
+    try:
+        for _ in range(600):
+            if os.path.exists(socket):
+                break
+            time.sleep(0.1)
+        result = run(socket, "interpolate_model", ml_fn, str(tmpdir / "worker.nc"), "pres", "hPa", "850/500")
+        assert result.returncode == 0, result.stdout
+        assert b"Interpolating" in result.stdout
+        result = run(socket, "interpolate_model", "--processes", "x")
+        assert result.returncode == 2
+        assert b"invalid int value" in result.stdout
+    finally:
+        worker.terminate()
+        worker.wait()
+    assert not os.path.exists(socket)
+
+    for name in ["direct.nc", "worker.nc"]:
+        fut = xarray.load_dataset(tmpdir / name)
+        assert "interpolate_model.py" in fut.attrs["history"]
+        fut.attrs = ref.attrs
+        assert ref.identical(fut)
@@ -0,0 +1,40 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import xarray
+
+
+def test_convert(tmpdir):
+    base = os.path.join(os.path.dirname(__file__), "..")
+    # the GRIB index sidecars are written next to the copies
+    shutil.copytree(os.path.join(base, "_test", "grib"), str(tmpdir / "grib"))
+    grib = str(tmpdir / "grib" / "2021-01-29T00:00:00.an.")
+    subprocess.run(
+        [sys.executable, os.path.join(base, "bin", "convert.py"),
+         "--pv", "--theta", "--tropopause", "--n2", "--pressure",
+         "--model-reduction", "-d lev,0,0 -d lev,16,28,4 -d lev,32,124,2",
+         "--pres-levels", "850/500/400/300/200/150/120/100/80/65/50/40/30/20/10/5/1",
+         "--theta-levels", "330/350/370/395/475",
+         "--gph-levels", "0/5000/10000/15000/20000",
+         "--time-units", "hours since 2021-01-29T00:00:00",
+         grib, str(tmpdir / "2021-01-29T00:00:00.an.")], check=True)
+
+    for kind in ["ml", "sfc", "pv", "pl", "tl", "al"]:
+        ref_fn = os.path.join(base, "_test", "mss", f"2021-01-29T00:00:00.an.{kind}.nc")
+        fut_fn = str(tmpdir / f"2021-01-29T00:00:00.an.{kind}.nc")
+        with xarray.load_dataset(ref_fn) as ref, \
+                xarray.load_dataset(fut_fn) as fut:
+            for var in ref.variables:
+                assert var in fut.variables, (kind, var)
+                for att in ["units", "standard_name"]:
+                    if att in ref[var].attrs:
+                        assert ref[var].attrs[att] == fut[var].attrs[att], (kind, var, att)
+            if kind in ["ml", "sfc", "pv"]:
+                # variables taken over from GRIB are identical up to the GRIB packing of z
+                for var in list(ref.data_vars) + [x for x in ref.coords if x != "time"]:
+                    if var not in ["pv", "n2"] and not var.startswith("TROPOPAUSE"):
+                        atol = 1e-6 * np.nanmax(np.abs(ref[var].values))
+                        assert np.allclose(ref[var].values, fut[var].values, atol=atol, equal_nan=True), (kind, var)
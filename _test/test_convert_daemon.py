@@ -0,0 +1,67 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import convert_daemon  # noqa: E402
+
+FAKE = """
+import os, sys, time
+args = dict(zip(sys.argv[2::2], sys.argv[3::2]))
+stage = "publish" if os.environ["PUBLISH_ONLY"] == "yes" else "convert"
+if stage == "convert":
+    # earlier steps take longer to convert
+    time.sleep(0.5 - int(args["--step"]) / 1000)
+    if args["--step"] == "108":
+        sys.exit(1)
+with open(sys.argv[1], "a") as fout:
+    fout.write(f"{stage} {args['--date']}T{args['--time']} {args['--step']}\\n")
+"""
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_convert_daemon(tmpdir, use_inotify):
+    (tmpdir / "fake.py").write_text(FAKE, "utf-8")
+    record = str(tmpdir / "record.txt")
+    grib = tmpdir / "grib"
+    grib.mkdir()
+    for step in [72, 36]:
+        (grib / f"ecmwf.20250304T00.{step:03d}.ready").write_text("", "utf-8")
+    (grib / "other.20250304T00.036.ready").write_text("", "utf-8")
+
+    def trigger():
+        for step in [144, 108]:
+            time.sleep(0.3)
+            (grib / f"ecmwf.20250304T00.{step:03d}.ready").write_text("", "utf-8")
+
+    daemon = convert_daemon.ConversionDaemon(
+        str(grib), "ecmwf", [sys.executable, str(tmpdir / "fake.py"), record], jobs=4, poll=0.1 if not use_inotify else 30,
+        expected={"20250304T00": [36, 72, 108, 144]}, use_inotify=use_inotify)
+    thread = threading.Thread(target=trigger)
+    thread.start()
+    state = daemon.run(timeout=20)
+    thread.join()
+
+    assert state == {("20250304", "00", 36): "published", ("20250304", "00", 72): "published",
+                     ("20250304", "00", 108): "failed", ("20250304", "00", 144): "published"}
+    with open(record) as fin:
+        published = [x for x in fin.read().splitlines() if x.startswith("publish")]
+    assert published == [f"publish 20250304T00 {step}" for step in [36, 72, 144]]
+    assert sorted(os.listdir(grib)) == [
+        "ecmwf.20250304T00.036.log", "ecmwf.20250304T00.072.log", "ecmwf.20250304T00.108.failed",
+        "ecmwf.20250304T00.108.log", "ecmwf.20250304T00.144.log", "other.20250304T00.036.ready"]
+
+
+def test_convert_daemon_command_missing(tmpdir):
+    grib = tmpdir / "grib"
+    grib.mkdir()
+    (grib / "ecmwf.20250304T00.036.ready").write_text("", "utf-8")
+    daemon = convert_daemon.ConversionDaemon(
+        str(grib), "ecmwf", [str(tmpdir / "missing")], jobs=2, poll=0.1,
+        expected={"20250304T00": [36]}, use_inotify=False)
+
+    assert daemon.run(timeout=20) == {("20250304", "00", 36): "failed"}
+    assert "ecmwf.20250304T00.036.failed" in os.listdir(grib)
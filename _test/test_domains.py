@@ -0,0 +1,66 @@
+import os
+import shutil
+import sys
+
+import numpy as np
+import pytest
+import xarray
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import domains  # noqa: E402
+
+
+def test_union_area():
+    assert domains.parse_domain("EUR.:75/-15/30/42.5") == ("EUR.", (75., -15., 30., 42.5))
+    with pytest.raises(ValueError):
+        domains.parse_domain("75/-15/30/42.5")
+    areas = [(75., -15., 30., 42.5), (65., -60., 35., 0.)]
+    assert domains.union_area(areas, "1.0/1.0") == "76/-61/29/43.5"
+    assert domains.union_area(areas, "0.5/0.25", halo=0) == "75/-60/30/42.5"
+    # the halo is clipped at the poles and around the globe
+    assert domains.union_area([(90., -180., 60., 180.), areas[1]], "1.0/1.0") == "90/-180/34/179"
+
+
+def test_select():
+    ds = xarray.Dataset({"t": (("lat", "lon"), np.arange(5 * 360.).reshape(5, 360))},
+                        coords={"lat": [40., 39., 38., 37., 36.], "lon": np.arange(360.)})
+    part = domains.select(ds, (39., -2., 37., 2.))
+    assert list(part["lat"].values) == [39., 38., 37.]
+    assert list(part["lon"].values) == [-2., -1., 0., 1., 2.]
+    assert list(part["t"].values[0]) == [718., 719., 360., 361., 362.]
+    with pytest.raises(ValueError):
+        domains.select(ds, (60., 0., 50., 10.))
+
+    # partly covered areas are not truncated
+    ds = xarray.Dataset({"t": (("lat", "lon"), np.zeros((11, 11)))},
+                        coords={"lat": np.arange(50., 39., -1.), "lon": np.arange(11.)})
+    assert domains.select(ds, (45., 2., 42., 8.)).sizes == {"lat": 4, "lon": 7}
+    for area in [(60., -5., 45., 5.), (45., 0., 42., 12.), (55., 0., 45., 10.), (45., -1., 42., 10.)]:
+        with pytest.raises(ValueError):
+            domains.select(ds, area)
+
+
+def test_cut_products(tmpdir):
+    base = os.path.join(os.path.dirname(__file__), "mss", "2021-01-29T00:00:00.an.")
+    for product in ["ml", "sfc", "pv"]:
+        shutil.copyfile(base + product + ".nc", str(tmpdir / f"x.{product}.nc"))
+    union_prefix, prefix = str(tmpdir / "x."), str(tmpdir / "x.")
+    cuts = [("a.", (38., -3., 32., 3.)), ("b.", (40., 0., 30., 5.))]
+    with pytest.raises(ValueError):
+        domains.cut_products(union_prefix, prefix, [("", (38., -3., 32., 3.))])
+
+    domains.cut_products(union_prefix, prefix, cuts)
+    for product in ["ml", "sfc", "pv"]:
+        with xarray.load_dataset(union_prefix + product + ".nc") as union:
+            for label, (north, west, south, east) in cuts:
+                with xarray.load_dataset(f"{prefix}{label}{product}.nc") as out:
+                    ref = union.sel(lat=slice(north, south), lon=slice(west, east))
+                    assert out["time"].encoding["units"] == union["time"].encoding["units"]
+                    assert out["time"].values == union["time"].values
+                    for var in list(ref.data_vars) + ["lat", "lon"]:
+                        assert np.allclose(ref[var].values, out[var].values, equal_nan=True), (product, var)
+                        assert ref[var].attrs.get("standard_name") == out[var].attrs.get("standard_name")
+
+    domains.cut_products(union_prefix, prefix, cuts, remove=True)
+    assert not os.path.exists(union_prefix + "ml.nc")
+    assert os.path.exists(prefix + "b.ml.nc")
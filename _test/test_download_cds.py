@@ -0,0 +1,98 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import download_cds  # noqa: E402
+
+ENV = {
+    "DATE": "2021-01-29", "TIME": "00:00:00", "CDS_TYPE": "an", "AREA": "40/-5/30/5.5", "GRID": "1.0/1.0",
+    "MODEL_LEVELS": "1/to/137", "MODEL_PARAMETERS": "T/U/V", "MODEL2_PARAMETERS": "LNSP/Z",
+    "PV_LEVELS": "2000", "PV_PARAMETERS": "Z/PRES", "SFC_PARAMETERS": "LSM/MSL",
+}
+
+
+class FakeClient:
+    """Stands in for cdsapi.Client, failing the first attempt of every request"""
+    lock = threading.Lock()
+    calls = []
+    active = 0
+    max_active = 0
+
+    def retrieve(self, name, request, target):
+        with self.lock:
+            FakeClient.calls.append(request)
+            FakeClient.active += 1
+            FakeClient.max_active = max(FakeClient.max_active, FakeClient.active)
+            failed = FakeClient.calls.count(request) == 1
+        try:
+            assert target.endswith(".tmp")
+            if failed:
+                raise RuntimeError("queue full")
+            with open(target, "w") as tf:
+                tf.write(f"{request['param']}:{request.get('levelist', '')}\n")
+        finally:
+            with self.lock:
+                FakeClient.active -= 1
+
+
+def test_split_request():
+    request = {"param": "T/U", "levelist": "1/to/5"}
+    assert [x["param"] for x in download_cds.split_request(request, "param")] == ["T", "U"]
+    assert [x["levelist"] for x in download_cds.split_request(request, "levels", 2)] == ["1/2", "3/4", "5"]
+    assert download_cds.split_request(request, "none") == [request]
+
+
+def test_scheduler(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    os.mkdir("grib")
+    jobs = download_cds.build_jobs(dict(ENV, CDS_SPLIT="param"))
+    assert len(jobs["grib/2021-01-29T00:00:00.an.ml.grib"][1]) == 3
+    with open("grib/2021-01-29T00:00:00.an.sfc.grib", "w") as tf:
+        tf.write("present\n")
+    with open("grib/2021-01-29T00:00:00.an.ml.grib.part001", "w") as tf:
+        tf.write("U:resumed\n")
+
+    delays = []
+    scheduler = download_cds.Scheduler(FakeClient, concurrency=2, retries=1, backoff=5, sleep=delays.append)
+    assert scheduler.run(jobs) == []
+
+    assert FakeClient.max_active <= 2
+    assert all("dataset" not in x for x in FakeClient.calls)
+    assert delays == [5] * 4
+    assert sorted(x["param"] for x in FakeClient.calls) == ["LNSP/Z"] * 2 + ["T"] * 2 + ["V"] * 2 + ["Z/PRES"] * 2
+    assert sorted(os.listdir("grib")) == sorted(f"2021-01-29T00:00:00.an.{x}.grib" for x in ["ml", "ml2", "pv", "sfc"])
+    with open("grib/2021-01-29T00:00:00.an.ml.grib") as tf:
+        assert tf.read() == "T:1/to/137\nU:resumed\nV:1/to/137\n"
+    with open("grib/2021-01-29T00:00:00.an.sfc.grib") as tf:
+        assert tf.read() == "present\n"
+
+    FakeClient.calls.clear()
+    os.remove("grib/2021-01-29T00:00:00.an.pv.grib")
+    scheduler = download_cds.Scheduler(FakeClient, retries=0, sleep=delays.append)
+    assert scheduler.run(jobs) == ["grib/2021-01-29T00:00:00.an.pv.grib"]
+    assert sorted(os.listdir("grib")) == sorted(f"2021-01-29T00:00:00.an.{x}.grib" for x in ["ml", "ml2", "sfc"])
+
+
+class FakeCache:
+    """Stands in for grib_cache.GribCache, recording the stored targets"""
+
+    def __init__(self):
+        self.stored = []
+
+    def fetch(self, request, target):
+        return False
+
+    def store(self, request, target):
+        assert request["dataset"] == download_cds.DATASET
+        self.stored.append(target)
+
+
+def test_scheduler_cache(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    os.mkdir("grib")
+    jobs = download_cds.build_jobs(dict(ENV, CDS_SPLIT="param"))
+    cache = FakeCache()
+    scheduler = download_cds.Scheduler(FakeClient, retries=1, sleep=lambda _: None, cache=cache)
+    assert scheduler.run(jobs) == []
+    assert sorted(cache.stored) == sorted(f"grib/2021-01-29T00:00:00.an.{x}.grib" for x in ["ml", "ml2", "pv", "sfc"])
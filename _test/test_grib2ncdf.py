@@ -0,0 +1,67 @@
+import os
+import shutil
+import sys
+
+import numpy as np
+import pytest
+import xarray
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import convert  # noqa: E402
+import grib2ncdf  # noqa: E402
+
+
+@pytest.mark.parametrize("kind, vertical, jobs", [
+    ("ml", "hybrid", 2), ("ml2", None, 1), ("sfc", None, 1), ("pv", "potentialVorticity", 1)])
+def test_convert(tmpdir, kind, vertical, jobs):
+    grib = str(tmpdir / f"{kind}.grib")
+    shutil.copyfile(os.path.join(os.path.dirname(__file__), "grib", f"2021-01-29T00:00:00.an.{kind}.grib"), grib)
+    grib2ncdf.convert(grib, str(tmpdir / f"test.{kind}.nc"), jobs=jobs)
+
+    ref = convert.read_grib(grib, vertical=vertical)
+    with xarray.load_dataset(str(tmpdir / f"test.{kind}.nc")) as out:
+        if kind == "ml2":
+            # cdo keeps the single model level of lnsp and z
+            assert out.sizes["lev"] == 1
+            out = out.isel(lev=0, drop=True)
+        for var in ref.variables:
+            assert out[var].dims == ref[var].dims, var
+            assert np.array_equal(out[var].values, ref[var].values, equal_nan=True), var
+            if var != "lev" and "units" in ref[var].attrs:
+                assert out[var].attrs["units"] == ref[var].attrs["units"], var
+        if kind == "ml":
+            assert out["lev"].attrs["formula"] == "hyam hybm (mlev=hyam+hybm*aps)"
+            assert np.allclose((out["hyai"].values[1:] + out["hyai"].values[:-1]) / 2, out["hyam"].values)
+        if kind == "pv":
+            assert out["Z"].attrs["code"] == 129
+            assert out["Z"].encoding["complevel"] == 7
+
+
+def test_convert_zarr(tmpdir, monkeypatch):
+    pytest.importorskip("zarr")
+    from eccodes import codes_grib_new_from_file, codes_release, codes_set, codes_write
+
+    grib = os.path.join(os.path.dirname(__file__), "grib", "2021-01-29T00:00:00.an.sfc.grib")
+    for step in [0, 6]:
+        with open(grib, "rb") as fin, open(str(tmpdir / f"{step:03d}.sfc.grib"), "wb") as fout:
+            while True:
+                gid = codes_grib_new_from_file(fin)
+                if gid is None:
+                    break
+                codes_set(gid, "step", step)
+                codes_write(gid, fout)
+                codes_release(gid)
+    monkeypatch.delenv("NC_ENCODING", raising=False)
+    monkeypatch.setenv("ZARR_STORE", str(tmpdir / "series."))
+    for step in [0, 6]:
+        grib2ncdf.convert_zarr(str(tmpdir / f"{step:03d}.sfc.grib"), str(tmpdir / f"ecmwf.x.{step:03d}.sfc.nc"))
+
+    grib2ncdf.convert(str(tmpdir / "000.sfc.grib"), str(tmpdir / "ref.sfc.nc"))
+    with xarray.open_zarr(str(tmpdir / "series.sfc.zarr"), consolidated=True) as out, \
+            xarray.load_dataset(str(tmpdir / "ref.sfc.nc")) as ref:
+        assert np.array_equal(out["time"].values, ref["time"].values[0] + np.array([0, 6], "m8[h]"))
+        assert sorted(out.data_vars) == sorted(ref.data_vars)
+        for var in ref.data_vars:
+            assert out[var].dims == ref[var].dims, var
+            assert out[var].attrs == ref[var].attrs, var
+            assert np.array_equal(out[var].values[1], ref[var].values[0], equal_nan=True), var
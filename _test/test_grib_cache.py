@@ -0,0 +1,44 @@
+import os
+import shutil
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import grib_cache  # noqa: E402
+
+
+def test_normalize():
+    request = {"PARAM": "T/u/T", "levelist": "1/to/9/by/4", "date": "2021-01-29", "target": "x.grib"}
+    assert grib_cache.normalize(request) == {"param": ["t", "u"], "levelist": ["1", "5", "9"], "date": "2021-01-29"}
+    assert grib_cache.request_key(request) == grib_cache.request_key(
+        {"date": "2021-01-29", "levelist": "9/5/1", "param": "U/T"})
+    assert grib_cache.is_subset(grib_cache.normalize({"param": "t", "levelist": "5", "date": "2021-01-29"}),
+                                grib_cache.normalize(request))
+    assert not grib_cache.is_subset(grib_cache.normalize({"param": "q", "levelist": "5", "date": "2021-01-29"}),
+                                    grib_cache.normalize(request))
+
+
+def test_cache(tmpdir):
+    base = os.path.dirname(__file__)
+    grib = os.path.join(base, "grib", "2021-01-29T00:00:00.an.ml.grib")
+    request = {"date": "2021-01-29", "levtype": "ml", "levelist": "1/to/137",
+               "param": "T/U/V/W/Q/CC/CLWC/CIWC/D/O3"}
+    cache = grib_cache.GribCache(str(tmpdir / "cache"), max_size=1)
+    shutil.copyfile(grib, tmpdir / "ml.grib")
+    cache.store(request, str(tmpdir / "ml.grib"))
+    assert cache.fetch(request, str(tmpdir / "copy.grib"))
+    assert os.path.getsize(tmpdir / "copy.grib") == os.path.getsize(grib)
+
+    env = dict(os.environ, GRIB_CACHE=str(tmpdir / "cache"))
+    command = [sys.executable, os.path.join(base, "..", "bin", "grib_cache.py"), "fetch", str(tmpdir / "subset.grib"),
+               "date=2021-01-29", "levtype=ml"]
+    assert subprocess.run(command + ["levelist=1/to/10", "param=t/q"], env=env).returncode == 0
+    assert 0 < os.path.getsize(tmpdir / "subset.grib") < os.path.getsize(grib) / 10
+    assert subprocess.run(command + ["levelist=1/to/10", "param=t/lnsp"], env=env).returncode == 1
+    assert subprocess.run(command + ["levelist=1/to/10", "param=t"], env=dict(env, GRIB_CACHE="")).returncode == 1
+
+    request2 = dict(request, date="2021-01-30")
+    shutil.copyfile(grib, tmpdir / "ml2.grib")
+    cache.store(request2, str(tmpdir / "ml2.grib"))
+    assert not cache.fetch(request, str(tmpdir / "evicted.grib"))
+    assert cache.fetch(request2, str(tmpdir / "kept.grib"))
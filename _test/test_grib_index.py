@@ -0,0 +1,41 @@
+import os
+import shutil
+import sys
+
+import pytest
+from eccodes import codes_get_message, codes_grib_new_from_file, codes_release
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import grib_index  # noqa: E402
+
+
+def test_index(tmpdir, monkeypatch):
+    base = os.path.dirname(__file__)
+    grib = str(tmpdir / "ml2.grib")
+    shutil.copyfile(os.path.join(base, "grib", "2021-01-29T00:00:00.an.ml2.grib"), grib)
+
+    messages = grib_index.messages(grib)
+    assert os.path.exists(grib_index.sidecar(grib))
+    assert [(x["shortName"], x["paramId"], x["level"], x["step"]) for x in messages] == [
+        ("lnsp", "152", "1", "0"), ("z", "129", "1", "0")]
+
+    expected = []
+    with open(grib, "rb") as fin:
+        while (gid := codes_grib_new_from_file(fin)) is not None:
+            expected.append(codes_get_message(gid))
+            codes_release(gid)
+    with grib_index.GribIndex([grib, grib]) as index:
+        assert len(index.messages) == 4
+        assert [index.read(x) for x in index.select(shortName="z")] == [expected[1]] * 2
+        assert index.select(level=1, file=1)[0]["shortName"] == "lnsp"
+
+    # the sidecar is used as long as the file is unchanged
+    def scan(filename):
+        raise AssertionError("file scanned again")
+    monkeypatch.setattr(grib_index, "scan", scan)
+    assert grib_index.messages(grib) == messages
+    os.utime(grib, ns=(0, 0))
+    with pytest.raises(AssertionError):
+        grib_index.messages(grib)
+    monkeypatch.undo()
+    assert grib_index.messages(grib) == messages
@@ -0,0 +1,68 @@
+import os
+import sys
+import warnings
+
+from metpy.interpolate import interpolate_1d
+import numpy as np
+import xarray
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import interpolate_model  # noqa: E402
+
+
+def test_interpolate_targets():
+    base = os.path.dirname(__file__)
+    ml = xarray.load_dataset(os.path.join(base, "mss", "2021-01-29T00:00:00.an.ml.nc"))
+    targets = [("pres", "hPa", [850, 500, 200, 100]),
+               ("pt", "K", [330, 350, 370]),
+               ("z", "m", [1000, 5000, 10000])]
+
+    serial = interpolate_model.interpolate_targets(ml, targets)
+    parallel = interpolate_model.interpolate_targets(ml, targets, processes=3)
+
+    for target, ref, fut in zip(targets, serial, parallel):
+        assert ref.identical(fut)
+        assert ref.identical(interpolate_model.interpolate_dataset(ml, *target))
+        assert list(ref[target[0]].values) == target[2]
+    assert "pres" in ml.variables and ml["pres"].attrs["units"] == "hPa"
+
+
+def test_interpolation_weights():
+    base = os.path.dirname(__file__)
+    ml = xarray.load_dataset(os.path.join(base, "mss", "2021-01-29T00:00:00.an.ml.nc"))
+    rng = np.random.default_rng(0)
+    t = ml["t"].values + rng.normal(0, 1, ml["t"].shape).astype(np.float32)
+    t[0, 3:5, 2, :] = np.nan
+    for vert_axis, levels in [("pres", [1000, 850, 500, 200, 100, 10, 0.001]),
+                              ("pt", [200, 330, 350, 370, 3000]),
+                              ("pt", [475, 330, 350])]:
+        xp = ml[vert_axis].values.copy()
+        xp[0, 10:12, 5, :] = np.nan
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            weights = interpolate_model.interpolation_weights(levels, xp, axis=1)
+            for y in [t, ml["pv"].values]:
+                ref = interpolate_1d(levels, xp, y, axis=1)
+                fut = interpolate_model.apply_interpolation_weights(weights, y)
+                assert ref.dtype == fut.dtype
+                assert np.array_equal(ref, fut, equal_nan=True)
+
+
+def test_interpolate_chunked(tmpdir):
+    base = os.path.dirname(__file__)
+    ml = xarray.load_dataset(os.path.join(base, "mss", "2021-01-29T00:00:00.an.ml.nc"))
+    ml = xarray.concat([ml, ml.assign_coords(time=ml["time"] + np.timedelta64(6, "h"))], "time")
+    ml.to_netcdf(tmpdir / "ml.nc", format="NETCDF4_CLASSIC")
+    targets = [("pres", "hPa", [850, 500, 200, 100]),
+               ("z", "m", [1000, 5000, 10000])]
+
+    assert len(interpolate_model.memory_chunks(ml, 100)) == 2
+    assert len(interpolate_model.memory_chunks(ml, 1)) == 2 * 3
+    interpolate_model.interpolate_chunked(
+        tmpdir / "ml.nc", [tmpdir / "pl.nc", tmpdir / "al.nc"], targets, 1)
+    for target, ref, name in zip(targets, interpolate_model.interpolate_targets(ml, targets), ["pl", "al"]):
+        ref.to_netcdf(tmpdir / "ref.nc", format="NETCDF4_CLASSIC")
+        ref = xarray.load_dataset(tmpdir / "ref.nc")
+        fut = xarray.load_dataset(tmpdir / f"{name}.nc")
+        fut.attrs = ref.attrs
+        assert ref.identical(fut)
@@ -0,0 +1,62 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+BIN = os.path.join(os.path.dirname(__file__), "..", "bin")
+sys.path.insert(0, BIN)
+import metrics  # noqa: E402
+
+
+def test_metrics(tmpdir, monkeypatch):
+    filename = str(tmpdir / "metrics.jsonl")
+    with metrics.stage("disabled"):
+        pass
+    assert not os.path.exists(filename)
+
+    monkeypatch.setenv("METRICS_FILE", filename)
+    monkeypatch.setenv("BASE", "2021-01-29T00:00:00.an")
+    for _ in range(2):
+        with metrics.stage("interpolate.pres"):
+            with open(tmpdir / "data", "wb") as fout:
+                fout.write(b"x" * 2 ** 20)
+    subprocess.run([sys.executable, os.path.join(BIN, "metrics.py"), "run", "copy",
+                    sys.executable, "-c", f"open({str(tmpdir / 'copy')!r}, 'wb').write(b'y' * 2 ** 21)"], check=True)
+
+    records = metrics.read_records(filename, base="2021-01-29T00:00:00.an")
+    assert [x["stage"] for x in records] == ["interpolate.pres", "interpolate.pres", "copy"]
+    for entry in records:
+        assert entry["wall_seconds"] >= 0 and entry["cpu_seconds"] >= 0 and entry["max_rss_bytes"] > 0
+    assert records[0]["write_bytes"] >= 2 ** 20
+    assert records[2]["write_bytes"] >= 2 ** 21
+    assert metrics.read_records(filename, base="other") == []
+    assert metrics.read_records(filename, since=records[2]["start"]) == records[2:]
+
+    totals = metrics.aggregate(records)
+    assert totals[("2021-01-29T00:00:00.an", "interpolate.pres")]["count"] == 2
+    assert "interpolate.pres" in metrics.summary(records)
+    text = metrics.prometheus(records)
+    assert 'mss_retrieval_stage_write_bytes{base="2021-01-29T00:00:00.an",stage="copy"} ' \
+           f'{records[2]["write_bytes"]}' in text
+    with open(filename) as fin:
+        assert all(json.loads(line)["base"] == "2021-01-29T00:00:00.an" for line in fin)
+
+
+def test_stage_peak_memory(tmpdir, monkeypatch):
+    if metrics.peak_memory() is None or not metrics.reset_peak_memory():
+        pytest.skip("peak memory cannot be reset")
+    filename = str(tmpdir / "metrics.jsonl")
+    monkeypatch.setenv("METRICS_FILE", filename)
+    with metrics.stage("outer"):
+        with metrics.stage("large"):
+            data = bytearray(2 ** 28)
+            data[::4096] = b"x" * len(data[::4096])
+            del data
+        with metrics.stage("small"):
+            pass
+
+    peaks = {x["stage"]: x["max_rss_bytes"] for x in metrics.read_records(filename)}
+    assert peaks["large"] - peaks["small"] > 2 ** 27
+    assert peaks["outer"] >= peaks["large"]
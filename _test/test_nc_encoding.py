@@ -0,0 +1,52 @@
+import os
+import sys
+
+import netCDF4
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import nc_encoding  # noqa: E402
+
+
+def test_chunk_sizes():
+    dims, shape = ("time", "lev", "lat", "lon"), (2, 40, 181, 360)
+    assert nc_encoding.chunk_sizes("maps", dims, shape) == (1, 1, 181, 360)
+    assert nc_encoding.chunk_sizes("sections", dims, shape) == (1, 40, 16, 16)
+    assert nc_encoding.chunk_sizes("balanced", dims[:1] + dims[2:], (2, 10, 360)) == (1, 10, 64)
+    assert nc_encoding.chunk_sizes({"lat": 10}, dims, shape) == (2, 40, 10, 360)
+    assert nc_encoding.chunk_sizes(None, dims, shape) is None
+
+
+def test_settings():
+    assert nc_encoding.settings(nc_encoding.DEFAULTS, "ml", "t")["chunks"] == "balanced"
+    setting = nc_encoding.settings(nc_encoding.DEFAULTS, "pv", "Z")
+    assert setting["complevel"] == 7 and setting["shuffle"] and setting["chunks"] == "maps"
+
+
+def test_encoding(tmpdir):
+    values = np.linspace(200, 300, 3 * 4 * 5 * 6).reshape(3, 4, 5, 6)
+    values[0, 0, 0, 0] = np.nan
+    ds = xr.Dataset({"t": (("time", "lev", "lat", "lon"), values), "pv": (("time", "lev", "lat", "lon"), values),
+                     "p": (("time", "lat", "lon"), values[:, 0])},
+                    coords={"lev": np.arange(4.), "lat": np.arange(5.), "lon": np.arange(6.)})
+    config = {"*": {"chunks": "sections", "complevel": 5, "shuffle": True},
+              "*.pv": {"pack": "int16"}, "*.p": {"pack": "float32", "chunks": "maps"}}
+    filename = str(tmpdir / "test.ml.nc")
+    ds.to_netcdf(filename, format="NETCDF4_CLASSIC", encoding=nc_encoding.encoding(ds, filename, config))
+
+    with netCDF4.Dataset(filename) as ncfile:
+        assert ncfile["t"].chunking() == [1, 4, 5, 6]
+        assert ncfile["t"].filters()["zlib"] and ncfile["t"].filters()["complevel"] == 5
+        assert ncfile["pv"].dtype == np.int16
+        assert ncfile["p"].dtype == np.float32 and ncfile["p"].chunking() == [1, 5, 6]
+        assert ncfile["lev"].chunking() == "contiguous"
+    with xr.load_dataset(filename) as result:
+        assert np.array_equal(result["t"].values, values, equal_nan=True)
+        assert np.isnan(result["pv"].values[0, 0, 0, 0])
+        assert np.allclose(result["pv"].values, values, atol=100 / 2 ** 16, equal_nan=True)
+        assert np.allclose(result["p"].values, values[:, 0], equal_nan=True)
+
+    options = nc_encoding.create_options(filename, "pv", ("time", "lev", "lat", "lon"), (3, 4, 5, 6), config)
+    assert options == {"chunksizes": (1, 4, 5, 6), "zlib": True, "complevel": 5, "shuffle": True,
+                       "datatype": "float32"}
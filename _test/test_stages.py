@@ -0,0 +1,119 @@
+import os
+import shutil
+import sys
+
+import numpy as np
+import pytest
+import xarray
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import convert  # noqa: E402
+import interpolate_model  # noqa: E402
+import stages  # noqa: E402
+
+
+def make_pipeline(tmpdir, calls, scale=2):
+    def double(outputs):
+        calls.append("double")
+        with open(str(tmpdir / "input.txt")) as fin, open(outputs[str(tmpdir / "double.txt")], "w") as fout:
+            fout.write(str(scale * int(fin.read())))
+
+    def increment(outputs):
+        calls.append("increment")
+        with open(str(tmpdir / "double.txt")) as fin, open(outputs[str(tmpdir / "result.txt")], "w") as fout:
+            fout.write(str(int(fin.read()) + 1))
+
+    pipeline = stages.Pipeline(str(tmpdir / "stages"), "x.")
+    pipeline.add("double", double, [str(tmpdir / "input.txt")], [str(tmpdir / "double.txt")],
+                 {"scale": scale}, intermediate=[str(tmpdir / "double.txt")])
+    pipeline.add("increment", increment, [str(tmpdir / "double.txt")], [str(tmpdir / "result.txt")])
+    return pipeline
+
+
+def test_pipeline(tmpdir):
+    (tmpdir / "input.txt").write("3")
+    calls = []
+    make_pipeline(tmpdir, calls).run()
+    assert calls == ["double", "increment"]
+    assert (tmpdir / "result.txt").read() == "7"
+    assert not (tmpdir / "double.txt").exists()
+    assert os.listdir(str(tmpdir / "stages")) != []
+
+    # neither the removed intermediate file nor touching the input cause a rerun
+    os.utime(str(tmpdir / "input.txt"), ns=(0, 0))
+    calls = []
+    make_pipeline(tmpdir, calls).run()
+    assert calls == []
+
+    # changed parameters rebuild the intermediate file
+    calls = []
+    make_pipeline(tmpdir, calls, scale=3).run()
+    assert calls == ["double", "increment"]
+    assert (tmpdir / "result.txt").read() == "10"
+
+    # a removed output is rebuilt after the removed intermediate file
+    (tmpdir / "input.txt").write("4")
+    calls = []
+    make_pipeline(tmpdir, calls).run()
+    (tmpdir / "result.txt").remove()
+    calls = []
+    make_pipeline(tmpdir, calls).run()
+    assert calls == ["double", "increment"]
+    assert (tmpdir / "result.txt").read() == "9"
+
+
+def test_pipeline_failure(tmpdir):
+    (tmpdir / "input.txt").write("3")
+    pipeline = make_pipeline(tmpdir, [])
+
+    def fail(outputs):
+        with open(outputs[str(tmpdir / "result.txt")], "w") as fout:
+            fout.write("partial")
+        raise RuntimeError("failed")
+
+    pipeline.stages["increment"].function = fail
+    with pytest.raises(RuntimeError):
+        pipeline.run()
+    # the intermediate file is kept and no partial output is left behind
+    assert sorted(os.listdir(str(tmpdir))) == ["double.txt", "input.txt", "stages"]
+
+    calls = []
+    make_pipeline(tmpdir, calls).run()
+    assert calls == ["increment"]
+
+
+def test_convert_resume(tmpdir, monkeypatch):
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "grib"), str(tmpdir / "grib"))
+    grib = str(tmpdir / "grib" / "2021-01-29T00:00:00.an.")
+    args = ["--pv", "--theta", "--tropopause", "--pressure", "--model-reduction", "-d lev,0,0 -d lev,16,28,4",
+            "--pres-levels", "500/300", "--gph-levels", "5000/10000", "--time-units", "hours since 2021-01-29T00:00:00",
+            grib]
+    option, grib_prefix, ref_prefix = convert.parse_args(args + [str(tmpdir / "ref.")])
+    convert.convert(option, grib_prefix, ref_prefix)
+
+    interpolate_targets = interpolate_model.interpolate_targets
+
+    def fail_altitude(ml, targets, processes=1):
+        if any(target[0] == "z" for target in targets):
+            raise RuntimeError("interpolation failed")
+        return interpolate_targets(ml, targets, processes)
+
+    option, grib_prefix, nc_prefix = convert.parse_args(
+        ["--stage-dir", str(tmpdir / "stages")] + args + [str(tmpdir / "out.")])
+    monkeypatch.setattr(interpolate_model, "interpolate_targets", fail_altitude)
+    with pytest.raises(RuntimeError):
+        convert.convert(option, grib_prefix, nc_prefix)
+    assert not (tmpdir / "out.al.nc").exists()
+
+    def recompute(*args):
+        raise AssertionError("model levels computed again")
+
+    monkeypatch.setattr(interpolate_model, "interpolate_targets", interpolate_targets)
+    monkeypatch.setattr(convert, "compute_model", recompute)
+    convert.convert(option, grib_prefix, nc_prefix)
+    assert not os.path.exists(os.path.join(str(tmpdir / "stages"), "out.model.nc"))
+    for kind in ["ml", "sfc", "pv", "pl", "al"]:
+        with xarray.load_dataset(str(tmpdir / f"ref.{kind}.nc")) as ref, \
+                xarray.load_dataset(str(tmpdir / f"out.{kind}.nc")) as out:
+            for var in ref.variables:
+                assert np.array_equal(ref[var].values, out[var].values, equal_nan=True), (kind, var)
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+import zarr_output  # noqa: E402
+
+pytest.importorskip("zarr")
+
+
+def step(hour, value):
+    return xr.Dataset(
+        {"t": (("time", "lev", "lat", "lon"), np.full((1, 3, 4, 5), value)),
+         "sp": (("time", "lat", "lon"), np.full((1, 4, 5), value))},
+        coords={"time": [np.datetime64("2021-01-29T00") + np.timedelta64(hour, "h")],
+                "lev": [1., 2., 3.], "lat": np.arange(4.), "lon": np.arange(5.)},
+        attrs={"history": "test"})
+
+
+def test_store_name(monkeypatch):
+    monkeypatch.delenv("ZARR_STORE", raising=False)
+    assert zarr_output.store_name("mss/a.an.ml.nc") == "mss/a.an.ml.zarr"
+    monkeypatch.setenv("ZARR_STORE", "zarr/ecmwf.")
+    assert zarr_output.store_name("mss/a.an.ml.nc") == "zarr/ecmwf.ml.zarr"
+
+
+def test_write(tmpdir, monkeypatch):
+    monkeypatch.delenv("NC_ENCODING", raising=False)
+    monkeypatch.setenv("ZARR_STORE", str(tmpdir / "series."))
+    for hour, value in [(0, 1.), (6, 2.), (12, 3.), (6, 4.)]:
+        zarr_output.write(step(hour, value), f"mss/ecmwf.x.{hour:03d}.ml.nc",
+                          {"time": {"units": "hours since 2021-01-29T00:00:00", "dtype": "float64"}})
+
+    with xr.open_zarr(str(tmpdir / "series.ml.zarr"), consolidated=True) as ds:
+        assert np.array_equal(ds["time"].values, np.datetime64("2021-01-29T00") + np.array([0, 6, 12], "m8[h]"))
+        assert ds["t"].isel(time=1, lev=0, lat=0, lon=0).values == 4.
+        assert ds["sp"].values[:, 0, 0].tolist() == [1., 4., 3.]
+        # balanced layout of the ml product
+        assert ds["t"].encoding["chunks"] == (1, 3, 4, 5)
+        assert ds.attrs["history"] == "test"
+
+
+def test_write_out_of_order(tmpdir, monkeypatch):
+    monkeypatch.delenv("NC_ENCODING", raising=False)
+    monkeypatch.setenv("ZARR_STORE", str(tmpdir / "series."))
+    for hour, value in [(0, 1.), (6, 2.), (3, 3.), (12, 4.), (9, 5.)]:
+        zarr_output.write(step(hour, value), f"mss/ecmwf.x.{hour:03d}.ml.nc",
+                          {"time": {"units": "hours since 2021-01-29T00:00:00", "dtype": "float64"}})
+
+    with xr.open_zarr(str(tmpdir / "series.ml.zarr"), consolidated=True) as ds:
+        assert np.array_equal(ds["time"].values,
+                              np.datetime64("2021-01-29T00") + np.array([0, 3, 6, 9, 12], "m8[h]"))
+        assert ds["t"].values[:, 0, 0, 0].tolist() == [1., 3., 2., 5., 4.]
+        assert ds["sp"].values[:, 0, 0].tolist() == [1., 3., 2., 5., 4.]
@@ -2,20 +2,27 @@
 Copyright (C) 2021 by Forschungszentrum Juelich GmbH
 Author(s): Joern Ungermann, May Baer
 """
+import concurrent.futures
+import contextlib
 import datetime
-import itertools
 import optparse
 import os
 import sys
 
+import netCDF4
 from metpy.calc import (
     potential_temperature, potential_vorticity_baroclinic,
     brunt_vaisala_frequency_squared, geopotential_to_height)
+from metpy.calc.tools import nominal_lat_lon_grid_deltas
+import metpy.constants as mpconsts
 from metpy.units import units
+import pyproj
 import xarray as xr
 
 import numpy as np
-import tqdm
+
+import metrics
+import nc_encoding
 
 VARIABLES = {
     "pres": ("FULL", "hPa", "air_pressure", "Pressure"),
@@ -36,6 +43,18 @@ VARIABLES = {
                                 "vertical location of second WMO thermal tropopause"),
 }
 
+# rough ratio between the peak memory used for computing the ancillary
+# quantities of a tile and the size of its model data as stored on disk
+MEMORY_FACTOR = 10
+
+# number of model levels computed at once in the low memory mode
+LEVEL_BLOCK = 16
+# number of latitudes searched for tropopauses at once in the low memory mode
+LATITUDE_BLOCK = 16
+
+# grid used for the horizontal derivatives of PV
+CRS = pyproj.CRS.from_cf({"grid_mapping_name": "latitude_longitude", "earth_radius": 6.356766e6})
+
 
 def find_tropopause(alts, temps):
     """
@@ -111,6 +130,164 @@ def find_tropopause(alts, temps):
     return result
 
 
+def _interp_columns(x, xp, fp):
+    """
+    Applies np.interp(x[i], xp[:, i], fp[:, i]) to every column i at once.
+    xp must be increasing along the first axis. The arithmetic follows the
+    numpy implementation so that results are bit-identical.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    xp = np.asarray(xp, dtype=np.float64)
+    fp = np.asarray(fp, dtype=np.float64)
+    cols = np.arange(xp.shape[1])
+    idx = np.clip((xp <= x).sum(axis=0) - 1, 0, xp.shape[0] - 2)
+    x0, x1 = xp[idx, cols], xp[idx + 1, cols]
+    f0, f1 = fp[idx, cols], fp[idx + 1, cols]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (f1 - f0) / (x1 - x0)
+        result = slope * (x - x0) + f0
+        retry = np.isnan(result)
+        result[retry] = (slope * (x - x1) + f1)[retry]
+        retry = np.isnan(result) & (f0 == f1)
+        result[retry] = f0[retry]
+        result = np.where(x == x0, f0, result)
+        result = np.where(x < xp[0], fp[0], result)
+        result = np.where(x >= xp[-1], fp[-1], result)
+    result[np.isnan(x)] = np.nan
+    return result
+
+
+def _check_layer(alts, temps, start, lo, hi, compare):
+    """
+    Vectorized version of the average lapse rate check of find_tropopause.
+    For each column, all levels within [lo, hi] starting at level index start
+    are considered. Returns True for columns, where either at most one level
+    lies within the layer or where compare is fulfilled for the average lapse
+    rate between the lowest level and all other levels of the layer.
+    """
+    # compare in the same precision as find_tropopause does with scalar bounds
+    dtype = np.result_type(alts.dtype, lo.dtype.type(0))
+    lo, hi = lo.astype(dtype), hi.astype(dtype)
+    ok = np.ones(alts.shape[1], dtype=bool)
+    count = np.zeros(alts.shape[1], dtype=int)
+    first_alt = np.full(alts.shape[1], np.nan, dtype=alts.dtype)
+    first_temp = np.full(alts.shape[1], np.nan, dtype=temps.dtype)
+    for lev in range(start, alts.shape[0]):
+        alt, temp = alts[lev], temps[lev]
+        inside = (lo <= alt) & (alt <= hi)
+        later = inside & (count > 0)
+        if later.any():
+            avg_lapse = (temp[later] - first_temp[later]) / (alt[later] - first_alt[later])
+            ok[later] &= compare(avg_lapse)
+        first = inside & (count == 0)
+        first_alt[first] = alt[first]
+        first_temp[first] = temp[first]
+        count += inside
+        # altitudes are increasing, so no further level may enter the layer
+        if not (alt <= hi).any():
+            break
+    return (count <= 1) | ok
+
+
+def find_tropopauses(alts, temps, pressures, thetas):
+    """
+    Identifies first and second thermal WMO tropopause for all columns of a
+    (time, lev, lat, lon) cube at once. This is a column-batched version of
+    find_tropopause combined with the selection performed by add_tropopauses
+    and gives the same results. Altitudes must be given in km and increase
+    along the level axis.
+
+    Returns altitude of first and second tropopause as well as pressure and
+    potential temperature at those altitudes, each of shape (time, lat, lon).
+    Pressure is interpolated linearly in log-pressure. Missing tropopauses are
+    set to NaN.
+    """
+    dtdz_wmo1, dtdz_wmo2 = -2, -3
+    z_crit1, z_crit2 = 2, 1
+    zmin, zmax = 5, 22
+
+    nlev = alts.shape[1]
+    shape = (alts.shape[0],) + alts.shape[2:]
+
+    def columns(data):
+        return np.moveaxis(np.asarray(data), 1, 0).reshape(nlev, -1)
+
+    all_alts, all_temps = columns(alts), columns(temps)
+    ncol = all_alts.shape[1]
+
+    # Move the valid levels of every column to the front, keeping their order,
+    # and pad with NaN. This mirrors the masking of find_tropopause.
+    valid = (~(np.isnan(all_alts) | np.isnan(all_temps))) & \
+        (all_alts > zmin - 3) & (all_alts < zmax + 3)
+    nvalid = valid.sum(axis=0)
+    order = np.argsort(~valid, axis=0, kind="stable")
+    padding = np.arange(nlev)[:, np.newaxis] >= nvalid
+    z = np.take_along_axis(all_alts, order, axis=0)
+    t = np.take_along_axis(all_temps, order, axis=0)
+    z[padding] = np.nan
+    t[padding] = np.nan
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lapse_rate = np.diff(t, axis=0) / np.diff(z, axis=0)
+    lapse_alts = (z[1:] + z[:-1]) / 2.
+
+    first = np.full(ncol, np.inf)
+    second = np.full(ncol, np.inf)
+    seek = np.ones(ncol, dtype=bool)
+    with np.errstate(invalid="ignore"):
+        for j in range(1, nlev - 1):
+            # only columns with at least three valid levels carry lapse rates
+            active = j < nvalid - 1
+            if not active.any():
+                break
+
+            # check whether search for second tropopause may commence
+            reset = active & ~seek & (lapse_rate[j] < dtdz_wmo2)
+            if reset.any():
+                cols = np.nonzero(reset)[0]
+                seek[cols] = _check_layer(
+                    z[:, cols], t[:, cols], j, lapse_alts[j, cols],
+                    lapse_alts[j, cols] + z_crit2, lambda x: x < -3)
+
+            candidate = active & seek & (lapse_rate[j - 1] <= dtdz_wmo1) & (dtdz_wmo1 < lapse_rate[j])
+            if not candidate.any():
+                continue
+            cols = np.nonzero(candidate)[0]
+            lr0 = lapse_rate[j - 1, cols].astype(np.float64)
+            lr1 = lapse_rate[j, cols].astype(np.float64)
+            la0 = lapse_alts[j - 1, cols].astype(np.float64)
+            la1 = lapse_alts[j, cols].astype(np.float64)
+            alt = np.where(lr0 == dtdz_wmo1, la0, (la1 - la0) / (lr1 - lr0) * (dtdz_wmo1 - lr0) + la0)
+            inside = (zmin <= alt) & (alt <= zmax)
+            cols, alt = cols[inside], alt[inside]
+            found = _check_layer(
+                z[:, cols], t[:, cols], j, alt, alt + z_crit1, lambda x: x > dtdz_wmo1)
+            cols, alt = cols[found], alt[found]
+            seek[cols] = False
+
+            # keep the lowest and second lowest tropopause strictly within range
+            keep = (zmin < alt) & (alt < zmax)
+            cols, alt = cols[keep], alt[keep]
+            lower = alt < first[cols]
+            between = ~lower & (alt > first[cols]) & (alt < second[cols])
+            second[cols[lower]] = first[cols[lower]]
+            first[cols[lower]] = alt[lower]
+            second[cols[between]] = alt[between]
+
+    first[np.isinf(first)] = np.nan
+    second[np.isinf(second)] = np.nan
+
+    all_alts = all_alts.astype(np.float64)
+    log_press = np.log(columns(pressures))
+    all_thetas = columns(thetas)
+    result = [first, second,
+              np.exp(_interp_columns(first, all_alts, log_press)),
+              np.exp(_interp_columns(second, all_alts, log_press)),
+              _interp_columns(first, all_alts, all_thetas),
+              _interp_columns(second, all_alts, all_thetas)]
+    return tuple(x.reshape(shape) for x in result)
+
+
 def parse_args(args):
     oppa = optparse.OptionParser(usage="""
     add_ancillary.py
@@ -133,6 +310,15 @@ def parse_args(args):
                     help="Add pressure")
     oppa.add_option('--tropopause', '', action='store_true',
                     help="Add first and second tropopause")
+    oppa.add_option('--processes', '', type='int', default=1,
+                    help="Number of processes used to compute tiles of the domain in parallel")
+    oppa.add_option('--max-memory', '', type='int', default=0,
+                    help="Process the files tile by tile using about this much memory (MiB) "
+                         "instead of loading them completely")
+    oppa.add_option('--low-memory', '', action='store_true',
+                    help="Compute and store the quantities in single precision")
+    oppa.add_option('--fused', '', action='store_true',
+                    help="Compute pressure, theta, PV and N2 in one pass without metpy")
     opt, arg = oppa.parse_args(args)
 
     if len(arg) != 2:
@@ -160,146 +346,540 @@ def my_geopotential_to_height(zh):
     return result
 
 
-def add_tropopauses(ml, sfc):
+def magnitude(var, unit):
     """
-    Adds first and second thermal WMO tropopause to model. Fill value is -999.
+    Returns the values of the DataArray var in unit. The values are not
+    copied if var is given in unit already.
+    """
+    if units(var.attrs["units"]) == units(unit):
+        return var.data
+    return (var.data * units(var.attrs["units"])).to(unit).m
+
+
+def pressure_single(ml, sp):
+    """
+    Computes the pressure (hPa) on model levels level by level into a
+    single precision array, avoiding full double precision temporaries.
+    """
+    lev = ml["lev"].data.astype(int) - 1
+    hyam, hybm = ml["hyam"].data[lev], ml["hybm"].data[lev]
+    pres = np.empty((sp.shape[0], len(lev)) + sp.shape[1:], dtype=np.float32)
+    for ilev in range(len(lev)):
+        pres[:, ilev] = (hyam[ilev] + hybm[ilev] * sp) / 100
+    return pres
+
+
+def potential_temperature_single(ml):
+    """
+    Computes the potential temperature (K) like metpy, but in place in a
+    single precision array.
+    """
+    pt = np.divide(magnitude(ml["pres"], "hPa"), 1000, dtype=np.float32)
+    np.power(pt, mpconsts.kappa.m_as(""), out=pt)
+    np.divide(magnitude(ml["t"], "K"), pt, out=pt)
+    return pt
+
+
+def grid_metrics(lon, lat):
+    """
+    Returns the grid spacings dx and dy (m) between neighbouring points and
+    the parallel and meridional map factors on the grid of lon and lat, as
+    used by metpy for the horizontal derivatives.
+    """
+    dx, dy = nominal_lat_lon_grid_deltas(lon * units.degree, lat * units.degree, CRS.get_geod())
+    factors = pyproj.Proj(CRS).get_factors(*np.meshgrid(lon, lat))
+    return dx.m_as("m"), dy.m_as("m"), factors.parallel_scale, factors.meridional_scale
+
+
+def level_blocks(nlev, block=LEVEL_BLOCK, halo=1):
+    """
+    Splits nlev levels into blocks for the low memory mode. Returns tuples
+    of the level slice including a halo and the interior of the block
+    relative to the former. The vertical finite differences of metpy use
+    three neighbouring levels, so the blocks reproduce the derivatives of
+    the complete column exactly.
+    """
+    blocks = []
+    for start in range(0, nlev, block):
+        stop = min(start + block, nlev)
+        lower, upper = max(start - halo, 0), min(stop + halo, nlev)
+        # metpy requires at least three levels for its finite differences
+        lower, upper = max(min(lower, upper - 3), 0), min(max(upper, lower + 3), nlev)
+        blocks.append((slice(lower, upper), slice(start - lower, stop - lower)))
+    return blocks
+
+
+def by_level_blocks(ml, compute):
+    """
+    Evaluates compute(levels) for blocks of model levels and writes the
+    interior of the returned arrays into a preallocated single precision
+    array of the shape of the model level fields.
+    """
+    axis = ml["t"].dims.index("lev")
+    result = np.empty(ml["t"].shape, dtype=np.float32)
+    for levels, interior in level_blocks(ml.sizes["lev"]):
+        index = (slice(None),) * axis
+        result[index + (slice(levels.start + interior.start, levels.start + interior.stop),)] = \
+            compute(index + (levels,))[index + (interior,)]
+    return result
+
+
+def potential_vorticity_single(ml):
+    """
+    Computes the potential vorticity (uK m^2 kg^-1 s^-1) with metpy from
+    single precision input in blocks of model levels, passing the grid
+    explicitly instead of assigning a CRS to the dataset.
+    """
+    lon, lat = ml["lon"].data, ml["lat"].data
+    dx, dy, parallel_scale, meridional_scale = grid_metrics(lon, lat)
+    # single precision grid quantities keep all temporaries in single precision
+    grid = {"dx": dx.astype(np.float32) * units.m, "dy": dy.astype(np.float32) * units.m,
+            "latitude": lat[:, np.newaxis].astype(np.float32) * units.degree,
+            "parallel_scale": parallel_scale.astype(np.float32),
+            "meridional_scale": meridional_scale.astype(np.float32)}
+    pt, pres = magnitude(ml["pt"], "K"), magnitude(ml["pres"], "hPa")
+    u, v = (ml[x].data * units(ml[x].attrs["units"]) for x in ["u", "v"])
+
+    def compute(index):
+        pv = potential_vorticity_baroclinic(
+            pt[index] * units.K, pres[index] * units.hPa, u[index], v[index],
+            vertical_dim=ml["t"].dims.index("lev"), **grid)
+        return pv.m_as(VARIABLES["pv"][1])
+    return by_level_blocks(ml, compute)
+
+
+def brunt_vaisala_frequency_squared_single(ml):
+    """
+    Computes N2 (s^-2) with metpy from single precision input in blocks of
+    model levels.
+    """
+    height = my_geopotential_to_height(ml["z"]).data
+    pt = magnitude(ml["pt"], "K")
+
+    def compute(index):
+        n2 = brunt_vaisala_frequency_squared(
+            height[index], pt[index] * units.K, vertical_dim=ml["t"].dims.index("lev"))
+        return n2.m_as(VARIABLES["n2"][1])
+    return by_level_blocks(ml, compute)
+
+
+def derivative_weights(delta, axis):
     """
+    Returns the weights w0, w1, w2 of the three point first derivative of
+    metpy for the spacings delta along axis. The derivative at index i is
+    w0[i] f[j - 1] + w1[i] f[j] + w2[i] f[j + 1] with j = i except at the
+    edges, where j is the second and the penultimate index.
+    """
+    delta = np.moveaxis(delta, axis, 0)
+    d0, d1 = delta[:-1], delta[1:]
+    combined = d0 + d1
+    center = [-d1 / (combined * d0), (d1 - d0) / (d0 * d1), d0 / (combined * d1)]
+    d0, d1 = delta[:1], delta[1:2]
+    combined = d0 + d1
+    big = combined + d0
+    left = [-big / (combined * d0), combined / (d0 * d1), -d0 / (combined * d1)]
+    d0, d1 = delta[-2:-1], delta[-1:]
+    combined = d0 + d1
+    big = combined + d1
+    right = [d1 / (combined * d0), -combined / (d0 * d1), big / (combined * d1)]
+    return [np.moveaxis(np.concatenate(weights), 0, axis) for weights in zip(left, center, right)]
+
+
+def derivative(weights, f, axis):
+    """
+    Applies the weights of derivative_weights to f along axis.
+    """
+    w0, w1, w2 = (np.moveaxis(w, axis, 0) for w in weights)
+    values = np.moveaxis(f, axis, 0)
+    result = np.empty(np.broadcast_shapes(f.shape, weights[0].shape), dtype=np.result_type(f, weights[0]))
+    out = np.moveaxis(result, axis, 0)
+    out[1:-1] = w0[1:-1] * values[:-2] + w1[1:-1] * values[1:-1] + w2[1:-1] * values[2:]
+    out[0] = w0[0] * values[0] + w1[0] * values[1] + w2[0] * values[2]
+    out[-1] = w0[-1] * values[-3] + w1[-1] * values[-2] + w2[-1] * values[-1]
+    return result
+
+
+def add_fused(ml, sfc, option, low_memory=False):
+    """
+    Computes pressure, potential temperature, PV and N2 as selected by
+    option in one pass over blocks of model levels. Units are stripped
+    from the inputs once and applied to the outputs; the derivative weights
+    of pressure, height and the horizontal grid are shared by all
+    quantities. The formulas follow metpy, which serves as reference.
+    """
+    dims = ml["t"].dims
+    assert dims[-2:] == ("lat", "lon"), dims
+    axis = dims.index("lev")
+    dtype = np.float32 if low_memory else np.float64
+    outputs = {}
+
+    def expand(values):
+        return np.expand_dims(values, tuple(range(len(dims) - values.ndim)))
+
+    try:
+        temp = magnitude(ml["t"], "K")
+        compute_pressure = option.pressure
+        if compute_pressure:
+            try:
+                lev = ml["lev"].data.astype(int) - 1
+                hyam, hybm = (ml[x].data[lev].reshape(-1, 1, 1) for x in ["hyam", "hybm"])
+                sp = np.expand_dims(np.exp(sfc["lnsp"].data), axis)
+                outputs["pres"] = None
+            except KeyError as ex:
+                print("Some variables miss for PRES calculation", ex)
+                compute_pressure = False
+        if not compute_pressure:
+            pres = magnitude(ml["pres"], "hPa")
+        if option.theta or option.pv or (option.n2 and "pt" not in ml):
+            outputs["pt"] = None
+        elif option.n2:
+            theta_in = magnitude(ml["pt"], "K")
+        if option.pv:
+            wind = [magnitude(ml[x], "m s^-1") for x in ["u", "v"]]
+            outputs["pv"] = None
+        if option.n2:
+            if units(ml["z"].attrs["units"]).dimensionality == units.m.dimensionality:
+                geopotential = magnitude(ml["z"], "m") * mpconsts.g.m_as("m s^-2")
+            else:
+                geopotential = magnitude(ml["z"], "m^2 s^-2")
+            outputs["n2"] = None
+    except KeyError as ex:
+        print("Some variables miss for the fused calculation", ex)
+        return ml
 
+    g = mpconsts.g.m_as("m s^-2")
+    earth_radius = mpconsts.Re.m_as("m")
+    kappa = mpconsts.kappa.m_as("")
+    if option.pv:
+        # horizontal grid metrics and map factor corrections as in metpy.calc.vector_derivative
+        dx, dy, parallel_scale, meridional_scale = grid_metrics(ml["lon"].data, ml["lat"].data)
+        dx, dy, parallel_scale, meridional_scale = (
+            expand(x.astype(dtype)) for x in [dx[np.newaxis, :], dy[:, np.newaxis], parallel_scale, meridional_scale])
+        weights_x, weights_y = derivative_weights(dx, -1), derivative_weights(dy, -2)
+        dx_correction = meridional_scale / parallel_scale * derivative(weights_y, parallel_scale, -2)
+        dy_correction = parallel_scale / meridional_scale * derivative(weights_x, meridional_scale, -1)
+        coriolis = expand((2 * mpconsts.omega.m_as("s^-1") *
+                           np.sin(np.deg2rad(ml["lat"].data))).astype(dtype)[:, np.newaxis])
+        pv_factor = -g * units("K m^2 kg^-1 s^-1").m_as(VARIABLES["pv"][1])
+
+    nlev = ml.sizes["lev"]
+    for levels, interior in level_blocks(nlev, LEVEL_BLOCK if low_memory else nlev):
+        index = (slice(None),) * axis + (levels,)
+        if compute_pressure:
+            block_pres = ((hyam[levels] + hybm[levels] * sp) / 100).astype(dtype, copy=False)
+        else:
+            block_pres = pres[index]
+        results = {"pres": block_pres}
+        if "pt" in outputs:
+            theta = results["pt"] = temp[index] / (block_pres / 1000) ** kappa
+        elif option.n2:
+            theta = theta_in[index]
+        if option.pv:
+            u, v = (x[index] for x in wind)
+            pres_weights = derivative_weights(np.diff(block_pres * 100, axis=axis), axis)
+            avor = parallel_scale * derivative(weights_x, v, -1) + u * dx_correction
+            avor -= meridional_scale * derivative(weights_y, u, -2) + v * dy_correction
+            avor += coriolis
+            pv = avor * derivative(pres_weights, theta, axis)
+            del avor
+            pv -= derivative(pres_weights, v, axis) * (parallel_scale * derivative(weights_x, theta, -1))
+            pv += derivative(pres_weights, u, axis) * (meridional_scale * derivative(weights_y, theta, -2))
+            pv *= pv_factor
+            results["pv"] = pv
+        if option.n2:
+            block_geopotential = geopotential[index]
+            height = block_geopotential * earth_radius / (g * earth_radius - block_geopotential)
+            height_weights = derivative_weights(np.diff(height, axis=axis), axis)
+            results["n2"] = g / theta * derivative(height_weights, theta, axis)
+        source = (slice(None),) * axis + (interior,)
+        target = (slice(None),) * axis + (slice(levels.start + interior.start, levels.start + interior.stop),)
+        for name in outputs:
+            if outputs[name] is None:
+                outputs[name] = np.empty(temp.shape, dtype=dtype)
+            outputs[name][target] = results[name][source]
+
+    for name, values in outputs.items():
+        ml[name] = (dims, values)
+        ml[name].attrs["units"] = VARIABLES[name][1]
+        ml[name].attrs["standard_name"] = VARIABLES[name][2]
+    return ml
+
+
+def add_tropopauses(ml, sfc, rows=None):
+    """
+    Adds first and second thermal WMO tropopause to model. Fill value is -999.
+    The columns are searched in bands of rows latitudes, by default all at once.
+    """
+    names = ["TROPOPAUSE", "TROPOPAUSE_SECOND", "TROPOPAUSE_PRESSURE", "TROPOPAUSE_SECOND_PRESSURE",
+             "TROPOPAUSE_THETA", "TROPOPAUSE_SECOND_THETA"]
     try:
-        temp = (ml["t"].data * units(ml["t"].attrs["units"])).to("K").m
-        press = np.log((ml["pres"].data * units(ml["pres"].attrs["units"])
-                        ).to("hPa").m)
-        gph = my_geopotential_to_height(ml["z"]).data.to("km").m
-        theta = (ml["pt"].data * units(ml["pt"].attrs["units"])).to("K").m
+        temp = magnitude(ml["t"], "K")
+        press = magnitude(ml["pres"], "hPa")
+        theta = magnitude(ml["pt"], "K")
+        zh = ml["z"]
     except KeyError as ex:
         print("Some variables are missing for WMO tropopause calculation:", ex)
         return sfc
 
-    if gph[0, 1, 0, 0] < gph[0, 0, 0, 0]:
-        gph = gph[:, ::-1, :, :]
-        press = press[:, ::-1, :, :]
-        temp = temp[:, ::-1, :, :]
-        theta = theta[:, ::-1, :, :]
-
-    valid = np.isfinite(gph[0, :, 0, 0])
-    assert gph[0, valid, 0, 0][1] > gph[0, valid, 0, 0][0]
-    assert press[0, valid, 0, 0][1] < press[0, valid, 0, 0][0]
-
-    above_tropo1 = np.empty((gph.shape[0], gph.shape[2], gph.shape[3]))
-    above_tropo1[:] = np.nan
-    above_tropo2 = above_tropo1.copy()
-    above_tropo1_press = above_tropo1.copy()
-    above_tropo2_press = above_tropo1.copy()
-    above_tropo1_theta = above_tropo1.copy()
-    above_tropo2_theta = above_tropo1.copy()
-    for iti, ilo, ila in tqdm.tqdm(
-            itertools.product(range(gph.shape[0]), range(gph.shape[3]), range(gph.shape[2])),
-            total=gph.shape[0] * gph.shape[3] * gph.shape[2], ascii=True):
-        tropopauses = find_tropopause(gph[iti, :, ila, ilo], temp[iti, :, ila, ilo])
-        tropopauses = [x for x in tropopauses if 5 < x < 22]
-        if len(tropopauses) > 0:
-            above_tropo1[iti, ila, ilo] = min(tropopauses)
-            above_tropo1_press[iti, ila, ilo] = np.interp(
-                above_tropo1[iti, ila, ilo], gph[iti, :, ila, ilo], press[iti, :, ila, ilo])
-            above_tropo1_theta[iti, ila, ilo] = np.interp(
-                above_tropo1[iti, ila, ilo], gph[iti, :, ila, ilo], theta[iti, :, ila, ilo])
-            second = [x for x in tropopauses if x > above_tropo1[iti, ila, ilo]]
-            if len(second) > 0:
-                above_tropo2[iti, ila, ilo] = min(second)
-            above_tropo2_press[iti, ila, ilo] = np.interp(
-                above_tropo2[iti, ila, ilo], gph[iti, :, ila, ilo], press[iti, :, ila, ilo])
-            above_tropo2_theta[iti, ila, ilo] = np.interp(
-                above_tropo2[iti, ila, ilo], gph[iti, :, ila, ilo], theta[iti, :, ila, ilo])
-
-    above_tropo1_press = np.exp(above_tropo1_press)
-    above_tropo2_press = np.exp(above_tropo2_press)
-
-    for name, var in [
-            ("TROPOPAUSE", above_tropo1),
-            ("TROPOPAUSE_SECOND", above_tropo2),
-            ("TROPOPAUSE_PRESSURE", above_tropo1_press * 100),
-            ("TROPOPAUSE_SECOND_PRESSURE", above_tropo2_press * 100),
-            ("TROPOPAUSE_THETA", above_tropo1_theta),
-            ("TROPOPAUSE_SECOND_THETA", above_tropo2_theta)]:
-        sfc[name] = (("time", "lat", "lon"), var.astype(np.float32))
+    nlat = ml.sizes["lat"]
+    rows = rows or nlat
+    results = {name: np.empty((ml.sizes["time"], nlat, ml.sizes["lon"]), dtype=np.float32) for name in names}
+    for start in range(0, nlat, rows):
+        band = slice(start, min(start + rows, nlat))
+        gph = my_geopotential_to_height(zh.isel(lat=band)).data.to("km").m
+        band_press, band_temp, band_theta = (x[:, :, band] for x in (press, temp, theta))
+
+        if gph[0, 1, 0, 0] < gph[0, 0, 0, 0]:
+            gph = gph[:, ::-1, :, :]
+            band_press = band_press[:, ::-1, :, :]
+            band_temp = band_temp[:, ::-1, :, :]
+            band_theta = band_theta[:, ::-1, :, :]
+
+        valid = np.isfinite(gph[0, :, 0, 0])
+        assert gph[0, valid, 0, 0][1] > gph[0, valid, 0, 0][0]
+        assert band_press[0, valid, 0, 0][1] < band_press[0, valid, 0, 0][0]
+
+        above_tropo1, above_tropo2, above_tropo1_press, above_tropo2_press, \
+            above_tropo1_theta, above_tropo2_theta = find_tropopauses(gph, band_temp, band_press, band_theta)
+
+        for name, var in zip(names, [
+                above_tropo1, above_tropo2, above_tropo1_press * 100, above_tropo2_press * 100,
+                above_tropo1_theta, above_tropo2_theta]):
+            results[name][:, band] = var
+
+    for name in names:
+        sfc[name] = (("time", "lat", "lon"), results[name])
         sfc[name].attrs["units"] = VARIABLES[name][1]
         sfc[name].attrs["standard_name"] = VARIABLES[name][2]
         sfc[name].attrs["long_name"] = VARIABLES[name][3]
     return sfc
 
 
+def add_ancillary(ml, sfc, option, verbose=True):
+    """
+    Adds the ancillary quantities selected by option to the model level
+    dataset ml and the surface dataset sfc.
+    """
+    log = print if verbose else (lambda *args: None)
+    # tiles of the parallel and chunked modes are not recorded individually
+    timed = metrics.stage if verbose else (lambda name: contextlib.nullcontext())
+    low_memory = getattr(option, "low_memory", False)
+    fused = getattr(option, "fused", False)
+    if fused and (option.pressure or option.theta or option.pv or option.n2):
+        with timed("ancillary.fused"):
+            log("Adding pressure, potential temperature, PV and N2 in one pass...")
+            ml = add_fused(ml, sfc, option, low_memory)
+    if option.pressure and not fused:
+        with timed("ancillary.pressure"):
+            log("Adding pressure...")
+            try:
+                sp = np.exp(sfc["lnsp"])
+                lev = ml["lev"].data.astype(int) - 1
+                if low_memory:
+                    ml["pres"] = (("time", "lev", "lat", "lon"), pressure_single(ml, sp.data))
+                else:
+                    ml["pres"] = (
+                        ("time", "lev", "lat", "lon"),
+                        (ml["hyam"].data[:][lev][np.newaxis, :, np.newaxis, np.newaxis] +
+                         ml["hybm"].data[:][lev][np.newaxis, :, np.newaxis, np.newaxis] *
+                         sp.data[:][:, np.newaxis, :, :]) / 100)
+            except KeyError as ex:
+                print("Some variables miss for PRES calculation", ex)
+            else:
+                ml["pres"].attrs["units"] = VARIABLES["pres"][1]
+                ml["pres"].attrs["standard_name"] = VARIABLES["pres"][2]
+    if (option.theta or option.pv) and not fused:
+        with timed("ancillary.theta"):
+            log("Adding potential temperature...")
+            try:
+                if low_memory:
+                    ml["pt"] = (ml["t"].dims, potential_temperature_single(ml))
+                else:
+                    ml["pt"] = potential_temperature(ml["pres"], ml["t"])
+                    ml["pt"].data = ml["pt"].data.to(VARIABLES["pt"][1]).m
+            except KeyError as ex:
+                print("Some variables miss for THETA calculation", ex)
+            else:
+                ml["pt"].attrs["units"] = VARIABLES["pt"][1]
+                ml["pt"].attrs["standard_name"] = VARIABLES["pt"][2]
+    if option.pv and not fused:
+        with timed("ancillary.pv"):
+            log("Adding potential vorticity...")
+            try:
+                if low_memory:
+                    ml["pv"] = (ml["t"].dims, potential_vorticity_single(ml))
+                else:
+                    ml = ml.metpy.assign_crs(grid_mapping_name='latitude_longitude',
+                                             earth_radius=6.356766e6)
+                    ml["pv"] = potential_vorticity_baroclinic(
+                        ml["pt"], ml["pres"], ml["u"], ml["v"])
+                    ml["pv"].data = ml["pv"].data.to(VARIABLES["pv"][1]).m
+            except KeyError as ex:
+                print("Some variables miss for PV calculation", ex)
+            else:
+                ml["pv"].attrs["units"] = VARIABLES["pv"][1]
+                ml["pv"].attrs["standard_name"] = VARIABLES["pv"][2]
+            finally:
+                if "metpy_crs" in ml.variables:
+                    ml = ml.drop_vars("metpy_crs")
+    if option.n2 and not fused:
+        with timed("ancillary.n2"):
+            log("Adding N2...")
+            try:
+                if low_memory:
+                    ml["n2"] = (ml["t"].dims, brunt_vaisala_frequency_squared_single(ml))
+                else:
+                    ml["n2"] = brunt_vaisala_frequency_squared(
+                        my_geopotential_to_height(ml["z"]), ml["pt"])
+                    ml["n2"].data = ml["n2"].data.to(VARIABLES["n2"][1]).m
+            except KeyError as ex:
+                print("Some variables miss for N2 calculation", ex)
+            else:
+                ml["n2"].attrs["units"] = VARIABLES["n2"][1]
+                ml["n2"].attrs["standard_name"] = VARIABLES["n2"][2]
+    if option.tropopause:
+        with timed("ancillary.tropopause"):
+            log("Adding first and second tropopause")
+            sfc = add_tropopauses(ml, sfc, LATITUDE_BLOCK if low_memory else None)
+
+    return ml, sfc
+
+
+def _add_ancillary_tile(ml, sfc, option, interior):
+    """
+    Computes ancillary quantities for one tile and returns only the
+    ancillary variables with the halo removed.
+    """
+    ml, sfc = add_ancillary(ml, sfc, option, verbose=False)
+    return (ml[[x for x in ml.data_vars if x in VARIABLES]].isel(lat=interior),
+            sfc[[x for x in sfc.data_vars if x in VARIABLES]].isel(lat=interior))
+
+
+def add_ancillary_parallel(ml, sfc, option, processes):
+    """
+    Same as add_ancillary, but splits the domain into tiles of single time
+    steps and latitude bands, which are processed by a pool of processes.
+    Tiles carry a halo of one grid point so that the horizontal derivatives
+    required for PV are identical to the serial computation.
+    """
+    halo = 1
+    ntime, nlat = ml.sizes["time"], ml.sizes["lat"]
+    # metpy requires at least three points for its finite differences
+    nbands = max(1, min(-(-processes // ntime), nlat // 3))
+    bounds = np.linspace(0, nlat, nbands + 1).astype(int)
+    print(f"Adding ancillary quantities using {ntime * nbands} tiles on {processes} processes...")
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        futures = []
+        for iti in range(ntime):
+            for start, stop in zip(bounds[:-1], bounds[1:]):
+                lower, upper = max(start - halo, 0), min(stop + halo, nlat)
+                sel = {"time": slice(iti, iti + 1), "lat": slice(lower, upper)}
+                futures.append(pool.submit(
+                    _add_ancillary_tile, ml.isel(sel), sfc.isel(sel, missing_dims="ignore"),
+                    option, slice(start - lower, stop - lower)))
+        tiles = [future.result() for future in futures]
+
+    for idx, xin in enumerate([ml, sfc]):
+        parts = [tile[idx] for tile in tiles]
+        if len(parts[0].data_vars) == 0:
+            continue
+        rows = [xr.concat(parts[iti * nbands:(iti + 1) * nbands], dim="lat")
+                for iti in range(ntime)]
+        result = xr.concat(rows, dim="time")
+        for var in result.data_vars:
+            xin[var] = result[var]
+    return ml, sfc
+
+
+def memory_tiles(ml, max_memory, halo=1):
+    """
+    Splits the domain into tiles of single time steps and latitude bands,
+    whose estimated memory requirement stays below max_memory (MiB).
+    Returns tuples of time slice, latitude slice including the halo and
+    the interior of the tile relative to the latter.
+    """
+    ntime, nlat = ml.sizes["time"], ml.sizes["lat"]
+    row_bytes = MEMORY_FACTOR * sum(
+        var.nbytes for var in ml.data_vars.values() if "lat" in var.dims) / (ntime * nlat)
+    rows = max(1, int(max_memory * 2 ** 20 // row_bytes) - 2 * halo)
+    # metpy requires at least three points for its finite differences
+    nbands = max(1, min(-(-nlat // rows), nlat // 3))
+    bounds = np.linspace(0, nlat, nbands + 1).astype(int)
+    tiles = []
+    for iti in range(ntime):
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            lower, upper = max(start - halo, 0), min(stop + halo, nlat)
+            tiles.append((slice(iti, iti + 1), slice(lower, upper), slice(start - lower, stop - lower)))
+    return tiles
+
+
+def write_tile(ncfile, var, index):
+    """
+    Writes the DataArray var into the region index of the open NetCDF file,
+    creating the variable if required.
+    """
+    if var.name not in ncfile.variables:
+        options = nc_encoding.create_options(
+            ncfile.filepath(), var.name, var.dims, [len(ncfile.dimensions[dim]) for dim in var.dims])
+        ncfile.createVariable(var.name, options.pop("datatype", var.dtype), var.dims, fill_value=np.nan, **options)
+    ncfile[var.name].setncatts(var.attrs)
+    ncfile[var.name][tuple(index.get(dim, slice(None)) for dim in var.dims)] = var.values
+
+
+def add_ancillary_chunked(sfc_filename, ml_filename, option, max_memory):
+    """
+    Same as add_ancillary, but reads and computes the files tile by tile
+    with bounded memory and writes the results of each tile directly into
+    the files. Tiles carry a halo of one grid point, so results are
+    identical to the in-memory computation.
+    """
+    with netCDF4.Dataset(ml_filename, "a") as ml_nc, \
+            netCDF4.Dataset(sfc_filename, "a") as sfc_nc:
+        ml = xr.open_dataset(xr.backends.NetCDF4DataStore(ml_nc))
+        sfc = xr.open_dataset(xr.backends.NetCDF4DataStore(sfc_nc))
+        tiles = memory_tiles(ml, max_memory)
+        print(f"Adding ancillary quantities in {len(tiles)} tiles...")
+        for time, lat, interior in tiles:
+            sel = {"time": time, "lat": lat}
+            results = _add_ancillary_tile(
+                ml.isel(sel).load(), sfc.isel(sel, missing_dims="ignore").load(), option, interior)
+            index = {"time": time, "lat": slice(lat.start + interior.start, lat.start + interior.stop)}
+            for ncfile, result in zip([ml_nc, sfc_nc], results):
+                for var in result.data_vars:
+                    write_tile(ncfile, result[var], index)
+        for ncfile in [ml_nc, sfc_nc]:
+            ncfile.setncatts(history_attributes(ncfile.__dict__))
+
+
+def history_attributes(attrs):
+    now = datetime.datetime.now().isoformat()
+    history = now + ":" + " ".join(sys.argv)
+    if "history" in attrs:
+        history += "\n" + attrs["history"]
+    return {"history": history, "date_modified": now}
+
+
 def main():
     option, sfc_filename, ml_filename = parse_args(sys.argv[1:])
 
+    if option.max_memory > 0:
+        add_ancillary_chunked(sfc_filename, ml_filename, option, option.max_memory)
+        return
+
     sfc = xr.load_dataset(sfc_filename)
     ml = xr.load_dataset(ml_filename)
 
-    if option.pressure:
-        print("Adding pressure...")
-        try:
-            sp = np.exp(sfc["lnsp"])
-            lev = ml["lev"].data.astype(int) - 1
-            ml["pres"] = (
-                ("time", "lev", "lat", "lon"),
-                (ml["hyam"].data[:][lev][np.newaxis, :, np.newaxis, np.newaxis] +
-                 ml["hybm"].data[:][lev][np.newaxis, :, np.newaxis, np.newaxis] *
-                 sp.data[:][:, np.newaxis, :, :]) / 100)
-        except KeyError as ex:
-            print("Some variables miss for PRES calculation", ex)
-        else:
-            ml["pres"].attrs["units"] = VARIABLES["pres"][1]
-            ml["pres"].attrs["standard_name"] = VARIABLES["pres"][2]
-    if option.theta or option.pv:
-        print("Adding potential temperature...")
-        try:
-            ml["pt"] = potential_temperature(ml["pres"], ml["t"])
-        except KeyError as ex:
-            print("Some variables miss for THETA calculation", ex)
-        else:
-            ml["pt"].data = ml["pt"].data.to(VARIABLES["pt"][1]).m
-            ml["pt"].attrs["units"] = VARIABLES["pt"][1]
-            ml["pt"].attrs["standard_name"] = VARIABLES["pt"][2]
-    if option.pv:
-        print("Adding potential vorticity...")
-        try:
-            ml = ml.metpy.assign_crs(grid_mapping_name='latitude_longitude',
-                                     earth_radius=6.356766e6)
-            ml["pv"] = potential_vorticity_baroclinic(
-                ml["pt"], ml["pres"], ml["u"], ml["v"])
-        except KeyError as ex:
-            print("Some variables miss for PV calculation", ex)
-        else:
-            ml["pv"].data = ml["pv"].data.to(VARIABLES["pv"][1]).m
-            ml["pv"].attrs["units"] = VARIABLES["pv"][1]
-            ml["pv"].attrs["standard_name"] = VARIABLES["pv"][2]
-        finally:
-            ml = ml.drop_vars("metpy_crs")
-    if option.n2:
-        print("Adding N2...")
-        try:
-            ml["n2"] = brunt_vaisala_frequency_squared(
-                my_geopotential_to_height(ml["z"]), ml["pt"])
-        except KeyError as ex:
-            print("Some variables miss for N2 calculation", ex)
-        else:
-            ml["n2"].data = ml["n2"].data.to(VARIABLES["n2"][1]).m
-            ml["n2"].attrs["units"] = VARIABLES["n2"][1]
-            ml["n2"].attrs["standard_name"] = VARIABLES["n2"][2]
-    if option.tropopause:
-        print("Adding first and second tropopause")
-        sfc = add_tropopauses(ml, sfc)
+    if option.processes > 1:
+        ml, sfc = add_ancillary_parallel(ml, sfc, option, option.processes)
+    else:
+        ml, sfc = add_ancillary(ml, sfc, option)
 
     for xin in [ml, sfc]:
-        now = datetime.datetime.now().isoformat()
-        history = now + ":" + " ".join(sys.argv)
-        if "history" in xin.attrs:
-            history += "\n" + xin.attrs["history"]
-        xin.attrs["history"] = history
-        xin.attrs["date_modified"] = now
-
-    sfc.to_netcdf(sfc_filename, format="NETCDF4_CLASSIC")
-    # no compression, yet, as ml is still converted by ncks
-    ml.to_netcdf(ml_filename, format="NETCDF4_CLASSIC")
+        xin.attrs.update(history_attributes(xin.attrs))
+
+    sfc.to_netcdf(sfc_filename, format="NETCDF4_CLASSIC", encoding=nc_encoding.encoding(sfc, sfc_filename))
+    ml.to_netcdf(ml_filename, format="NETCDF4_CLASSIC", encoding=nc_encoding.encoding(ml, ml_filename))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,106 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+
+Writes the time steps of a newly converted dataset into an existing
+product, so that the products of a forecast run grow with every converted
+step instead of being converted again as a whole.
+
+Steps already contained in the product are overwritten in place, new
+steps are inserted in time order. Only the steps after the first inserted
+one are rewritten, which is nothing in the usual case of appending later
+steps. The time dimension of the product must be unlimited. Writers of a
+product are serialized by a lock file, so that steps may be converted in
+parallel. Values of int16 packed variables are limited to the range of
+the steps the product was created with.
+"""
+import contextlib
+import datetime
+import fcntl
+import os
+import sys
+
+import netCDF4
+import numpy as np
+
+
+@contextlib.contextmanager
+def locked(path):
+    """
+    Holds an exclusive lock on path + ".lock" within the context.
+    """
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def clip_packed(var, values):
+    """
+    Limits values to the range representable by the packed integer variable var.
+    """
+    if "scale_factor" not in var.ncattrs() or var.dtype.kind != "i":
+        return values
+    limit = np.iinfo(var.dtype).max * var.scale_factor
+    offset = getattr(var, "add_offset", 0.)
+    return np.clip(values, offset - limit, offset + limit)
+
+
+def append(ds, filename):
+    """
+    Writes all variables with time dimension of ds into the product filename.
+    Returns the indices of the steps of ds in the product. The caller must
+    hold the lock of filename.
+    """
+    with netCDF4.Dataset(filename, "a") as ncfile:
+        time = ncfile["time"]
+        calendar = getattr(time, "calendar", "standard")
+        old = np.asarray(time[:], dtype=np.float64)
+        new = np.asarray(netCDF4.date2num(
+            ds["time"].values.astype("datetime64[us]").tolist(), time.units, calendar), dtype=np.float64)
+        merged = np.union1d(old, new)
+        # the leading steps not moved by inserting new steps
+        first = 0
+        while first < len(old) and old[first] == merged[first]:
+            first += 1
+        positions = np.searchsorted(merged, new)
+
+        names = [name for name in ds.variables
+                 if name != "time" and name in ncfile.variables and "time" in ds[name].dims]
+        for name in names:
+            var = ncfile[name]
+            if var.dimensions[0] != "time" or ds[name].transpose("time", ...).shape[1:] != var.shape[1:]:
+                raise ValueError(f"{name} of {filename} does not match the new steps")
+
+        for name in names:
+            var = ncfile[name]
+            values = ds[name].transpose("time", ...).values
+            # steps moved to make room for the inserted ones
+            tail = var[first:len(old)]
+            moved = np.searchsorted(merged, old[first:])
+            keep = ~np.isin(old[first:], new)
+            for position, data in zip(moved[keep], tail[keep]):
+                var[position] = data
+            for position, data in zip(positions, values):
+                var[position] = clip_packed(var, data)
+        time[first:] = merged[first:]
+
+        now = datetime.datetime.now().isoformat()
+        history = now + ":" + " ".join(sys.argv)
+        if "history" in ncfile.ncattrs():
+            history += "\n" + ncfile.history
+        ncfile.setncatts({"history": history, "date_modified": now})
+    return positions
+
+
+def write(ds, filename, encoding):
+    """
+    Writes the steps of ds into the product filename or creates it with an
+    unlimited time dimension using the to_netcdf encoding.
+    """
+    with locked(filename):
+        if os.path.exists(filename):
+            print("Appending to", filename)
+            append(ds, filename)
+        else:
+            print("Writing", filename)
+            ds.to_netcdf(filename, format="NETCDF4_CLASSIC", encoding=encoding, unlimited_dims=["time"])
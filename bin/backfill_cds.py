@@ -0,0 +1,156 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+
+Retrieves and converts a range of analysis times with get_cds.sh.
+
+The downloads of upcoming times run while earlier times are converted
+by a bounded pool of workers. Completed times are recorded by a marker
+file in the state directory and skipped when the backfill is restarted,
+partially downloaded times are resumed by download_cds.py.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time as timer
+
+
+def analysis_times(first, last, interval):
+    """
+    Returns all times from first to last (inclusive) spaced by interval hours.
+    """
+    result = []
+    while first <= last:
+        result.append(first)
+        first += datetime.timedelta(hours=interval)
+    return result
+
+
+class Backfill:
+    """
+    Runs the download and convert stages of command for a list of times.
+    The stage is passed to command in BACKFILL_STAGE, which the settings
+    files never assign.
+    At most downloads downloads and conversions conversions run at the
+    same time and at most prefetch times are downloaded ahead of their
+    conversion. The output of every stage is written to a log file in
+    state_dir.
+    """
+
+    def __init__(self, command, state_dir, downloads=1, conversions=1, prefetch=2):
+        self.command = command
+        self.state_dir = state_dir
+        self.downloads = downloads
+        self.conversions = conversions
+        self.prefetch = threading.Semaphore(max(prefetch, 1))
+        self.status = {}
+        os.makedirs(state_dir, exist_ok=True)
+
+    def base(self, time):
+        return time.strftime("%Y-%m-%dT%H:%M:%S") + ".an"
+
+    def marker(self, time):
+        return os.path.join(self.state_dir, self.base(time) + ".done")
+
+    def stage(self, time, name, flags):
+        """
+        Runs one stage of command for time and records its state and duration.
+        """
+        start = timer.time()
+        env = dict(os.environ, **flags)
+        with open(os.path.join(self.state_dir, f"{self.base(time)}.{name}.log"), "w") as log:
+            result = subprocess.run(
+                self.command + [time.strftime("%Y-%m-%d"), time.strftime("%H:%M:%S")],
+                env=env, stdout=log, stderr=subprocess.STDOUT)
+        self.status[time][name] = timer.time() - start
+        if result.returncode != 0:
+            self.status[time]["state"] = f"{name} failed"
+        return result.returncode == 0
+
+    def download(self, time):
+        self.status[time]["state"] = "downloading"
+        return self.stage(time, "download", {"BACKFILL_STAGE": "download"})
+
+    def convert(self, time):
+        try:
+            self.status[time]["state"] = "converting"
+            if self.stage(time, "convert", {"BACKFILL_STAGE": "convert"}):
+                open(self.marker(time), "w").close()
+                self.status[time]["state"] = "done"
+        finally:
+            self.prefetch.release()
+
+    def run(self, times):
+        """
+        Processes all times not yet completed and returns the status
+        dictionary.
+        """
+        conversions = []
+        with ThreadPoolExecutor(self.conversions) as convert_pool:
+            with ThreadPoolExecutor(self.downloads) as download_pool:
+
+                def downloaded(future, time):
+                    if future.exception() is None and future.result():
+                        conversions.append(convert_pool.submit(self.convert, time))
+                    else:
+                        if future.exception() is not None:
+                            self.status[time]["state"] = "download failed"
+                        self.prefetch.release()
+
+                for time in times:
+                    if os.path.exists(self.marker(time)):
+                        self.status[time] = {"state": "skipped"}
+                        continue
+                    self.status[time] = {"state": "waiting"}
+                    self.prefetch.acquire()
+                    future = download_pool.submit(self.download, time)
+                    future.add_done_callback(lambda future, time=time: downloaded(future, time))
+        for future in conversions:
+            future.result()
+        return self.status
+
+    def summary(self):
+        lines = [f"{'time':20s} {'state':16s} {'download':>9s} {'convert':>9s}"]
+        for time, status in sorted(self.status.items()):
+            durations = [f"{status[x]:8.1f}s" if x in status else f"{'-':>9s}" for x in ["download", "convert"]]
+            lines.append(f"{time.strftime('%Y-%m-%dT%H:%M:%S'):20s} {status['state']:16s} {' '.join(durations)}")
+        return "\n".join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("first", type=datetime.datetime.fromisoformat, help="first time, e.g. 2021-01-29T00:00:00")
+    parser.add_argument("last", type=datetime.datetime.fromisoformat, help="last time, e.g. 2021-02-05T18:00:00")
+    parser.add_argument("-i", "--interval", type=int, default=6, help="hours between times (default: 6)")
+    parser.add_argument("-d", "--downloads", type=int, default=1, help="number of concurrent downloads (default: 1)")
+    parser.add_argument("-c", "--conversions", type=int, default=1,
+                        help="number of concurrent conversions (default: 1)")
+    parser.add_argument("-p", "--prefetch", type=int, default=None,
+                        help="maximum number of times downloaded ahead of conversion (default: 2 * conversions)")
+    parser.add_argument("-s", "--state-dir", default="backfill",
+                        help="directory for log files and completion markers (default: backfill)")
+    parser.add_argument("--command", default="bash " + os.path.join(os.path.dirname(os.path.abspath(__file__)), "get_cds.sh"),
+                        help="command processing a single date and time (default: get_cds.sh)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    backfill = Backfill(
+        shlex.split(args.command), args.state_dir, downloads=args.downloads, conversions=args.conversions,
+        prefetch=args.prefetch if args.prefetch is not None else 2 * args.conversions)
+    try:
+        status = backfill.run(analysis_times(args.first, args.last, args.interval))
+    finally:
+        print(backfill.summary())
+    if any(x["state"] not in ("done", "skipped") for x in status.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
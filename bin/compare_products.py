@@ -0,0 +1,202 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+
+Compares converted products against reference files and checks the
+resources used by the conversion against budgets.
+
+Every variable of every reference product (ml, pl, tl, al, pv, sfc) must
+exist in the output with equal units, standard_name and shape and its
+values must agree within the tolerance configured for it. The maximum and
+RMS deviation of every variable is reported.
+
+The configuration is a JSON file of the form
+
+    {"tolerances": {"*": {"atol": 0, "rtol": 1e-6, "scaled_atol": 1e-4},
+                    "*.pv": {"scaled_atol": 0.05}},
+     "budgets": {"interpolate_model": {"wall_seconds": 60, "max_rss_bytes": 2e9}}}
+
+Tolerances are selected by matching "<product>.<variable>" against the
+patterns, later patterns overriding earlier ones. A value passes if
+|out - ref| <= atol + scaled_atol * max|ref| + rtol * |ref|; an optional
+"rms" gives a limit for the RMS deviation. Budgets limit the summed
+wall_seconds, cpu_seconds, read_bytes and write_bytes and the peak
+max_rss_bytes of stages recorded in a metrics file (see metrics.py).
+"""
+import argparse
+import fnmatch
+import glob
+import json
+import os
+import sys
+
+import numpy as np
+import xarray as xr
+
+import metrics
+
+PRODUCTS = ["ml", "pl", "tl", "al", "pv", "sfc"]
+
+DEFAULT_TOLERANCE = {"atol": 0., "rtol": 0., "scaled_atol": 0., "rms": None}
+
+
+def load_config(filename):
+    if filename is None:
+        return {"tolerances": {}, "budgets": {}}
+    with open(filename) as fin:
+        config = json.load(fin)
+    config.setdefault("tolerances", {})
+    config.setdefault("budgets", {})
+    return config
+
+
+def tolerance(tolerances, product, variable):
+    """
+    Returns the tolerance for variable of product, combining all matching
+    patterns in the order given.
+    """
+    result = dict(DEFAULT_TOLERANCE)
+    for pattern, values in tolerances.items():
+        if fnmatch.fnmatchcase(f"{product}.{variable}", pattern):
+            result.update(values)
+    return result
+
+
+def compare_variable(ref, out, tol):
+    """
+    Compares two arrays and returns the deviations and a list of failures.
+    """
+    result = {"max_abs": 0., "rms": 0., "max_rel": 0., "failures": []}
+    if ref.shape != out.shape:
+        result["failures"].append(f"shape {out.shape} differs from {ref.shape}")
+        return result
+    if not np.issubdtype(ref.dtype, np.number):
+        if not np.array_equal(ref, out):
+            result["failures"].append("values differ")
+        return result
+    ref, out = np.asarray(ref, dtype=np.float64), np.asarray(out, dtype=np.float64)
+    nans = np.isnan(ref) != np.isnan(out)
+    if nans.any():
+        result["failures"].append(f"{nans.sum()} NaN mismatches")
+    valid = ~(np.isnan(ref) | np.isnan(out))
+    if not valid.any():
+        return result
+    ref, out = ref[valid], out[valid]
+    deviation = np.abs(out - ref)
+    scale = np.abs(ref).max()
+    result["max_abs"] = deviation.max()
+    result["rms"] = np.sqrt((deviation ** 2).mean())
+    result["max_rel"] = result["max_abs"] / scale if scale > 0 else result["max_abs"]
+    limit = tol["atol"] + tol["scaled_atol"] * scale + tol["rtol"] * np.abs(ref)
+    exceeded = deviation > limit
+    if exceeded.any():
+        result["failures"].append(f"{exceeded.sum()} values exceed tolerance, max deviation {result['max_abs']:.3g}")
+    if tol["rms"] is not None and result["rms"] > tol["rms"]:
+        result["failures"].append(f"RMS deviation {result['rms']:.3g} exceeds {tol['rms']:.3g}")
+    return result
+
+
+def compare_file(ref_fn, out_fn, product, tolerances):
+    """
+    Compares all variables of the reference file. Returns a dictionary
+    mapping variable names to the result of compare_variable.
+    """
+    results = {}
+    with xr.load_dataset(ref_fn) as ref, xr.load_dataset(out_fn) as out:
+        for var in ref.variables:
+            if var not in out.variables:
+                results[var] = {"max_abs": 0., "rms": 0., "max_rel": 0., "failures": ["missing"]}
+                continue
+            result = compare_variable(ref[var].values, out[var].values, tolerance(tolerances, product, var))
+            for att in ["units", "standard_name"]:
+                if att in ref[var].attrs and ref[var].attrs[att] != out[var].attrs.get(att):
+                    result["failures"].append(f"{att} {out[var].attrs.get(att)} differs from {ref[var].attrs[att]}")
+            results[var] = result
+    return results
+
+
+def compare_products(ref_dir, out_dir, tolerances):
+    """
+    Compares all products in ref_dir with the equally named files in
+    out_dir. Returns a dictionary mapping file names to the variable
+    results; a missing output file has the result None.
+    """
+    results = {}
+    for ref_fn in sorted(glob.glob(os.path.join(ref_dir, "*.nc"))):
+        name = os.path.basename(ref_fn)
+        product = name.split(".")[-2]
+        if product not in PRODUCTS:
+            continue
+        out_fn = os.path.join(out_dir, name)
+        results[name] = compare_file(ref_fn, out_fn, product, tolerances) if os.path.exists(out_fn) else None
+    return results
+
+
+def check_budgets(records, budgets):
+    """
+    Checks the aggregated metrics records against the budgets. Returns a
+    list of failures. Stages without records are not checked.
+    """
+    totals = {}
+    for (_, stage), total in metrics.aggregate(records).items():
+        if stage not in totals:
+            totals[stage] = dict(total)
+        else:
+            for name in ["wall_seconds", "cpu_seconds", "read_bytes", "write_bytes"]:
+                totals[stage][name] += total[name]
+            totals[stage]["max_rss_bytes"] = max(totals[stage]["max_rss_bytes"], total["max_rss_bytes"])
+    failures = []
+    for stage, limits in budgets.items():
+        for name, limit in limits.items():
+            if stage in totals and totals[stage][name] > limit:
+                failures.append(f"{stage}: {name} {totals[stage][name]:.6g} exceeds budget {limit:.6g}")
+    return failures
+
+
+def report(results):
+    """
+    Returns a table of the comparison results and the number of failures.
+    """
+    lines = [f"{'product':36s} {'variable':28s} {'max abs':>10s} {'rms':>10s} {'max rel':>10s}  status"]
+    failures = 0
+    for name, variables in results.items():
+        if variables is None:
+            lines.append(f"{name:36s} {'-':28s} {'':>10s} {'':>10s} {'':>10s}  missing")
+            failures += 1
+            continue
+        for var, result in variables.items():
+            status = "; ".join(result["failures"]) or "ok"
+            failures += len(result["failures"]) > 0
+            lines.append(f"{name:36s} {var:28s} {result['max_abs']:10.3g} {result['rms']:10.3g} "
+                         f"{result['max_rel']:10.3g}  {status}")
+    return "\n".join(lines), failures
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("reference", help="directory of the reference products")
+    parser.add_argument("output", help="directory of the products to check")
+    parser.add_argument("-c", "--config", help="JSON file with tolerances and budgets")
+    parser.add_argument("-m", "--metrics", help="metrics file of the conversion to check against the budgets")
+    parser.add_argument("--base", help="only check metrics records of this base name")
+    parser.add_argument("--since", type=float, help="only check metrics records started after this epoch time")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = load_config(args.config)
+    table, failures = report(compare_products(args.reference, args.output, config["tolerances"]))
+    print(table)
+    if args.metrics:
+        budget_failures = check_budgets(metrics.read_records(args.metrics, args.base, args.since), config["budgets"])
+        for failure in budget_failures:
+            print(failure)
+        failures += len(budget_failures)
+    if failures > 0:
+        print(f"{failures} checks failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
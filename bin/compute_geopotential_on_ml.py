@@ -38,11 +38,18 @@ Parameters    : tq.grib                - grib file with all the levelist
                                          to store in the output
                 -o output   (optional) - name of the output file
                                          (default='z_out.grib')
+                -v          (optional) - decode all levels of a step at once
+                                         and integrate the column in one go
+                -j jobs     (optional) - number of steps to compute
+                                         concurrently in vectorized mode
+                -n ml.nc    (optional) - add z to this NetCDF file
+                                         instead of writing GRIB
 
 Return Value  : output (default='z_out.grib')
                 A fieldset of geopotential on model levels
+                or variable z added to the given NetCDF file
 
-Dependencies  : None
+Dependencies  : eccodes, numpy, netCDF4, grib_index.py
 
 Example Usage :
                 compute_geopotential_on_ml.py tq.grib zlnsp.grib
@@ -50,16 +57,24 @@ Example Usage :
 from __future__ import print_function
 import sys
 import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+import netCDF4
 import numpy as np
-from eccodes import (codes_index_new_from_file, codes_index_get, codes_get,
-                     codes_index_select, codes_new_from_index, codes_set,
-                     codes_index_add_file, codes_get_array, codes_get_values,
-                     codes_index_release, codes_release, codes_set_values,
-                     codes_write)
+from eccodes import (codes_get, codes_set, codes_get_array,
+                     codes_get_values, codes_release, codes_set_values,
+                     codes_write, codes_new_from_message)
+
+import grib_index
 
 R_D = 287.06
 R_G = 9.80665
 
+Z_DIMENSIONS = ('time', 'lev', 'lat', 'lon')
+Z_ATTRIBUTES = {'standard_name': 'geopotential_height',
+                'long_name': 'Geopotential',
+                'units': 'm**2 s**-2'}
+
 
 def parse_args():
     ''' Parse program arguments using ArgumentParser'''
@@ -69,6 +84,15 @@ def parse_args():
                         default='all')
     parser.add_argument('-o', '--output', help='name of the output file',
                         default='z_out.grib')
+    parser.add_argument('-n', '--netcdf',
+                        help=('write z directly into this existing NetCDF '
+                              'file instead of a GRIB file (implies -v)'))
+    parser.add_argument('-v', '--vectorized', action='store_true',
+                        help=('decode all levels of a step at once and '
+                              'integrate the whole column in one go'))
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help=('number of steps computed concurrently '
+                              '(vectorized mode only)'))
     parser.add_argument('t_q', metavar='tq.grib', type=str,
                         help=('grib file with temperature(t) and humidity(q)'
                               'for the model levels'))
@@ -101,22 +125,24 @@ def main():
     print('Arguments: %s' % ", ".join(
         ['%s: %s' % (k, v) for k, v in vars(args).items()]))
 
-    fout = open(args.output, 'wb')
-    index_keys = ['date', 'time', 'shortName', 'level', 'step']
+    if args.vectorized or args.netcdf:
+        main_vectorized(args)
+        return
 
-    idx = codes_index_new_from_file(args.z_lnsp, index_keys)
-    codes_index_add_file(idx, args.t_q)
+    fout = open(args.output, 'wb')
+    filenames = [args.z_lnsp, args.t_q]
     if 'u_v' in args:
-        codes_index_add_file(idx, args.u_v)
+        filenames.append(args.u_v)
+    idx = MessageIndex(filenames)
     values = None
     # iterate date
-    for date in codes_index_get(idx, 'date'):
-        codes_index_select(idx, 'date', date)
+    for date in idx.get('date'):
+        idx.select('date', date)
         # iterate time
-        for time in codes_index_get(idx, 'time'):
-            codes_index_select(idx, 'time', time)
-            for step in codes_index_get(idx, 'step'):
-                codes_index_select(idx, 'step', step)
+        for time in idx.get('time'):
+            idx.select('time', time)
+            for step in idx.get('step'):
+                idx.select('step', step)
                 if not values:
                     values = get_initial_values(idx, keep_sample=True)
                 if 'height' in args:
@@ -137,15 +163,52 @@ def main():
         except KeyError:
             pass
 
-    codes_index_release(idx)
+    idx.release()
     fout.close()
 
 
+class MessageIndex(object):
+    '''Selection of messages from the persistent index of the given files
+    with the semantics of an eccodes index on date, time, step, shortName
+    and level'''
+
+    def __init__(self, filenames):
+        self.index = grib_index.GribIndex(filenames)
+        self.entries = {}
+        for entry in self.index.messages:
+            key = tuple(entry[x] for x in ['date', 'time', 'step',
+                                           'shortName', 'level'])
+            # like eccodes, the first message of a key wins
+            self.entries.setdefault(key, entry)
+        self.selected = {}
+
+    def get(self, key, ktype=str):
+        '''Return the distinct values of key sorted as strings like
+        codes_index_get, so that steps are written in the same order'''
+        values = sorted(set(entry[key] for entry in self.index.messages))
+        return [ktype(value) for value in values]
+
+    def select(self, key, value):
+        self.selected[key] = str(value)
+
+    def new_handle(self):
+        '''Return a handle of the selected message or None'''
+        entry = self.entries.get(tuple(
+            self.selected.get(x) for x in ['date', 'time', 'step',
+                                           'shortName', 'level']))
+        if entry is None:
+            return None
+        return codes_new_from_message(self.index.read(entry))
+
+    def release(self):
+        self.index.close()
+
+
 def get_initial_values(idx, keep_sample=False):
     '''Get the values of surface z, pv and number of levels '''
-    codes_index_select(idx, 'level', 1)
-    codes_index_select(idx, 'shortName', 'z')
-    gid = codes_new_from_index(idx)
+    idx.select('level', 1)
+    idx.select('shortName', 'z')
+    gid = idx.new_handle()
 
     values = {}
     # surface geopotential
@@ -163,7 +226,7 @@ def get_initial_values(idx, keep_sample=False):
 def check_max_level(idx, values):
     '''Make sure we have all the levels required'''
     # how many levels are we computing?
-    max_level = max(codes_index_get(idx, 'level', int))
+    max_level = max(idx.get('level', int))
     if max_level != values['nlevels']:
         print('%s [WARN] total levels should be: %d but it is %d' %
               (sys.argv[0], values['nlevels'], max_level),
@@ -173,9 +236,9 @@ def check_max_level(idx, values):
 
 def get_surface_pressure(idx):
     '''Get the surface pressure for date-time-step'''
-    codes_index_select(idx, 'level', 1)
-    codes_index_select(idx, 'shortName', 'lnsp')
-    gid = codes_new_from_index(idx)
+    idx.select('level', 1)
+    idx.select('shortName', 'lnsp')
+    gid = idx.new_handle()
     if gid is None:
         raise WrongStepError()
     if codes_get(gid, 'gridType', str) == 'sh':
@@ -202,15 +265,15 @@ def compute_z_level(idx, lev, values, z_h):
     # select the levelist and retrieve the vaules of t and q
     # t_level: values for t
     # q_level: values for q
-    codes_index_select(idx, 'level', lev)
-    codes_index_select(idx, 'shortName', 't')
-    gid = codes_new_from_index(idx)
+    idx.select('level', lev)
+    idx.select('shortName', 't')
+    gid = idx.new_handle()
     if gid is None:
         raise MissingLevelError('T at level {} missing from input'.format(lev))
     t_level = codes_get_values(gid)
     codes_release(gid)
-    codes_index_select(idx, 'shortName', 'q')
-    gid = codes_new_from_index(idx)
+    idx.select('shortName', 'q')
+    gid = idx.new_handle()
     if gid is None:
         raise MissingLevelError('Q at level {} missing from input'.format(lev))
     q_level = codes_get_values(gid)
@@ -267,6 +330,240 @@ def production_step(idx, step, values, fout):
                   file=sys.stderr)
 
 
+def main_vectorized(args):
+    '''Main function of the vectorized mode'''
+    with ProcessPoolExecutor(args.jobs) as pool:
+        sample, steps = compute_steps(args.t_q, args.z_lnsp, args.levelist,
+                                      pool)
+        if args.netcdf:
+            write_netcdf(args.netcdf, sample, steps)
+        else:
+            with open(args.output, 'wb') as fout:
+                write_grib(fout, sample, steps)
+
+
+def add_geopotential(dataset, t_q, z_lnsp, levelist=range(1, 138), jobs=1):
+    '''Add geopotential on model levels as variable z to an xarray Dataset
+    with time, lev, lat and lon coordinates'''
+    with ProcessPoolExecutor(jobs) as pool:
+        sample, steps = compute_steps(t_q, z_lnsp, levelist, pool)
+        z_ml = np.full([dataset.sizes[x] for x in Z_DIMENSIONS], np.nan,
+                       dtype=np.float32)
+        write_fields(z_ml, sample, steps, dataset['time'].values,
+                     dataset['lev'].values, dataset['lat'].values,
+                     dataset['lon'].values)
+    dataset['z'] = (Z_DIMENSIONS, z_ml, dict(Z_ATTRIBUTES))
+    return dataset
+
+
+def compute_steps(t_q, z_lnsp, levelist, pool):
+    '''Compute z for all steps of the given files using pool. Returns the
+    encoded z sample message and an iterator over the date/time/step
+    key, the computed levels and z on these levels for each step'''
+    filenames = [z_lnsp, t_q]
+    values = None
+    todo = []
+    with grib_index.GribIndex(filenames) as idx:
+        fields, max_level = read_fields(idx)
+        # same order of steps as the level-by-level mode
+        for key in sorted(fields):
+            if values is None and 1 in fields[key]['z']:
+                values = get_initial_values_from_message(
+                    idx.read(fields[key]['z'][1]), max_level)
+            if 1 not in fields[key]['lnsp']:
+                if key[2] != '0':
+                    raise WrongStepError()
+                continue
+            todo.append(key)
+    if values is None:
+        raise ValueError('{} contains no z on level 1'.format(z_lnsp))
+
+    sample = values.pop('sample')
+    values['levelist'] = levelist
+    # the workers read the messages of their step themselves
+    results = pool.map(production_step_vectorized,
+                       [fields[key] for key in todo],
+                       [values] * len(todo),
+                       [filenames] * len(todo))
+    return sample, zip(todo, results)
+
+
+def write_grib(fout, sample, steps):
+    '''Write z of all steps as GRIB messages based on sample'''
+    gid = codes_new_from_message(sample)
+    for key, (levels, z_f) in steps:
+        codes_set(gid, 'step', int(key[2]))
+        for lev, z_level in zip(levels, z_f):
+            codes_set(gid, 'level', int(lev))
+            codes_set_values(gid, z_level)
+            codes_write(gid, fout)
+    codes_release(gid)
+
+
+def write_netcdf(filename, sample, steps):
+    '''Write z of all steps into an existing NetCDF file with time, lev,
+    lat and lon coordinates, e.g. created by cdo from the model levels'''
+    with netCDF4.Dataset(filename, 'a') as ncin:
+        times = netCDF4.num2date(ncin['time'][:], ncin['time'].units,
+                                 getattr(ncin['time'], 'calendar',
+                                         'standard'),
+                                 only_use_cftime_datetimes=False,
+                                 only_use_python_datetimes=True)
+        if 'z' not in ncin.variables:
+            ncin.createVariable('z', 'f4', Z_DIMENSIONS, fill_value=np.nan)
+        ncin['z'].setncatts(Z_ATTRIBUTES)
+        write_fields(ncin['z'], sample, steps,
+                     np.array(times, dtype='datetime64[ns]'),
+                     ncin['lev'][:], ncin['lat'][:], ncin['lon'][:])
+
+
+def write_fields(target, sample, steps, times, levs, lats, lons):
+    '''Write z of all steps into the (time, lev, lat, lon) array-like
+    target described by the given coordinates'''
+    gid = codes_new_from_message(sample)
+    shape = (codes_get(gid, 'Nj', int), codes_get(gid, 'Ni', int))
+    grid_lats = codes_get_array(gid, 'latitudes').reshape(shape)[:, 0]
+    grid_lons = codes_get_array(gid, 'longitudes').reshape(shape)[0, :]
+    codes_release(gid)
+    idx_lat = find_indices(grid_lats, lats)
+    idx_lon = find_indices(grid_lons, lons, period=360)
+    levs = {int(round(lev)): i for i, lev in enumerate(levs)}
+    times = list(np.asarray(times, dtype='datetime64[ns]'))
+
+    z_level = np.empty((len(lats), len(lons)), dtype=np.float32)
+    for key, (levels, z_f) in steps:
+        valid_time = np.datetime64(datetime.datetime.strptime(
+            key[0] + '%04d' % int(key[1]), '%Y%m%d%H%M'), 'ns') + \
+            np.timedelta64(int(key[2]), 'h')
+        if valid_time not in times:
+            raise MissingTimeError(
+                'time {} not found in output'.format(valid_time))
+        idx_time = times.index(valid_time)
+        for lev, z_values in zip(levels, z_f):
+            if lev not in levs:
+                continue
+            z_level[idx_lat[:, np.newaxis], idx_lon] = z_values.reshape(shape)
+            target[idx_time, levs[lev], :, :] = z_level
+    return target
+
+
+def find_indices(grid, coords, period=None):
+    '''Return the index within coords for each value of grid, which
+    must contain the same points'''
+    if len(grid) != len(coords):
+        raise ValueError('grid of input does not match coordinates of output')
+    diff = grid[:, np.newaxis] - np.asarray(coords)[np.newaxis, :]
+    if period is not None:
+        diff = (diff + period / 2) % period - period / 2
+    result = np.abs(diff).argmin(axis=1)
+    if not np.allclose(diff[np.arange(len(grid)), result], 0, atol=1e-4):
+        raise ValueError('grid of input does not match coordinates of output')
+    return result
+
+
+def read_fields(idx):
+    '''Group the index entries of all messages of the grib_index.GribIndex
+    idx by date/time/step. The entries are stored per shortName and level,
+    so the messages can be read and decoded where they are needed'''
+    params = {'130': 't', '133': 'q', '129': 'z', '152': 'lnsp'}
+    fields = {}
+    max_level = 0
+    for message in idx.messages:
+        level = int(message['level'])
+        max_level = max(max_level, level)
+        name = params.get(message['paramId'])
+        if name is not None:
+            key = tuple(message[x] for x in ['date', 'time', 'step'])
+            entry = fields.setdefault(key, {'t': {}, 'q': {}, 'z': {},
+                                            'lnsp': {}})
+            entry[name][level] = message
+    return fields, max_level
+
+
+def get_initial_values_from_message(message, max_level):
+    '''Get the values of surface z, pv and number of levels '''
+    gid = codes_new_from_message(message)
+    values = {}
+    values['z'] = codes_get_values(gid)
+    values['pv'] = codes_get_array(gid, 'pv')
+    values['nlevels'] = codes_get(gid, 'NV', int) // 2 - 1
+    if max_level != values['nlevels']:
+        print('%s [WARN] total levels should be: %d but it is %d' %
+              (sys.argv[0], values['nlevels'], max_level),
+              file=sys.stderr)
+        values['nlevels'] = max_level
+    values['sample'] = message
+    codes_release(gid)
+    return values
+
+
+def decode_values(message):
+    '''Decode the values of an encoded message'''
+    gid = codes_new_from_message(message)
+    result = codes_get_values(gid)
+    codes_release(gid)
+    return result
+
+
+def production_step_vectorized(fields, values, filenames):
+    '''Compute z at full levels for all levels of one step at once, reading
+    the messages of the index entries in fields from filenames'''
+    with grib_index.MessageReader(filenames) as reader:
+        gid = codes_new_from_message(reader.read(fields['lnsp'][1]))
+        if codes_get(gid, 'gridType', str) == 'sh':
+            print('%s [ERROR] fields must be gridded, not spectral' %
+                  sys.argv[0], file=sys.stderr)
+            sys.exit(1)
+        values = dict(values, sp=np.exp(codes_get_values(gid)))
+        codes_release(gid)
+
+        levels = []
+        for lev in sorted(values['levelist'], reverse=True):
+            for name in ['t', 'q']:
+                if lev not in fields[name]:
+                    print('%s [WARN] %s at level %d missing from input' %
+                          (sys.argv[0], name.upper(), lev), file=sys.stderr)
+                    break
+            else:
+                levels.append(lev)
+        if not levels:
+            return levels, []
+        t_level = np.array([decode_values(reader.read(fields['t'][lev]))
+                            for lev in levels])
+        q_level = np.array([decode_values(reader.read(fields['q'][lev]))
+                            for lev in levels])
+    return levels, compute_z_column(values, levels, t_level, q_level)
+
+
+def compute_z_column(values, levels, t_level, q_level):
+    '''Compute z at full level for all given levels, based on t/q/sp.
+    levels must be ordered from the ground upwards and t_level/q_level
+    hold one row of values for each level'''
+    levels = np.asarray(levels, dtype=int)
+    a_coef = values['pv'][0:values['nlevels'] + 1]
+    b_coef = values['pv'][values['nlevels'] + 1:]
+    # pressure on all half-levels
+    p_half = a_coef[:, np.newaxis] + (b_coef[:, np.newaxis] * values['sp'])
+    ph_lev, ph_levplusone = p_half[levels - 1], p_half[levels]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dlog_p = np.log(ph_levplusone / ph_lev)
+        alpha = 1. - ((ph_lev / (ph_levplusone - ph_lev)) * dlog_p)
+    top = levels == 1
+    dlog_p[top] = np.log(ph_levplusone[top] / 0.1)
+    alpha[top] = np.log(2)
+
+    # compute moist temperature
+    t_level = t_level * (1. + 0.609133 * q_level)
+    t_level = t_level * R_D
+
+    # z_h is the geopotential of the half-level below each full level,
+    # accumulated from the ground upwards
+    z_h = np.cumsum(np.concatenate([values['z'][np.newaxis],
+                                    (t_level * dlog_p)[:-1]]), axis=0)
+    return z_h + (t_level * alpha)
+
+
 class WrongStepError(Exception):
     ''' Exception capturing wrong step'''
     pass
@@ -277,5 +574,10 @@ class MissingLevelError(Exception):
     pass
 
 
+class MissingTimeError(Exception):
+    ''' Exception capturing steps missing from the output file'''
+    pass
+
+
 if __name__ == '__main__':
     main()
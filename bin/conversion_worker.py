@@ -0,0 +1,150 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+
+Resident worker running the python conversion scripts without paying for
+interpreter startup and the import of xarray, MetPy and eccodes per call.
+
+Usage: conversion_worker.py [--socket PATH] serve
+       conversion_worker.py [--socket PATH] run <script> [arguments...]
+
+serve imports the scripts once and listens on a unix socket, every job is
+executed in a forked copy of the worker. run submits a job, e.g.
+"run add_ancillary --pv a.sfc.nc a.ml.nc", passing on the output and exit
+status of the script. If no worker is listening, run executes the script
+in a new interpreter instead.
+"""
+import argparse
+import importlib
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+
+import metrics
+
+BINDIR = os.path.dirname(os.path.abspath(__file__))
+
+# scripts served by the worker; eccodes must be imported after MetPy
+SCRIPTS = ["interpolate_model", "add_ancillary", "compute_geopotential_on_ml", "convert", "grib2ncdf", "domains"]
+
+
+def run_job(job, conn):
+    """
+    Runs job in the current (forked) process with output sent to conn.
+    Returns the exit status of the script.
+    """
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.chdir(job["cwd"])
+    os.environ.clear()
+    os.environ.update(job["env"])
+    sys.argv = [os.path.join(BINDIR, job["script"] + ".py")] + job["args"]
+    os.dup2(conn.fileno(), 1)
+    os.dup2(conn.fileno(), 2)
+    try:
+        with metrics.stage(job["script"]):
+            importlib.import_module(job["script"]).main()
+        status = 0
+    except SystemExit as ex:
+        status = ex.code if isinstance(ex.code, int) else (0 if ex.code is None else 1)
+        if ex.code is not None and not isinstance(ex.code, int):
+            print(ex.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return status
+
+
+def serve(path):
+    for script in SCRIPTS:
+        importlib.import_module(script)
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    # finished jobs are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print("Conversion worker listening on", path, flush=True)
+    try:
+        while True:
+            conn, _ = server.accept()
+            if os.fork() == 0:
+                server.close()
+                with conn.makefile("rb") as fin:
+                    job = json.loads(fin.readline())
+                status = run_job(job, conn)
+                conn.sendall(b"\0" + str(status).encode())
+                conn.close()
+                os._exit(0)
+            conn.close()
+    finally:
+        server.close()
+        os.remove(path)
+
+
+def submit(path, script, args):
+    """
+    Runs script with args in the worker listening on path and returns its
+    exit status, or executes the script directly if there is no worker.
+    """
+    if script not in SCRIPTS:
+        raise ValueError(f"unknown script {script}")
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        client.close()
+        sys.stdout.flush()
+        os.execv(sys.executable, [sys.executable, os.path.join(BINDIR, script + ".py")] + args)
+    with client:
+        client.sendall(json.dumps({"script": script, "args": args, "cwd": os.getcwd(),
+                                   "env": dict(os.environ)}).encode() + b"\n")
+        status = b""
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            if not status:
+                # the exit status follows a NUL byte at the end of the output
+                data, separator, status = data.partition(b"\0")
+                sys.stdout.buffer.write(data)
+                sys.stdout.buffer.flush()
+                status = separator + status
+            else:
+                status += data
+    if not status:
+        print("Conversion worker terminated unexpectedly", file=sys.stderr)
+        return 1
+    return int(status[1:])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-s", "--socket", default=os.environ.get("CONVERSION_WORKER") or "conversion_worker.sock",
+                        help="unix socket of the worker (default: $CONVERSION_WORKER)")
+    parser.add_argument("command", choices=["serve", "run"])
+    parser.add_argument("script", nargs="?", choices=SCRIPTS)
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    if (args.command == "run") != (args.script is not None):
+        parser.error("run requires the script name, serve takes no further arguments")
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.command == "serve":
+        serve(args.socket)
+    else:
+        sys.exit(submit(args.socket, args.script, args.args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+"""
+import datetime
+import optparse
+import os
+import re
+import sys
+
+import numpy as np
+import xarray as xr
+
+import add_ancillary
+import append_steps
+import compute_geopotential_on_ml
+import grib2ncdf
+import interpolate_model
+import metrics
+import nc_encoding
+import stages
+import zarr_output
+
+# attribute fixes formerly applied by ncatted
+ATTRIBUTES = {
+    "ml": {
+        "cc": {"standard_name": "cloud_area_fraction_in_atmosphere_layer", "units": "dimensionless"},
+        "o3": {"standard_name": "mass_fraction_of_ozone_in_air"},
+        "ciwc": {"standard_name": "specific_cloud_ice_water_content"},
+        "clwc": {"standard_name": "specific_cloud_liquid_water_content"},
+        "lev": {"long_name": "hybrid level at layer midpoints", "units": "level", "positive": "down",
+                "standard_name": "atmosphere_hybrid_sigma_pressure_coordinate"},
+    },
+    "sfc": {
+        "BLH": {"standard_name": "atmosphere_boundary_layer_thickness"},
+        "CI": {"standard_name": "sea_ice_area_fraction", "units": "dimensionless"},
+        "HCC": {"standard_name": "high_cloud_area_fraction", "units": "dimensionless"},
+        "LCC": {"standard_name": "low_cloud_area_fraction", "units": "dimensionless"},
+        "LSM": {"standard_name": "land_binary_mask", "units": "dimensionless"},
+        "MCC": {"standard_name": "medium_cloud_area_fraction", "units": "dimensionless"},
+        "MSL": {"standard_name": "air_pressure_at_sea_level"},
+        "SSTK": {"standard_name": "sea_surface_temperature"},
+        "U10M": {"standard_name": "surface_eastward_wind"},
+        "V10M": {"standard_name": "surface_northward_wind"},
+        "TCW": {"standard_name": "total_column_water"},
+        "TCWV": {"standard_name": "total_column_cloud_liquid_water"},
+        "T2M": {"standard_name": "2_meter_temperature"},
+        "D2M": {"standard_name": "2_meter_dewpoint"},
+        "ISHF": {"standard_name": "instantaneous_surface_sensible_heat_flux"},
+        "IEWS": {"standard_name": "instantaneous_x_surface_stress"},
+        "INSS": {"standard_name": "instantaneous_y_surface_stress"},
+        "ASN": {"units": "dimensionless"},
+        "SD": {"units": "m"},
+    },
+    "pv": {
+        "lev": {"standard_name": "atmosphere_ertel_potential_vorticity_coordinate",
+                "units": "uK m^2 kg^-1 s^-1", "axis": "Z"},
+        "Z": {"standard_name": "geopotential_height"},
+        "O3": {"standard_name": "mass_fraction_of_ozone_in_air"},
+        "PRES": {"standard_name": "air_pressure"},
+        "PT": {"standard_name": "air_potential_temperature"},
+        "Q": {"standard_name": "specific_humidity"},
+        "U": {"standard_name": "eastward_wind"},
+        "V": {"standard_name": "northward_wind"},
+    },
+}
+
+# vertical interpolations: file label, vertical axis, units, coordinate standard_name
+INTERPOLATIONS = [
+    ("pl", "pres", "hPa", "atmosphere_pressure_coordinate"),
+    ("tl", "pt", "K", "atmosphere_potential_temperature_coordinate"),
+    ("al", "z", "m", "atmosphere_altitude_coordinate"),
+]
+
+
+def parse_args(args):
+    oppa = optparse.OptionParser(usage="""
+    convert.py
+
+    Converts the GRIB files of one model run into the NetCDF files used by MSS.
+    All products are derived in memory and each file is written exactly once.
+    With --stage-dir, a rerun after a failure writes only the missing or
+    outdated products.
+
+    Usage: convert.py [options] <GRIB prefix> <NetCDF prefix>
+
+    Example:
+    convert.py grib/2021-01-29T00:00:00.an. mss/2021-01-29T00:00:00.an.
+    reads grib/2021-01-29T00:00:00.an.{ml,ml2,sfc,pv}.grib and writes
+    mss/2021-01-29T00:00:00.an.{ml,sfc,pv,pl,tl,al}.nc
+    """)
+
+    oppa.add_option('--theta', '', action='store_true',
+                    help="Add pt potential temperature field")
+    oppa.add_option('--n2', '', action='store_true',
+                    help="Add n2 static stability.")
+    oppa.add_option('--pv', '', action='store_true',
+                    help="Add pv potential vorticity.")
+    oppa.add_option('--pressure', '', action='store_true',
+                    help="Add pressure")
+    oppa.add_option('--tropopause', '', action='store_true',
+                    help="Add first and second tropopause")
+    oppa.add_option('--processes', '', type='int', default=1,
+                    help="Number of processes used for geopotential and ancillary quantities")
+    oppa.add_option('--model-reduction', '', default="",
+                    help="ncks style hyperslabs of model levels to keep, e.g. '-d lev,0,0 -d lev,16,28,4'")
+    oppa.add_option('--pres-levels', '', default="",
+                    help="Slash separated pressure levels (hPa) of the pl file")
+    oppa.add_option('--theta-levels', '', default="",
+                    help="Slash separated potential temperature levels (K) of the tl file")
+    oppa.add_option('--gph-levels', '', default="",
+                    help="Slash separated altitude levels (m) of the al file")
+    oppa.add_option('--time-units', '', default=None,
+                    help="Units of the time axis, e.g. 'hours since 2021-01-29T00:00:00'")
+    oppa.add_option('--append', '', action='store_true',
+                    help="Write the time steps into existing NetCDF files, replacing steps already contained")
+    oppa.add_option('--low-memory', '', action='store_true',
+                    help="Compute the ancillary quantities in single precision")
+    oppa.add_option('--fused', '', action='store_true',
+                    help="Compute pressure, theta, PV and N2 in one pass without metpy")
+    oppa.add_option('--stage-dir', '', default=None,
+                    help="Directory of the stage manifests, with which a rerun skips completed stages "
+                         "(ignored with --append and Zarr output)")
+    opt, arg = oppa.parse_args(args)
+
+    if len(arg) != 2:
+        print(oppa.get_usage())
+        sys.exit(1)
+    for kind in ["ml", "ml2"]:
+        if not os.path.exists(arg[0] + kind + ".grib"):
+            print("Cannot find model data at", arg[0] + kind + ".grib")
+            sys.exit(1)
+    return opt, arg[0], arg[1]
+
+
+def parse_levels(levels):
+    return [float(x) for x in levels.split("/")] if levels else []
+
+
+def parse_model_reduction(reduction, size):
+    """
+    Translates ncks hyperslabs of lev (zero based, inclusive, optional
+    stride) into the sorted union of model level indices to keep.
+    """
+    slabs = re.findall(r"-d\s*lev,([^\s]+)", reduction)
+    if not slabs:
+        return np.arange(size)
+    indices = set()
+    for slab in slabs:
+        values = [int(x) for x in slab.split(",")]
+        start, stop = values[0], values[1] if len(values) > 1 else values[0]
+        stride = values[2] if len(values) > 2 else 1
+        indices.update(range(start, min(stop, size - 1) + 1, stride))
+    return np.array(sorted(indices))
+
+
+def read_grib(filename, vertical=None):
+    """
+    Reads a GRIB file with cfgrib and arranges it like cdo would: time, lev,
+    lat and lon dimensions and cdo -t ecmwf variable names.
+    """
+    ds = xr.load_dataset(filename, engine="cfgrib",
+                         backend_kwargs={"indexpath": "", "read_keys": ["edition", "pv"]})
+    for dim in ["step", "time"]:
+        if dim in ds.dims:
+            ds = ds.swap_dims({dim: "valid_time"})
+            break
+    else:
+        ds = ds.expand_dims("valid_time")
+    ds = ds.drop_vars([x for x in ["time", "step", "number", "surface"] if x in ds.coords])
+    ds = ds.rename({"valid_time": "time", "latitude": "lat", "longitude": "lon"})
+    for axis, coord in [("T", "time"), ("Y", "lat"), ("X", "lon")]:
+        ds[coord].attrs["axis"] = axis
+    if vertical in ds.coords:
+        if vertical not in ds.dims:
+            ds = ds.expand_dims(vertical)
+        ds = ds.rename({vertical: "lev"}).transpose("time", "lev", "lat", "lon")
+    else:
+        ds = ds.drop_vars([x for x in [vertical, "hybrid"] if x in ds.coords])
+        ds = ds.transpose("time", "lat", "lon")
+
+    names = {}
+    for var in ds.data_vars:
+        attrs = ds[var].attrs
+        if attrs["GRIB_edition"] == 1 and attrs["GRIB_paramId"] in grib2ncdf.ECMWF_NAMES:
+            names[var] = grib2ncdf.ECMWF_NAMES[attrs["GRIB_paramId"]]
+        else:
+            names[var] = attrs["GRIB_shortName"]
+    if vertical == "hybrid":
+        # hybrid coefficients at layer midpoints as provided by cdo
+        pv = np.asarray(next(iter(ds.data_vars.values())).attrs["GRIB_pv"])
+        a, b = pv[:len(pv) // 2], pv[len(pv) // 2:]
+        ds["hyam"] = (("nhym",), (a[1:] + a[:-1]) / 2)
+        ds["hybm"] = (("nhym",), (b[1:] + b[:-1]) / 2)
+    for var in ds.variables:
+        ds[var].attrs = {key: value for key, value in ds[var].attrs.items()
+                         if not key.startswith("GRIB_") and value != "unknown"}
+        ds[var].encoding = {}
+    ds.attrs = {key: value for key, value in ds.attrs.items() if not key.startswith("GRIB_")}
+    return ds.rename(names)
+
+
+def fix_attributes(ds, kind):
+    for var, attrs in ATTRIBUTES[kind].items():
+        if var in ds.variables:
+            ds[var].attrs.update(attrs)
+    return ds
+
+
+def write(ds, filename, time_units, append=False):
+    """
+    Writes the product ds to filename. With append, the time steps of ds
+    are written into an already existing product.
+    """
+    now = datetime.datetime.now().isoformat()
+    ds.attrs["history"] = now + ":" + " ".join(sys.argv)
+    ds.attrs["date_modified"] = now
+    time_encoding = {"units": time_units, "calendar": "proleptic_gregorian", "dtype": "float64"}
+    if zarr_output.enabled():
+        zarr_output.write(ds, filename, {"time": time_encoding})
+        return
+    encoding = nc_encoding.encoding(ds, filename)
+    encoding["time"] = time_encoding
+    if append:
+        append_steps.write(ds, filename, encoding)
+        return
+    print("Writing", filename)
+    ds.to_netcdf(filename, format="NETCDF4_CLASSIC", encoding=encoding)
+
+
+def compute_model(option, grib_prefix):
+    """
+    Reads the model levels and the surface and adds geopotential and the
+    ancillary quantities. Returns ml and sfc.
+    """
+    print("Reading model levels...")
+    with metrics.stage("read.ml"):
+        ml = read_grib(grib_prefix + "ml.grib", vertical="hybrid")
+        ml2 = read_grib(grib_prefix + "ml2.grib")
+    if os.path.exists(grib_prefix + "sfc.grib"):
+        print("Reading surface...")
+        with metrics.stage("read.sfc"):
+            sfc = read_grib(grib_prefix + "sfc.grib")
+        sfc["lnsp"] = ml2["lnsp"]
+    else:
+        sfc = ml2[["lnsp"]]
+
+    fix_attributes(ml, "ml")
+    fix_attributes(sfc, "sfc")
+
+    print("Adding gph...")
+    with metrics.stage("geopotential"):
+        ml = compute_geopotential_on_ml.add_geopotential(
+            ml, grib_prefix + "ml.grib", grib_prefix + "ml2.grib", jobs=option.processes)
+
+    if option.theta or option.n2 or option.pv or option.pressure or option.tropopause:
+        with metrics.stage("ancillary"):
+            if option.processes > 1:
+                ml, sfc = add_ancillary.add_ancillary_parallel(ml, sfc, option, option.processes)
+            else:
+                ml, sfc = add_ancillary.add_ancillary(ml, sfc, option)
+    return ml, sfc
+
+
+def convert(option, grib_prefix, nc_prefix):
+    """
+    Converts the GRIB files of grib_prefix as a pipeline of stages (see
+    stages.py). With option.stage_dir, the model levels with all
+    ancillary quantities are kept as an intermediate file until all
+    products are written, so that a rerun after a failure continues with
+    the missing products.
+    """
+    stage_dir = option.stage_dir if not (option.append or zarr_output.enabled()) else None
+    pipeline = stages.Pipeline(stage_dir, os.path.basename(nc_prefix))
+    checkpoint = pipeline.path("model.nc")
+    grib = {kind: grib_prefix + kind + ".grib" for kind in ["ml", "ml2", "sfc", "pv"]}
+    model = {}
+
+    def model_levels():
+        if "ml" not in model:
+            print("Reading", checkpoint)
+            model["ml"] = xr.load_dataset(checkpoint)
+            for var in model["ml"].variables:
+                model["ml"][var].encoding = {}
+        return model["ml"]
+
+    def reduced_levels():
+        if "reduced" not in model:
+            ml = model_levels()
+            model["reduced"] = ml.drop_vars(["hyam", "hybm"]).isel(
+                lev=parse_model_reduction(option.model_reduction, ml.sizes["lev"]))
+        return model["reduced"]
+
+    def time_units(ds):
+        return option.time_units or "hours since " + str(ds["time"].values[0])[:19]
+
+    def write_model(outputs):
+        model["ml"], sfc = compute_model(option, grib_prefix)
+        model.pop("reduced", None)
+        with metrics.stage("write.sfc"):
+            write(sfc, outputs[nc_prefix + "sfc.nc"], time_units(model["ml"]), option.append)
+        if checkpoint is not None:
+            model["ml"].to_netcdf(outputs[checkpoint], format="NETCDF4_CLASSIC")
+
+    def write_ml(outputs):
+        ml = reduced_levels()
+        with metrics.stage("write.ml"):
+            write(ml, outputs[nc_prefix + "ml.nc"], time_units(ml), option.append)
+
+    def write_pv(outputs):
+        print("Converting pv...")
+        with metrics.stage("convert.pv"):
+            pv = read_grib(grib["pv"], vertical="potentialVorticity")
+            pv = pv.assign_coords(lev=pv["lev"] / 1000)
+            fix_attributes(pv, "pv")
+            write(pv, outputs[nc_prefix + "pv.nc"], time_units(pv), option.append)
+
+    model_inputs = [grib[kind] for kind in ["ml", "ml2", "sfc"] if os.path.exists(grib[kind])]
+    params = {name: getattr(option, name) for name in [
+        "theta", "n2", "pv", "pressure", "tropopause", "low_memory", "fused", "time_units"]}
+    # later stages read the model levels from memory without stage directory
+    levels_input = [checkpoint] if checkpoint else []
+    pipeline.add("model", write_model, model_inputs, [nc_prefix + "sfc.nc"] + levels_input, params,
+                 intermediate=levels_input)
+    pipeline.add("ml", write_ml, levels_input, [nc_prefix + "ml.nc"],
+                 {"model_reduction": option.model_reduction, "time_units": option.time_units})
+    if os.path.exists(grib["pv"]):
+        pipeline.add("pv", write_pv, [grib["pv"]], [nc_prefix + "pv.nc"], {"time_units": option.time_units})
+
+    # interpolations of outdated products are computed together to share the workers
+    products, targets, interpolated = [], [], {}
+    for (kind, vert_axis, vert_units, standard_name), levels in zip(
+            INTERPOLATIONS, [option.pres_levels, option.theta_levels, option.gph_levels]):
+        if levels:
+            products.append((kind, vert_axis, standard_name))
+            targets.append((vert_axis, vert_units, parse_levels(levels)))
+
+    def write_interpolated(kind, vert_axis, standard_name):
+        def function(outputs):
+            if not interpolated:
+                outdated = [number for number, product in enumerate(products)
+                            if product[0] not in pipeline.done and pipeline.outdated(product[0])]
+                results = interpolate_model.interpolate_targets(
+                    reduced_levels(), [targets[number] for number in outdated], option.processes)
+                interpolated.update(zip([products[number][0] for number in outdated], results))
+            interp = interpolated.pop(kind)
+            interp[vert_axis].attrs["standard_name"] = standard_name
+            with metrics.stage("write." + kind):
+                write(interp, outputs[nc_prefix + kind + ".nc"], time_units(interp), option.append)
+        return function
+
+    for (kind, vert_axis, standard_name), target in zip(products, targets):
+        pipeline.add(kind, write_interpolated(kind, vert_axis, standard_name), levels_input,
+                     [nc_prefix + kind + ".nc"],
+                     {"target": target, "model_reduction": option.model_reduction, "time_units": option.time_units})
+    pipeline.run()
+
+
+def main():
+    option, grib_prefix, nc_prefix = parse_args(sys.argv[1:])
+    convert(option, grib_prefix, nc_prefix)
+
+
+if __name__ == "__main__":
+    main()
@@ -27,92 +27,11 @@ else
     export HH=12
 fi
 
-   
-# script should start at 06h/18h to look for 00 12h forecast
-export h_exit=`date --date="+6hours" +%H`
 
-for FCSTEP in $FCSTEPS
-do
-
-# Set path, filenames and variables used later in the script
-    export DATE=${YEAR}-${MONTH}-${DAY}
-    export YMD=${YEAR}${MONTH}${DAY}
-    export TIME=${HH}:00:00
-    export BASE=${DATASET}.${YMD}T${HH}.${FCSTEP}
-    export init_date=${DATE}T${TIME}
-    echo BASE: $BASE
-    export time_units="hours since ${init_date}"
-
-
-    lockfile=grib/${DATASET}.${YMD}T${HH}.${FCSTEP}.ready
-    echo `date` waiting for lockfile $lockfile
-    until  test -e $lockfile
-    do
-	sleep 30
-	h_now=`date +%H`
-	if [[ $h_now == $h_exit ]] 
-	then
-	    echo lockfile $lockfile not found by `date`
-	    echo exiting script
-	    exit 1
-	fi
-    done
-    rm $lockfile
-
-    # Convert grib to netCDF, set init time
-    echo `date`: converting ${FCSTEP}h forecast
-    . $BINDIR/convert.sh
-
-    if [ $ECTRANS_ID == "none" ]
-    then
-	echo "no ectrans transfer -- move data to " $MSSDIR
-	if [ x$TRANSFER_MODEL_LEVELS == x"yes" ]; then
-	    mv $mlfile $MSSDIR
-	fi
-	if [ -f $tlfile ]; then
-	    mv $tlfile $MSSDIR
-	fi
-	if [ -f $plfile ]; then
-	    mv $plfile $MSSDIR
-	fi
-	if [ -f $pvfile ]; then
-	    mv $pvfile $MSSDIR
-	fi
-	if [ -f $alfile ]; then
-	    mv $alfile $MSSDIR
-	fi
-	if [ -f $sfcfile ]; then
-	    mv $sfcfile $MSSDIR
-	fi
-    fi
-done
-echo `date`: converting finished
-
-
-if [[ x$CLEANUP == x"yes" ]]
-then
-  export CYMD=${CLEANUP_YEAR}${CLEANUP_MONTH}${CLEANUP_DAY}
-  export CBASE=${DATASET}.${CYMD}T${HH}.${FCSTEP}
-  echo cleanup $CBASE
-    
-  # clean up locally
-  for f in $mlfile $tlfile $plfile $pvfile $alfile $sfcfile grib/${CBASE}*.grib;
-  do
-      if [ -f $f ];
-      then
-          rm $f
-      fi
-  done
-  if [ $ECTRANS_ID == "none" ]
-  then
-    # clean up MSS server dir
-    for f in $MSSDIR/${CBASE}*.nc
-    do
-	if [ -f $f ];
-	then
-            rm $f
-	fi
-    done
-  fi
-fi
+# script should start at 06h/18h to look for 00 12h forecast; convert the
+# steps of this run as soon as their .ready markers appear and give up
+# after 6 hours
+$PYTHON $BINDIR/convert_daemon.py --dataset $DATASET --jobs ${CONVERT_JOBS:-2} \
+    --run ${YEAR}${MONTH}${DAY}T${HH} --steps $FCSTEPS --timeout 21600 \
+    --command "bash $BINDIR/get_ecmwf_aviso.sh" grib
 echo `date`: ECMWF data converson finished
@@ -0,0 +1,138 @@
+#!/bin/bash
+#Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+#Author(s): Joern Ungermann, May Baer
+
+# Former conversion chain based on cdo and nco, sourced by convert.sh
+# if CONVERTER is set to cdo.
+
+# grib_to_netcdf <stage> <GRIB file> <NetCDF file> [<cdo options>]
+# copies a GRIB file with grib2ncdf.py or with cdo if GRIB2NCDF is cdo
+grib_to_netcdf() {
+    if [[ x$GRIB2NCDF == x"cdo" ]]; then
+        measure $1 cdo -f nc4c $4 -t ecmwf copy $2 $3
+    else
+        run_script grib2ncdf -j ${PROCESSES:-1} $2 $3
+    fi
+}
+
+echo copy ml
+grib_to_netcdf cdo.ml grib/${BASE}.ml.grib $mlfile
+
+echo adding gph
+run_script compute_geopotential_on_ml -j ${PROCESSES:-1} grib/${BASE}.ml.grib grib/${BASE}.ml2.grib -n $mlfile
+
+measure ncatted.ml ncatted -O \
+    -a standard_name,cc,o,c,cloud_area_fraction_in_atmosphere_layer \
+    -a standard_name,o3,o,c,mass_fraction_of_ozone_in_air \
+    -a standard_name,ciwc,o,c,specific_cloud_ice_water_content \
+    -a standard_name,clwc,o,c,specific_cloud_liquid_water_content \
+    -a units,cc,o,c,dimensionless \
+    -a units,time,o,c,"${time_units}" \
+    $mlfile
+
+if [[ x$SFC_PARAMETERS != x"" ]]; then
+    echo converting sfc
+    grib_to_netcdf cdo.sfc grib/${BASE}.sfc.grib $sfcfile
+
+    cdo showatts  $sfcfile
+    echo "ncatted"
+
+    measure ncatted.sfc ncatted -O \
+        -a standard_name,BLH,o,c,atmosphere_boundary_layer_thickness \
+        -a standard_name,CI,o,c,sea_ice_area_fraction \
+        -a standard_name,HCC,o,c,high_cloud_area_fraction \
+        -a standard_name,LCC,o,c,low_cloud_area_fraction \
+        -a standard_name,LSM,o,c,land_binary_mask \
+        -a standard_name,MCC,o,c,medium_cloud_area_fraction \
+        -a standard_name,MSL,o,c,air_pressure_at_sea_level \
+        -a standard_name,SSTK,o,c,sea_surface_temperature \
+        -a standard_name,U10M,o,c,surface_eastward_wind \
+        -a standard_name,V10M,o,c,surface_northward_wind \
+        -a standard_name,TCW,o,c,total_column_water \
+        -a standard_name,TCWV,o,c,total_column_cloud_liquid_water \
+        -a standard_name,T2M,o,c,2_meter_temperature \
+        -a standard_name,D2M,o,c,2_meter_dewpoint \
+        -a standard_name,ISHF,o,c,instantaneous_surface_sensible_heat_flux\
+        -a standard_name,IEWS,o,c,instantaneous_x_surface_stress\
+        -a standard_name,INSS,o,c,instantaneous_y_surface_stress\
+        -a units,HCC,o,c,dimensionless \
+        -a units,LCC,o,c,dimensionless \
+        -a units,MCC,o,c,dimensionless \
+        -a units,CI,o,c,dimensionless \
+        -a units,LSM,o,c,dimensionless \
+        -a units,ASN,o,c,dimensionless \
+        -a units,SD,o,c,m \
+        $sfcfile
+
+    cdo showatts  $sfcfile
+fi
+# extract lnsp and remove lev dimension.
+measure grib_copy.lnsp grib_copy -w shortName=lnsp grib/${BASE}.ml2.grib ${tmpfile}
+grib_to_netcdf cdo.lnsp ${tmpfile} ${tmpfile}2
+rm -f ${tmpfile}.msgidx
+measure ncwa.lnsp ncwa -O -alev ${tmpfile}2 ${tmpfile}
+measure ncks.lnsp ncks -7 -C -O -x -vhyai,hyam,hybi,hybm,lev ${tmpfile} ${tmpfile}2
+rm ${tmpfile}
+if [[ x$SFC_PARAMETERS != x"" ]]; then
+    measure cdo.merge_sfc cdo merge ${sfcfile} ${tmpfile}2 ${tmpfile}
+else
+    mv ${tmpfile}2 ${tmpfile}
+fi
+mv ${tmpfile} $sfcfile
+rm ${tmpfile}2
+
+echo add ancillary
+if [[ x$LOW_MEMORY == x"yes" ]]; then
+    low_memory=--low-memory
+fi
+if [[ x$ANCILLARY_KERNELS == x"fused" ]]; then
+    fused=--fused
+fi
+run_script add_ancillary $low_memory $fused --processes ${PROCESSES:-1} --max-memory ${MAX_MEMORY:-0} $sfcfile $mlfile $ANCILLARY
+
+echo fix up ml
+measure ncks.ml ncks -O -7 -C -x -v hyai,hyam,hybi,hybm $MODEL_REDUCTION $mlfile $mlfile
+measure ncatted.ml_lev ncatted -O -a standard_name,lev,o,c,atmosphere_hybrid_sigma_pressure_coordinate $mlfile
+
+if [[ x$PV_LEVELS != x"" ]]; then
+    echo converting pv
+    grib_to_netcdf cdo.pv grib/${BASE}.pv.grib $pvfile "-z zip_7"
+    measure ncatted.pv ncatted -O \
+        -a standard_name,lev,o,c,atmosphere_ertel_potential_vorticity_coordinate \
+        -a standard_name,Z,o,c,geopotential_height \
+        -a standard_name,O3,o,c,mass_fraction_of_ozone_in_air \
+        -a standard_name,PRES,o,c,air_pressure \
+        -a standard_name,PT,o,c,air_potential_temperature \
+        -a standard_name,Q,o,c,specific_humidity \
+        -a standard_name,U,o,c,eastward_wind \
+        -a standard_name,V,o,c,northward_wind \
+        -a units,lev,o,c,"uK m^2 kg^-1 s^-1" \
+        -a units,time,o,c,"${time_units}" \
+        $pvfile
+    measure ncap2.pv ncap2 -O -s "lev/=1000" $pvfile $pvfile
+fi
+
+targets=""
+if [[ x$PRES_LEVELS != x"" ]]; then
+    targets="$targets $plfile pres hPa $PRES_LEVELS"
+fi
+if [[ x$THETA_LEVELS != x"" ]]; then
+    targets="$targets $tlfile pt K $THETA_LEVELS"
+fi
+if [[ x$GPH_LEVELS != x"" ]]; then
+    targets="$targets $alfile z m $GPH_LEVELS"
+fi
+
+if [[ x$targets != x"" ]]; then
+    echo "Creating pressure, potential temperature and altitude level files..."
+    run_script interpolate_model -j ${PROCESSES:-1} -m ${MAX_MEMORY:-0} $mlfile $targets
+fi
+if [[ x$PRES_LEVELS != x"" ]]; then
+    measure ncatted.pl ncatted -O -a standard_name,pres,o,c,atmosphere_pressure_coordinate $plfile
+fi
+if [[ x$THETA_LEVELS != x"" ]]; then
+    measure ncatted.tl ncatted -O -a standard_name,pt,o,c,atmosphere_potential_temperature_coordinate $tlfile
+fi
+if [[ x$GPH_LEVELS != x"" ]]; then
+    measure ncatted.al ncatted -O -a standard_name,z,o,c,atmosphere_altitude_coordinate $alfile
+fi
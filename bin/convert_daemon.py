@@ -0,0 +1,236 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer, Jens-Uwe Grooss
+
+Converts forecast steps as soon as their download is complete.
+
+Watches a directory for the ${DATASET}.${YMD}T${HH}.${FCSTEP}.ready markers
+written by get_ecmwf_aviso.sh with DOWNLOAD_ONLY=yes, using inotify where
+available and polling otherwise. Several steps are converted at the same
+time by calling get_ecmwf_aviso.sh with CONVERT_ONLY=yes and PUBLISH=no,
+the converted products are then published in time order with
+PUBLISH_ONLY=yes.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import shlex
+import subprocess
+import sys
+import time as timer
+
+IN_CREATE = 0x100
+IN_MOVED_TO = 0x80
+IN_CLOSE_WRITE = 0x8
+
+MARKER = re.compile(r"^(?P<dataset>.+)\.(?P<ymd>\d{8})T(?P<hh>\d{2})\.(?P<step>\d{3})\.(?P<state>ready|converting)$")
+
+
+class Watcher:
+    """
+    Waits for files being created in directory. Uses inotify if available
+    and otherwise returns after the timeout, so that the caller polls.
+    wake interrupts a running wait from another thread.
+    """
+
+    def __init__(self, directory, use_inotify=True):
+        self.wake_read, self.wake_write = os.pipe()
+        self.inotify = None
+        if use_inotify and sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+                fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+                if fd >= 0 and libc.inotify_add_watch(
+                        fd, os.fsencode(directory), IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE) >= 0:
+                    self.inotify = fd
+                elif fd >= 0:
+                    os.close(fd)
+            except (OSError, AttributeError):
+                pass
+        if self.inotify is None:
+            print("Polling", directory, "for markers")
+
+    def wait(self, timeout):
+        fds = [self.wake_read] + ([self.inotify] if self.inotify is not None else [])
+        ready, _, _ = select.select(fds, [], [], timeout)
+        for fd in ready:
+            os.read(fd, 65536)
+
+    def wake(self):
+        os.write(self.wake_write, b"x")
+
+    def close(self):
+        for fd in [self.wake_read, self.wake_write, self.inotify]:
+            if fd is not None:
+                os.close(fd)
+
+
+class ConversionDaemon:
+    """
+    Converts the forecast steps of dataset signalled by markers in directory
+    with at most jobs parallel calls of command and publishes them in time
+    order. If expected maps a forecast run (YYYYMMDDTHH) to its steps,
+    a step of that run is only published after all earlier expected steps
+    and the daemon finishes once all expected steps are published.
+    """
+
+    def __init__(self, directory, dataset, command, jobs=2, poll=30, expected=None, use_inotify=True):
+        self.directory = directory
+        self.dataset = dataset
+        self.command = command
+        self.jobs = jobs
+        self.poll = poll
+        self.expected = expected or {}
+        self.use_inotify = use_inotify
+        self.state = {}
+
+    def base(self, key):
+        ymd, hh, step = key
+        return f"{self.dataset}.{ymd}T{hh}.{step:03d}"
+
+    def marker(self, key, state):
+        return os.path.join(self.directory, f"{self.base(key)}.{state}")
+
+    def scan(self):
+        """
+        Returns the keys of all new markers. Markers of conversions that
+        were interrupted are picked up again.
+        """
+        result = []
+        for name in sorted(os.listdir(self.directory)):
+            match = MARKER.match(name)
+            if match is None or match["dataset"] != self.dataset:
+                continue
+            key = (match["ymd"], match["hh"], int(match["step"]))
+            if key not in self.state:
+                result.append(key)
+        return sorted(result)
+
+    def call(self, key, flags):
+        ymd, hh, step = key
+        with open(os.path.join(self.directory, self.base(key) + ".log"), "a") as log:
+            result = subprocess.run(
+                self.command + ["--date", ymd, "--time", hh, "--step", str(step)],
+                env=dict(os.environ, **flags), stdout=log, stderr=subprocess.STDOUT)
+        return result.returncode == 0
+
+    def fail(self, key):
+        try:
+            os.replace(self.marker(key, "converting"), self.marker(key, "failed"))
+        except FileNotFoundError:
+            pass
+        self.state[key] = "failed"
+
+    def convert(self, key):
+        """
+        Converts the step key. Any error, e.g. a command that cannot be
+        started, marks the step as failed, so later steps are not blocked.
+        """
+        try:
+            if self.call(key, {"CONVERT_ONLY": "yes", "PUBLISH": "no", "PUBLISH_ONLY": "no"}):
+                self.state[key] = "converted"
+                return
+            print(f"Conversion of {self.base(key)} failed")
+        except Exception as ex:
+            print(f"Conversion of {self.base(key)} failed:", ex)
+        self.fail(key)
+
+    def publishable(self, key, force):
+        """
+        Checks whether key is converted and all earlier steps are finished.
+        """
+        if self.state[key] != "converted":
+            return False
+        if any(other < key and state not in ("published", "failed") for other, state in self.state.items()):
+            return False
+        run = f"{key[0]}T{key[1]}"
+        return force or all(
+            self.state.get((key[0], key[1], step)) in ("published", "failed")
+            for step in self.expected.get(run, []) if step < key[2])
+
+    def publish(self, force=False):
+        for key in sorted(self.state):
+            if not self.publishable(key, force):
+                continue
+            if self.call(key, {"PUBLISH_ONLY": "yes"}):
+                print(f"Published {self.base(key)}")
+                os.remove(self.marker(key, "converting"))
+                self.state[key] = "published"
+            else:
+                print(f"Publishing {self.base(key)} failed")
+                self.fail(key)
+
+    def finished(self):
+        return bool(self.expected) and all(
+            self.state.get((run[:8], run[9:], step)) in ("published", "failed")
+            for run, steps in self.expected.items() for step in steps)
+
+    def run(self, timeout=0):
+        """
+        Processes markers until all expected steps are published or timeout
+        seconds have passed (0 for no limit). Returns the states of all
+        steps seen.
+        """
+        deadline = timer.time() + timeout if timeout > 0 else None
+        watcher = Watcher(self.directory, self.use_inotify)
+        try:
+            with ThreadPoolExecutor(self.jobs) as pool:
+                while not self.finished() and (deadline is None or timer.time() < deadline):
+                    for key in self.scan():
+                        for state in ["ready", "converting"]:
+                            if os.path.exists(self.marker(key, state)):
+                                os.replace(self.marker(key, state), self.marker(key, "converting"))
+                        print(f"Converting {self.base(key)}")
+                        self.state[key] = "converting"
+                        pool.submit(self.convert, key).add_done_callback(lambda _: watcher.wake())
+                    self.publish()
+                    wait = self.poll if deadline is None else max(min(self.poll, deadline - timer.time()), 0)
+                    watcher.wait(wait)
+            self.publish(force=True)
+        finally:
+            watcher.close()
+        return self.state
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="directory of the GRIB files and .ready markers")
+    parser.add_argument("-d", "--dataset", default=os.environ.get("DATASET", "ecmwf"),
+                        help="dataset name of the markers (default: $DATASET)")
+    parser.add_argument("-j", "--jobs", type=int, default=2, help="number of parallel conversions (default: 2)")
+    parser.add_argument("-p", "--poll", type=float, default=30,
+                        help="seconds between directory scans without inotify (default: 30)")
+    parser.add_argument("-t", "--timeout", type=float, default=0,
+                        help="seconds after which to stop waiting for markers (default: no limit)")
+    parser.add_argument("--run", help="forecast run (YYYYMMDDTHH) whose steps are expected")
+    parser.add_argument("--steps", nargs="+", type=int, default=[],
+                        help="steps of the forecast run; the daemon exits after publishing them")
+    parser.add_argument("--no-inotify", action="store_true", help="poll the directory instead of using inotify")
+    parser.add_argument("--command", default="bash " + os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                    "get_ecmwf_aviso.sh"),
+                        help="command converting and publishing a step (default: get_ecmwf_aviso.sh)")
+    args = parser.parse_args()
+    if (args.run is None) != (len(args.steps) == 0):
+        parser.error("--run and --steps must be given together")
+    return args
+
+
+def main():
+    args = parse_args()
+    daemon = ConversionDaemon(
+        args.directory, args.dataset, shlex.split(args.command), jobs=args.jobs, poll=args.poll,
+        expected={args.run: args.steps} if args.run is not None else None, use_inotify=not args.no_inotify)
+    state = daemon.run(args.timeout)
+    missing = [step for step in args.steps if (args.run[:8], args.run[9:], step) not in state]
+    if missing:
+        print("Steps not available:", " ".join(str(x) for x in missing))
+    if missing or "failed" in state.values():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
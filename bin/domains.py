@@ -0,0 +1,174 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+
+Serves several domains from a single retrieval and conversion. DOMAINS
+in settings.config lists the domains as <label>:<north>/<west>/<south>/<east>
+with labels written like LABEL, e.g.
+
+    export DOMAINS="EUR.:75/-15/30/42.5 ATL.:65/-60/35/0"
+
+The union of all areas, widened by DOMAIN_HALO grid points, is retrieved
+and converted once. The products are then cut into the products of every
+domain, named with its label. The halo lets horizontal derivatives such
+as PV use centred differences also at the edges of the domains. Areas
+must use the same longitude convention and lie on the grid of GRID.
+
+Usage:
+    domains.py union --grid <dlon>/<dlat> [--halo <n>] <domain> [<domain> ...]
+        prints the area to retrieve
+    domains.py labels <domain> [<domain> ...]
+        prints the labels of the domains
+    domains.py cut [--remove] <union prefix> <prefix> <domain> [<domain> ...]
+        writes <prefix><label><product>.nc from every <union prefix><product>.nc
+"""
+import argparse
+import datetime
+import os
+import sys
+
+import numpy as np
+import xarray as xr
+
+import nc_encoding
+import stages
+
+PRODUCTS = ["ml", "pl", "tl", "al", "pv", "sfc"]
+
+# tolerance (degrees) of matching grid points to the domain boundaries
+TOLERANCE = 1e-4
+
+
+def parse_domain(text):
+    """
+    Returns label and (north, west, south, east) of a domain definition.
+    """
+    label, separator, area = text.rpartition(":")
+    values = area.split("/")
+    if not separator or not label or len(values) != 4:
+        raise ValueError(f"domain {text} is not of the form <label>:<north>/<west>/<south>/<east>")
+    north, west, south, east = (float(x) for x in values)
+    if north < south:
+        raise ValueError(f"domain {text} has its north below its south")
+    return label, (north, west, south, east)
+
+
+def width(area):
+    """
+    Returns the eastward extent of area in degrees.
+    """
+    extent = area[3] - area[1]
+    return extent + 360 if extent < 0 else extent
+
+
+def union_area(areas, grid, halo=1):
+    """
+    Returns the MARS area covering all areas with halo grid points to
+    spare, where grid is "<dlon>/<dlat>".
+    """
+    dlon, dlat = (float(x) for x in grid.split("/"))
+    north = min(90., max(area[0] for area in areas) + halo * dlat)
+    south = max(-90., min(area[2] for area in areas) - halo * dlat)
+    west = min(area[1] for area in areas) - halo * dlon
+    east = max(area[1] + width(area) for area in areas) + halo * dlon
+    if east - west >= 360 - dlon:
+        west = min(area[1] for area in areas)
+        east = west + 360 - dlon
+    return f"{north:g}/{west:g}/{south:g}/{east:g}"
+
+
+def select(ds, area):
+    """
+    Returns the part of ds within area. Longitudes are given in the
+    convention of area and increase eastwards from its western boundary.
+    Raises ValueError unless the grid points of ds include the boundaries
+    of area.
+    """
+    north, west, south, east = area
+    lat, lon = ds["lat"].values, ds["lon"].values
+    covered = [np.any(np.abs(lat - north) <= TOLERANCE), np.any(np.abs(lat - south) <= TOLERANCE)] + [
+        np.any(np.abs((lon - x + 180) % 360 - 180) <= TOLERANCE) for x in (west, east)]
+    if not all(covered):
+        raise ValueError(f"area {area} is not covered by the converted data")
+    lats = np.nonzero((lat >= south - TOLERANCE) & (lat <= north + TOLERANCE))[0]
+    offset = (lon - west + TOLERANCE) % 360 - TOLERANCE
+    lons = np.nonzero(offset <= width(area) + TOLERANCE)[0]
+    lons = lons[np.argsort(offset[lons], kind="stable")]
+    part = ds.isel(lat=lats, lon=lons)
+    shift = 360 * np.round((west + offset[lons] - lon[lons]) / 360)
+    return part.assign_coords(lon=("lon", lon[lons] + shift, part["lon"].attrs))
+
+
+def write(ds, filename, unlimited_dims=()):
+    """
+    Writes the cut product ds to filename with the encoding of nc_encoding.py.
+    """
+    ds = ds.copy()
+    for var in ds.variables:
+        ds[var].encoding = {}
+    encoding = nc_encoding.encoding(ds, filename)
+    now = datetime.datetime.now().isoformat()
+    history = now + ":" + " ".join(sys.argv)
+    if "history" in ds.attrs:
+        history += "\n" + ds.attrs["history"]
+    ds.attrs["history"], ds.attrs["date_modified"] = history, now
+    print("Writing", filename)
+    tmpname = stages.temporary(filename)
+    try:
+        ds.to_netcdf(tmpname, format="NETCDF4_CLASSIC", encoding=encoding, unlimited_dims=list(unlimited_dims))
+        os.replace(tmpname, filename)
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+def cut_products(union_prefix, prefix, domains, remove=False):
+    """
+    Cuts all products <union_prefix><product>.nc into the products
+    <prefix><label><product>.nc of the domains, a list of labels and
+    areas. With remove, the products of the union are deleted afterwards.
+    """
+    labels = [label for label, _ in domains]
+    if len(set(labels)) != len(labels) or any(prefix + label == union_prefix for label in labels):
+        raise ValueError("the labels of the domains must be unique and differ from LABEL")
+    sources = [f"{union_prefix}{product}.nc" for product in PRODUCTS if os.path.exists(f"{union_prefix}{product}.nc")]
+    for source in sources:
+        product = source[len(union_prefix):-3]
+        # times are copied undecoded to keep their units verbatim
+        with xr.open_dataset(source, decode_times=False) as ds:
+            for label, area in domains:
+                write(select(ds, area), f"{prefix}{label}{product}.nc", ds.encoding.get("unlimited_dims", ()))
+    if remove:
+        for source in sources:
+            os.remove(source)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    union = commands.add_parser("union", help="print the area to retrieve")
+    union.add_argument("--grid", required=True, help="grid spacing <dlon>/<dlat> in degrees")
+    union.add_argument("--halo", type=int, default=1, help="grid points added around the domains (default: 1)")
+    labels = commands.add_parser("labels", help="print the labels of the domains")
+    cut = commands.add_parser("cut", help="cut the products of the union into the products of the domains")
+    cut.add_argument("--remove", action="store_true", help="remove the products of the union afterwards")
+    cut.add_argument("union_prefix", help="prefix of the products of the union, e.g. mss/<base>.")
+    cut.add_argument("prefix", help="prefix of the products of the domains, followed by their labels")
+    for command in [union, labels, cut]:
+        command.add_argument("domains", nargs="+", help="domains as <label>:<north>/<west>/<south>/<east>")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    domains = [parse_domain(domain) for domain in args.domains]
+    if args.command == "union":
+        print(union_area([area for _, area in domains], args.grid, args.halo))
+    elif args.command == "labels":
+        print(" ".join(label for label, _ in domains))
+    else:
+        cut_products(args.union_prefix, args.prefix, domains, args.remove)
+
+
+if __name__ == "__main__":
+    main()
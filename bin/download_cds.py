@@ -3,71 +3,178 @@ Copyright (C) 2021 by Forschungszentrum Juelich GmbH
 Author(s): May Baer
 """
 
-from threading import Thread
-import os.path
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import sys
+import threading
+import time as timer
 # To run this example, you need a CDSAPI key
 import cdsapi
 
-c_ml = cdsapi.Client()
-c_pv = cdsapi.Client()
-c_tl = cdsapi.Client()
-c_sfc = cdsapi.Client()
-
-date = os.environ["DATE"]
-time = os.environ["TIME"]
-
-request = {
+import grib_cache
+import metrics
+
+DATASET = 'reanalysis-era5-complete'
+
+
+def split_request(request, split, block=1):
+    """
+    Splits request into several smaller requests, either by parameter
+    ("param") or into blocks of at most block levels ("levels").
+    """
+    if split == "param":
+        return [dict(request, param=param) for param in request["param"].split("/")]
+    if split == "levels" and "levelist" in request:
+        levels = grib_cache.expand_list(request["levelist"])
+        return [dict(request, levelist="/".join(levels[i:i + block]))
+                for i in range(0, len(levels), block)]
+    return [request]
+
+
+def build_jobs(env):
+    """
+    Returns the jobs as dict mapping target GRIB file to its request and
+    the list of partial requests whose results are concatenated into it.
+    """
+    date, time = env["DATE"], env["TIME"]
+    request = {
         'class': 'od',
         'time': time,
         'date': date,
         'expver': '1',
         'stream': 'oper',
-        'type': os.environ["CDS_TYPE"],
-        "area": os.environ["AREA"],
-        "grid": os.environ["GRID"],
+        'type': env["CDS_TYPE"],
+        "area": env["AREA"],
+        "grid": env["GRID"],
     }
-
-
-def ml():
-    c_ml.retrieve('reanalysis-era5-complete', dict(request, **{
-        'levelist': os.environ["MODEL_LEVELS"],
-        'levtype': 'ml',
-        'param': os.environ["MODEL_PARAMETERS"],
-    }), f'grib/{date}T{time}.an.ml.grib')
-
-
-def ml2():
-    c_ml.retrieve('reanalysis-era5-complete', dict(request, **{
-        'levelist': '1',
-        'levtype': 'ml',
-        'param': os.environ["MODEL2_PARAMETERS"],
-    }), f'grib/{date}T{time}.an.ml2.grib')
-
-
-def pv():
-    if os.environ["PV_LEVELS"] == "":
-        return
-    c_pv.retrieve('reanalysis-era5-complete', dict(request, **{
-        'levelist': os.environ["PV_LEVELS"],
-        'levtype': 'pv',
-        'param': os.environ["PV_PARAMETERS"],
-    }), f'grib/{date}T{time}.an.pv.grib')
-
-
-def sfc():
-    c_sfc.retrieve('reanalysis-era5-complete', dict(request, **{
-        'levtype': 'sfc',
-        'param': os.environ["SFC_PARAMETERS"],
-    }), f'grib/{date}T{time}.an.sfc.grib')
-
-
-threads = []
-for levtype in ["ml", "ml2", "pv", "sfc"]:
-    if not os.path.isfile(f'grib/{date}T{time}.an.{levtype}.grib'):
-        threads.append(Thread(target=globals()[levtype]))
-
-for thread in threads:
-    thread.start()
-
-for thread in threads:
-    thread.join()
+    levtypes = {
+        "ml": dict(request, levelist=env["MODEL_LEVELS"], levtype='ml', param=env["MODEL_PARAMETERS"]),
+        "ml2": dict(request, levelist='1', levtype='ml', param=env["MODEL2_PARAMETERS"]),
+        "pv": dict(request, levelist=env["PV_LEVELS"], levtype='pv', param=env["PV_PARAMETERS"]),
+        "sfc": dict(request, levtype='sfc', param=env["SFC_PARAMETERS"]),
+    }
+    if env["PV_LEVELS"] == "":
+        del levtypes["pv"]
+    jobs = {}
+    for levtype, req in levtypes.items():
+        split = env.get("CDS_SPLIT", "none") if levtype == "ml" else "none"
+        jobs[f'grib/{date}T{time}.an.{levtype}.grib'] = (req, split_request(
+            req, split, int(env.get("CDS_SPLIT_LEVELS", "46"))))
+    return jobs
+
+
+class Scheduler:
+    """
+    Retrieves the parts of all jobs with a limited number of concurrent
+    CDS requests. Every part is downloaded into a temporary file that is
+    renamed after success, so that an interrupted run can be resumed with
+    the parts already present. Failed requests are retried with
+    exponential backoff. client_factory must return objects providing
+    the retrieve method of cdsapi.Client. If a grib_cache.GribCache is
+    given, requests are served from and stored in it.
+    """
+
+    def __init__(self, client_factory, concurrency=4, retries=3, backoff=60, sleep=timer.sleep, cache=None):
+        self.client_factory = client_factory
+        self.cache = cache
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.local = threading.local()
+
+    def client(self):
+        if not hasattr(self.local, "client"):
+            self.local.client = self.client_factory()
+        return self.local.client
+
+    def retrieve(self, request, target, store=True):
+        """
+        Retrieves request into target and returns the time of completion.
+        The download is stored in the cache only with store.
+        """
+        if os.path.isfile(target):
+            print("Reusing", target)
+            return timer.time()
+        key = dict(request, dataset=DATASET)
+        if self.cache is not None and self.cache.fetch(key, target):
+            return timer.time()
+        for attempt in range(self.retries + 1):
+            try:
+                self.client().retrieve(DATASET, request, target + ".tmp")
+                os.replace(target + ".tmp", target)
+                break
+            except Exception as ex:
+                if os.path.isfile(target + ".tmp"):
+                    os.remove(target + ".tmp")
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                print(f"Retrieving {target} failed ({ex}), retrying in {delay}s")
+                self.sleep(delay)
+        if self.cache is not None and store:
+            self.cache.store(key, target)
+        return timer.time()
+
+    def run(self, jobs):
+        """
+        Downloads and assembles all jobs not yet present and returns the
+        list of targets that could not be retrieved. The download time and
+        size of every target is recorded as stage download.<levtype>.
+        """
+        start = timer.time()
+        jobs = {target: (request, parts) for target, (request, parts) in jobs.items()
+                if not os.path.isfile(target) and not (
+                    self.cache is not None and self.cache.fetch(dict(request, dataset=DATASET), target))}
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            futures = {
+                # parts are not cached, the assembled target serves their requests
+                target: [pool.submit(self.retrieve, part, self.part_name(target, idx, len(parts)), len(parts) == 1)
+                         for idx, part in enumerate(parts)]
+                for target, (_, parts) in jobs.items()}
+            failed = []
+            for target, parts in futures.items():
+                errors = [part.exception() for part in parts if part.exception() is not None]
+                if errors:
+                    print(f"Failed to retrieve {target}:", errors[0])
+                    failed.append(target)
+                    continue
+                if len(parts) > 1:
+                    self.assemble(target, len(parts))
+                    if self.cache is not None:
+                        self.cache.store(dict(jobs[target][0], dataset=DATASET), target)
+                metrics.record("download." + target.split(".")[-2], start=start,
+                               wall_seconds=max(part.result() for part in parts) - start,
+                               write_bytes=os.path.getsize(target))
+        return failed
+
+    @staticmethod
+    def part_name(target, idx, nparts):
+        return target if nparts == 1 else f"{target}.part{idx:03d}"
+
+    def assemble(self, target, nparts):
+        parts = [self.part_name(target, idx, nparts) for idx in range(nparts)]
+        with open(target + ".tmp", "wb") as fout:
+            for part in parts:
+                with open(part, "rb") as fin:
+                    shutil.copyfileobj(fin, fout)
+        os.replace(target + ".tmp", target)
+        for part in parts:
+            os.remove(part)
+
+
+def main():
+    scheduler = Scheduler(
+        cdsapi.Client,
+        concurrency=int(os.environ.get("CDS_CONCURRENCY", "4")),
+        retries=int(os.environ.get("CDS_RETRIES", "3")),
+        backoff=float(os.environ.get("CDS_BACKOFF", "60")),
+        cache=grib_cache.from_environment())
+    failed = scheduler.run(build_jobs(os.environ))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
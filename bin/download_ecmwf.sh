@@ -2,83 +2,44 @@
 #Copyright (C) 2021 by Forschungszentrum Juelich GmbH
 #Author(s): May Baer
 
+. $BINDIR/functions.sh
 
-if [ ! -f grib/${BASE}.ml.grib ]; then
-    mars <<EOF
-    retrieve,
-    time=$TIME,
-    date=$DATE,
-    step=$STEP,
-    area=$AREA,
-    grid=$GRID,
-    truncation=$TRUNCATION,
-    resol=$RESOL,
-    class=od,
-    levelist=$MODEL_LEVELS,
-    levtype=ml,
-    param=$MODEL_PARAMETERS,
-    stream=oper,
-    type=$ECMWF_TYPE,
-    target="grib/${BASE}.ml.grib"
-EOF
-fi
-if [ ! -f grib/${BASE}.ml2.grib ]; then
-    mars <<EOF
-    retrieve,
-    time=$TIME,
-    date=$DATE,
-    step=$STEP,
-    area=$AREA,
-    grid=$GRID,
-    truncation=$TRUNCATION,
-    resol=$RESOL,
-    class=od,
-    levelist=1,
-    levtype=ml,
-    param=$MODEL2_PARAMETERS,
-    stream=oper,
-    type=$ECMWF_TYPE,
-    target="grib/${BASE}.ml2.grib"
-EOF
-fi
-if [ ! -f grib/${BASE}.sfc.grib ]; then
-    if [[ x$SFC_PARAMETERS != x"" ]]; then
-        mars <<EOF
-        retrieve,
-        time=$TIME,
-        date=$DATE,
-        step=$STEP,
-        area=$AREA,
-        grid=$GRID,
-        truncation=$TRUNCATION,
-        resol=$RESOL,
-        class=od,
-        levtype=sfc,
-        param=$SFC_PARAMETERS,
-        stream=oper,
-        type=fc,
-        target="grib/${BASE}.sfc.grib"
-EOF
+# retrieve <target> <keyword=value>...
+# Retrieves the MARS request given by the keywords into target, unless
+# target exists or the request can be served from the GRIB cache.
+retrieve() {
+    local target=$1
+    local levtype=${target%.grib}
+    shift
+    if [ -f $target ]; then
+        return
     fi
-fi
-if [ ! -f grib/${BASE}.pv.grib ]; then
-    if [[ x$PV_LEVELS != x"" ]]; then
-        mars <<EOF
-        retrieve,
-        time=$TIME,
-        date=$DATE,
-        step=$STEP,
-        area=$AREA,
-        grid=$GRID,
-        truncation=$TRUNCATION,
-        resol=$RESOL,
-        class=od,
-        levelist=$PV_LEVELS,
-        levtype=pv,
-        param=$PV_PARAMETERS,
-        stream=oper,
-        type=fc,
-        target="grib/${BASE}.pv.grib"
-EOF
+    if [[ x$GRIB_CACHE != x"" ]] && $PYTHON $BINDIR/grib_cache.py fetch $target dataset=mars "$@"; then
+        return
+    fi
+    (
+        echo "retrieve,"
+        for keyword in "$@"; do
+            echo "    $keyword,"
+        done
+        echo "    target=\"$target\""
+    ) | measure download.${levtype##*.} mars
+    if [[ x$GRIB_CACHE != x"" ]] && [ -f $target ]; then
+        $PYTHON $BINDIR/grib_cache.py store $target dataset=mars "$@"
     fi
+}
+
+request="time=$TIME date=$DATE step=$STEP area=$AREA grid=$GRID truncation=$TRUNCATION resol=$RESOL class=od stream=oper"
+
+retrieve grib/${BASE}.ml.grib $request \
+    levelist=$MODEL_LEVELS levtype=ml param=$MODEL_PARAMETERS type=$ECMWF_TYPE
+retrieve grib/${BASE}.ml2.grib $request \
+    levelist=1 levtype=ml param=$MODEL2_PARAMETERS type=$ECMWF_TYPE
+if [[ x$SFC_PARAMETERS != x"" ]]; then
+    retrieve grib/${BASE}.sfc.grib $request \
+        levtype=sfc param=$SFC_PARAMETERS type=fc
+fi
+if [[ x$PV_LEVELS != x"" ]]; then
+    retrieve grib/${BASE}.pv.grib $request \
+        levelist=$PV_LEVELS levtype=pv param=$PV_PARAMETERS type=fc
 fi
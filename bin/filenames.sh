@@ -0,0 +1,13 @@
+#!/bin/bash
+#Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+#Author(s): Joern Ungermann, May Baer
+
+# names of the converted products of ${BASE}, PRODUCT_BASE names products
+# collecting the steps of several conversions with APPEND=yes
+export mlfile=mss/${PRODUCT_BASE:-$BASE}.${LABEL}ml.nc
+export plfile=mss/${PRODUCT_BASE:-$BASE}.${LABEL}pl.nc
+export alfile=mss/${PRODUCT_BASE:-$BASE}.${LABEL}al.nc
+export tlfile=mss/${PRODUCT_BASE:-$BASE}.${LABEL}tl.nc
+export pvfile=mss/${PRODUCT_BASE:-$BASE}.${LABEL}pv.nc
+export sfcfile=mss/${PRODUCT_BASE:-$BASE}.${LABEL}sfc.nc
+export tmpfile=mss/.${BASE}.${LABEL}tmp
@@ -0,0 +1,32 @@
+#!/bin/bash
+#Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+#Author(s): Joern Ungermann, May Baer
+
+# Shell functions shared by the download and conversion scripts.
+
+# start of the current cycle, reported by the metrics summary of convert.sh
+export METRICS_START=${METRICS_START:-$(date +%s)}
+
+# measure <stage> <command> <arguments>...
+# Runs command, recording its resource usage as stage if METRICS_FILE is set.
+measure() {
+    if [[ x$METRICS_FILE != x"" ]]; then
+        $PYTHON $BINDIR/metrics.py run "$@"
+    else
+        shift
+        "$@"
+    fi
+}
+
+# run_script <script> <arguments>...
+# Runs a python script of bin, in the conversion worker listening on
+# $CONVERSION_WORKER if set.
+run_script() {
+    local script=$1
+    shift
+    if [[ x$CONVERSION_WORKER != x"" ]]; then
+        $PYTHON $BINDIR/conversion_worker.py --socket $CONVERSION_WORKER run $script "$@"
+    else
+        measure $script $PYTHON $BINDIR/$script.py "$@"
+    fi
+}
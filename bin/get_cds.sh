@@ -14,6 +14,20 @@ fi
 
 . ${BINDIR}/../settings.config
 
+# backfill_cds.py runs the download and the conversion as separate stages,
+# which take precedence over DOWNLOAD_ONLY and CONVERT_ONLY of the settings
+if [[ x$BACKFILL_STAGE == x"download" ]]; then
+    export DOWNLOAD_ONLY=yes CONVERT_ONLY=no
+elif [[ x$BACKFILL_STAGE == x"convert" ]]; then
+    export DOWNLOAD_ONLY=no CONVERT_ONLY=yes
+fi
+
+# retrieve the union of all DOMAINS, which convert.sh cuts into the products of each domain
+if [[ x$DOMAINS != x"" ]]; then
+    export AREA=$($PYTHON $BINDIR/domains.py union --grid $GRID --halo ${DOMAIN_HALO:-1} $DOMAINS) || exit 1
+    echo Retrieving $AREA for $DOMAINS
+fi
+
 cd $WORKDIR
 mkdir -p mss
 mkdir -p grib
@@ -31,13 +45,21 @@ fi
 export time_units="hours since ${init_date}"
 
 # Download ml, sfc, pv and pt files
-echo "Downloading files, this might take a long time!"
-$PYTHON $BINDIR/download_cds.py
+if [[ x$CONVERT_ONLY != x"yes" ]]; then
+    echo "Downloading files, this might take a long time!"
+    $PYTHON $BINDIR/download_cds.py || exit 1
+fi
+if [[ x$DOWNLOAD_ONLY == x"yes" ]]; then
+    exit 0
+fi
 
 . $BINDIR/convert.sh
 
 if [[ $CLEANUP == "yes" ]]                                                           
 then
   # clean up locally
-  rm -f grib/${BASE}*.grib
+  rm -f grib/${BASE}*.grib grib/${BASE}*.grib.msgidx
+  if [[ x$STAGE_DIR != x"" ]]; then
+      rm -f ${STAGE_DIR}/${BASE}*
+  fi
 fi
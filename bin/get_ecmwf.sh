@@ -33,6 +33,12 @@ fi
 
 . ${MAINDIR}/settings.config
 
+# retrieve the union of all DOMAINS, which convert.sh cuts into the products of each domain
+if [[ x$DOMAINS != x"" ]]; then
+    export AREA=$($PYTHON $BINDIR/domains.py union --grid $GRID --halo ${DOMAIN_HALO:-1} $DOMAINS) || exit 1
+    echo Retrieving $AREA for $DOMAINS
+fi
+
 # get forecast date
 # If used as a shell script that is run on a event trigger,
 # the $MSJ* environment variables contain the corresponding time info.
@@ -91,51 +97,62 @@ export time_units="hours since ${init_date}"
 # Convert grib to netCDF, set init time
 . $BINDIR/convert.sh
 
-if [ $ECTRANS_ID == "none" ]
-then
-    echo "no ectrans transfer -- move data to " $MSSDIR
-  if [ x$TRANSFER_MODEL_LEVELS == x"yes" ]; then
-      mv $mlfile $MSSDIR
-  fi
-  if [ -f $tlfile ]; then
-      mv $tlfile $MSSDIR
-  fi
-  if [ -f $plfile ]; then
-      mv $plfile $MSSDIR
-  fi
-  if [ -f $pvfile ]; then
-      mv $pvfile $MSSDIR
-
-  fi
-  if [ -f $alfile ]; then
-      mv $alfile $MSSDIR
-  fi
-  if [ -f $sfcfile ]; then
-      mv $sfcfile $MSSDIR
-  fi
-else  
-
-if ecaccess-association-list | grep -q $ECTRANS_ID; then
-  echo "Transfering files to "$ECTRANS_ID 
-  if [ x$TRANSFER_MODEL_LEVELS == x"yes" ]; then
-      ectrans -remote $ECTRANS_ID -source $mlfile -target $mlfile -overwrite -remove 
-  fi
-  if [ -f $tlfile ]; then
-      ectrans -remote $ECTRANS_ID -source $tlfile -target $tlfile -overwrite -remove 
-  fi
-  if [ -f $plfile ]; then
-      ectrans -remote $ECTRANS_ID -source $plfile -target $plfile -overwrite -remove 
-  fi
-  if [ -f $pvfile ]; then
-      ectrans -remote $ECTRANS_ID -source $pvfile -target $pvfile -overwrite -remove 
-  fi
-  if [ -f $alfile ]; then
-      ectrans -remote $ECTRANS_ID -source $alfile -target $alfile -overwrite -remove 
-  fi
-  if [ -f $sfcfile ]; then
-      ectrans -remote $ECTRANS_ID -source $sfcfile -target $sfcfile -overwrite -remove
-  fi
-fi
+# transfer the products named by filenames.sh for the current LABEL
+transfer_products() {
+    . $BINDIR/filenames.sh
+    if [ $ECTRANS_ID == "none" ]
+    then
+        echo "no ectrans transfer -- move data to " $MSSDIR
+        if [ x$TRANSFER_MODEL_LEVELS == x"yes" ]; then
+            mv $mlfile $MSSDIR
+        fi
+        if [ -f $tlfile ]; then
+            mv $tlfile $MSSDIR
+        fi
+        if [ -f $plfile ]; then
+            mv $plfile $MSSDIR
+        fi
+        if [ -f $pvfile ]; then
+            mv $pvfile $MSSDIR
+        fi
+        if [ -f $alfile ]; then
+            mv $alfile $MSSDIR
+        fi
+        if [ -f $sfcfile ]; then
+            mv $sfcfile $MSSDIR
+        fi
+    elif ecaccess-association-list | grep -q $ECTRANS_ID; then
+        echo "Transfering files to "$ECTRANS_ID
+        if [ x$TRANSFER_MODEL_LEVELS == x"yes" ]; then
+            ectrans -remote $ECTRANS_ID -source $mlfile -target $mlfile -overwrite -remove
+        fi
+        if [ -f $tlfile ]; then
+            ectrans -remote $ECTRANS_ID -source $tlfile -target $tlfile -overwrite -remove
+        fi
+        if [ -f $plfile ]; then
+            ectrans -remote $ECTRANS_ID -source $plfile -target $plfile -overwrite -remove
+        fi
+        if [ -f $pvfile ]; then
+            ectrans -remote $ECTRANS_ID -source $pvfile -target $pvfile -overwrite -remove
+        fi
+        if [ -f $alfile ]; then
+            ectrans -remote $ECTRANS_ID -source $alfile -target $alfile -overwrite -remove
+        fi
+        if [ -f $sfcfile ]; then
+            ectrans -remote $ECTRANS_ID -source $sfcfile -target $sfcfile -overwrite -remove
+        fi
+    fi
+}
+
+if [[ x$DOMAINS != x"" ]]; then
+    # subshell, so that LABEL and the file names do not leak into the cleanup
+    (
+        for LABEL in $($PYTHON $BINDIR/domains.py labels $DOMAINS); do
+            transfer_products
+        done
+    )
+else
+    transfer_products
 fi
 if [[ x$CLEANUP == x"yes" ]]
 then
@@ -143,14 +160,17 @@ then
   export CBASE=${DATASET}.${CYMD}T${HH}.${FCSTEP}
   echo cleanup $CBASE
     
-  # clean up locally
-  for f in $mlfile $tlfile $plfile $pvfile $alfile $sfcfile grib/${CBASE}*.grib;
+  # clean up locally, including the products of all DOMAINS
+  for f in mss/${PRODUCT_BASE:-$BASE}.*.nc grib/${CBASE}*.grib grib/${CBASE}*.grib.msgidx;
   do
       if [ -f $f ];
       then
           rm $f
       fi
   done
+  if [[ x$STAGE_DIR != x"" ]]; then
+      rm -f ${STAGE_DIR}/${CBASE}*
+  fi
   if [ $ECTRANS_ID == "none" ]
   then
     # clean up MSS server dir
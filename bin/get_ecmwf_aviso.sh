@@ -32,6 +32,12 @@ fi
 
 . ${MAINDIR}/settings.config
 
+# the aviso retrieval and publishing of forecast steps do not cut DOMAINS
+if [[ x$DOMAINS != x"" ]]; then
+    echo FATAL `date` DOMAINS require get_ecmwf.sh or get_cds.sh
+    exit 1
+fi
+
 # get forecast date
 # If used as a shell script that is run on a event trigger,
 # the $MSJ* environment variables contain the corresponding time info.
@@ -110,71 +116,80 @@ export BASE=${DATASET}.${YMD}T${HH}.${FCSTEP}
 export init_date=$(date +%Y-%m-%dT%H:%M:%S)
 echo BASE: $BASE
 
+# with APPEND=yes the steps of a forecast run are written into common
+# products, which are kept after publishing for the following steps
+if [[ x$APPEND == x"yes" ]]; then
+    export PRODUCT_BASE=${DATASET}.${YMD}T${HH}
+fi
+
 if [[ "$init_date" > "$DATE" ]] 
 then 
     export init_date="${DATE}T${TIME}"
 fi
 export time_units="hours since ${init_date}"
 
-# Retrieve ml, sfc, pv and pt files
-. $BINDIR/download_ecmwf.sh
+# convert_daemon.py calls this script with CONVERT_ONLY=yes PUBLISH=no to
+# convert downloaded steps and with PUBLISH_ONLY=yes to publish them in order
+if [[ x$PUBLISH_ONLY != x"yes" ]]; then
+    if [[ x$CONVERT_ONLY != x"yes" ]]; then
+        # Retrieve ml, sfc, pv and pt files
+        . $BINDIR/download_ecmwf.sh
+
+        if [ $DOWNLOAD_ONLY == "yes" ]
+        then
+            lockfile=grib/${BASE}.ready
+            echo touch $lockfile and exit
+            touch $lockfile
+            exit 1
+        fi
+    fi
+
+    # Convert grib to netCDF, set init time
+    . $BINDIR/convert.sh
+else
+    . $BINDIR/filenames.sh
+fi
 
-if [ $DOWNLOAD_ONLY == "yes" ]
-then
-    lockfile=grib/${BASE}.ready
-    echo touch $lockfile and exit
-    touch $lockfile
-    exit 1
+if [[ x$PUBLISH == x"no" ]]; then
+    exit 0
 fi
 
-# Convert grib to netCDF, set init time
-. $BINDIR/convert.sh
+# publishes product $1 to $MSSDIR or by ectrans. With APPEND=yes, later
+# steps may be appended to the product meanwhile, so a copy taken under
+# its lock (see append_steps.py) is published instead. MSSDIR receives a
+# temporary file renamed into place, so the MSS server never reads a
+# partially written product.
+publish_product() {
+    local file=$1 source=$1
+    if [[ x$APPEND == x"yes" ]]; then
+        source=mss/.$(basename $file).publish$$
+        flock $file.lock cp $file $source || return 1
+    fi
+    if [ $ECTRANS_ID == "none" ]; then
+        local tmpname=$MSSDIR/.$(basename $file).tmp$$
+        mv $source $tmpname && mv $tmpname $MSSDIR/$(basename $file)
+    else
+        ectrans -remote $ECTRANS_ID -source $source -target $file -overwrite -remove
+    fi
+}
 
 if [ $ECTRANS_ID == "none" ]
 then
     echo "no ectrans transfer -- move data to " $MSSDIR
+    publish=yes
+elif ecaccess-association-list | grep -q $ECTRANS_ID; then
+    echo "Transfering files to "$ECTRANS_ID
+    publish=yes
+fi
+if [[ x$publish == x"yes" ]]; then
   if [ x$TRANSFER_MODEL_LEVELS == x"yes" ]; then
-      mv $mlfile $MSSDIR
-  fi
-  if [ -f $tlfile ]; then
-      mv $tlfile $MSSDIR
-  fi
-  if [ -f $plfile ]; then
-      mv $plfile $MSSDIR
-  fi
-  if [ -f $pvfile ]; then
-      mv $pvfile $MSSDIR
-
-  fi
-  if [ -f $alfile ]; then
-      mv $alfile $MSSDIR
-  fi
-  if [ -f $sfcfile ]; then
-      mv $sfcfile $MSSDIR
-  fi
-else  
-
-if ecaccess-association-list | grep -q $ECTRANS_ID; then
-  echo "Transfering files to "$ECTRANS_ID 
-  if [ x$TRANSFER_MODEL_LEVELS == x"yes" ]; then
-      ectrans -remote $ECTRANS_ID -source $mlfile -target $mlfile -overwrite -remove 
-  fi
-  if [ -f $tlfile ]; then
-      ectrans -remote $ECTRANS_ID -source $tlfile -target $tlfile -overwrite -remove 
-  fi
-  if [ -f $plfile ]; then
-      ectrans -remote $ECTRANS_ID -source $plfile -target $plfile -overwrite -remove 
-  fi
-  if [ -f $pvfile ]; then
-      ectrans -remote $ECTRANS_ID -source $pvfile -target $pvfile -overwrite -remove 
+      publish_product $mlfile || exit 1
   fi
-  if [ -f $alfile ]; then
-      ectrans -remote $ECTRANS_ID -source $alfile -target $alfile -overwrite -remove 
-  fi
-  if [ -f $sfcfile ]; then
-      ectrans -remote $ECTRANS_ID -source $sfcfile -target $sfcfile -overwrite -remove
-  fi
-fi
+  for f in $tlfile $plfile $pvfile $alfile $sfcfile; do
+      if [ -f $f ]; then
+          publish_product $f || exit 1
+      fi
+  done
 fi
 
 if [[ x$CLEANUP == x"yes" ]]
@@ -184,17 +199,27 @@ then
   echo cleanup $CBASE
     
   # clean up locally
-  for f in $mlfile $tlfile $plfile $pvfile $alfile $sfcfile grib/${CBASE}*.grib;
+  if [[ x$APPEND == x"yes" ]]; then
+      products="mss/${DATASET}.${CYMD}T${HH}.*nc mss/${DATASET}.${CYMD}T${HH}.*nc.lock"
+      published="$MSSDIR/${DATASET}.${CYMD}T${HH}.*nc"
+  else
+      products="$mlfile $tlfile $plfile $pvfile $alfile $sfcfile"
+      published="$MSSDIR/${CBASE}*.nc"
+  fi
+  for f in $products grib/${CBASE}*.grib grib/${CBASE}*.grib.msgidx;
   do
       if [ -f $f ];
       then
           rm $f
       fi
   done
+  if [[ x$STAGE_DIR != x"" ]]; then
+      rm -f ${STAGE_DIR}/${CBASE}*
+  fi
   if [ $ECTRANS_ID == "none" ]
   then
     # clean up MSS server dir
-    for f in $MSSDIR/${CBASE}*.nc
+    for f in $published
     do
 	if [ -f $f ];
 	then
@@ -1,4 +1,301 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+
+Converts a GRIB file to NetCDF like "cdo -f nc4c -t ecmwf copy" while
+holding only a few fields in memory.
+
+The file is scanned once through its message index (see grib_index.py)
+to create the dimensions time, lev, lat and lon and one variable per
+parameter. Every message is then decoded and its field written into the
+(time, lev) slice of its variable. Parameters on the level types in
+LEVELS get a lev dimension, all others are stored as (time, lat, lon).
+Variables are named like cdo -t ecmwf names them and files on model
+levels carry the hybrid coefficients hyai, hybi, hyam and hybm.
+
+Chunking and compression follow nc_encoding.py; writing a field keeps at
+most one row of chunks of its variable in the chunk cache. With --jobs,
+messages are decoded by several threads. If OUTPUT_FORMAT is "zarr", the
+file is converted into a temporary NetCDF file, which is then written by
+zarr_output.py with the same variables and attributes.
+"""
+import argparse
+import collections
+import datetime
+import math
+import os
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import netCDF4
+import numpy as np
 import xarray as xr
 
-xr.load_dataset(sys.argv[1], engine="cfgrib").to_netcdf(sys.argv[2])
+import grib_index
+import nc_encoding
+import zarr_output
+
+# names cdo -t ecmwf assigns to GRIB1 parameters of the ECMWF table 128
+ECMWF_NAMES = {
+    3: "PT", 31: "CI", 32: "ASN", 34: "SSTK", 54: "PRES", 129: "Z", 130: "T",
+    131: "U", 132: "V", 133: "Q", 134: "SP", 135: "W", 136: "TCW", 137: "TCWV",
+    141: "SD", 151: "MSL", 152: "LNSP", 155: "D", 159: "BLH", 164: "TCC",
+    165: "U10M", 166: "V10M", 167: "T2M", 168: "D2M", 172: "LSM", 186: "LCC",
+    187: "MCC", 188: "HCC", 203: "O3", 229: "IEWS", 230: "INSS", 231: "ISHF",
+    235: "SKT", 246: "CLWC", 247: "CIWC", 248: "CC",
+}
+
+# level types stored along lev and the attributes cdo gives the coordinate
+LEVELS = {
+    "hybrid": {"standard_name": "hybrid_sigma_pressure", "long_name": "hybrid level at layer midpoints",
+               "formula": "hyam hybm (mlev=hyam+hybm*aps)", "formula_terms": "ap: hyam b: hybm ps: aps",
+               "units": "level", "positive": "down"},
+    "potentialVorticity": {"axis": "Z"},
+    "isobaricInhPa": {"standard_name": "air_pressure", "long_name": "pressure", "units": "hPa",
+                      "positive": "down", "axis": "Z"},
+    "theta": {"standard_name": "air_potential_temperature", "long_name": "potential temperature",
+              "units": "K", "axis": "Z"},
+}
+
+GRIDS = ("regular_ll", "regular_gg")
+
+# hybrid coefficients: name, dimension, long_name, units
+HYBRID = [
+    ("hyai", "nhyi", "hybrid A coefficient at layer interfaces", "Pa"),
+    ("hybi", "nhyi", "hybrid B coefficient at layer interfaces", "1"),
+    ("hyam", "nhym", "hybrid A coefficient at layer midpoints", "Pa"),
+    ("hybm", "nhym", "hybrid B coefficient at layer midpoints", "1"),
+]
+
+
+def valid_time(entry):
+    """
+    Returns the valid time of a message index entry. Steps are in hours.
+    """
+    return (datetime.datetime.strptime(entry["date"] + "%04d" % int(entry["time"]), "%Y%m%d%H%M") +
+            datetime.timedelta(hours=int(entry["step"].split("-")[-1])))
+
+
+def describe(message):
+    """
+    Returns name, level type, attributes, grid, hybrid coefficients and
+    originating centre of the parameter of an encoded message.
+    """
+    from eccodes import codes_get, codes_get_array, codes_new_from_message, codes_release
+
+    gid = codes_new_from_message(message)
+    try:
+        grid = codes_get(gid, "gridType")
+        if grid not in GRIDS:
+            raise ValueError(f"unsupported grid type {grid}")
+        edition = codes_get(gid, "edition", int)
+        param = codes_get(gid, "paramId", int)
+        name = codes_get(gid, "shortName")
+        attrs = {"long_name": codes_get(gid, "name"), "units": codes_get(gid, "units")}
+        if codes_get(gid, "cfName") != "unknown":
+            attrs["standard_name"] = codes_get(gid, "cfName")
+        if edition == 1:
+            name = ECMWF_NAMES.get(param, name)
+            attrs.update(code=codes_get(gid, "indicatorOfParameter", int),
+                         table=codes_get(gid, "table2Version", int))
+        else:
+            attrs["param"] = ".".join(
+                str(codes_get(gid, key, int)) for key in ["parameterNumber", "parameterCategory", "discipline"])
+        shape = (codes_get(gid, "Nj", int), codes_get(gid, "Ni", int))
+        return {
+            "name": name,
+            "level_type": codes_get(gid, "typeOfLevel"),
+            "attrs": attrs,
+            "lat": codes_get_array(gid, "latitudes").reshape(shape)[:, 0],
+            "lon": codes_get_array(gid, "longitudes").reshape(shape)[0, :],
+            "pv": codes_get_array(gid, "pv") if codes_get(gid, "PVPresent", int) else None,
+            "institution": codes_get(gid, "centreDescription"),
+        }
+    finally:
+        codes_release(gid)
+
+
+def decode(message):
+    """
+    Returns the field of an encoded message as float32 with missing values
+    replaced by NaN.
+    """
+    from eccodes import codes_get, codes_get_values, codes_new_from_message, codes_release
+
+    gid = codes_new_from_message(message)
+    try:
+        values = codes_get_values(gid)
+        if codes_get(gid, "bitmapPresent", int):
+            values[values == codes_get(gid, "missingValue", float)] = np.nan
+        return values.astype(np.float32).reshape(codes_get(gid, "Nj", int), codes_get(gid, "Ni", int))
+    finally:
+        codes_release(gid)
+
+
+def fields(index, entries, jobs=1):
+    """
+    Yields the entries together with their decoded fields in order. With
+    more than one job, up to 2 * jobs messages are decoded concurrently.
+    """
+    if jobs <= 1:
+        for entry in entries:
+            yield entry, decode(index.read(entry))
+        return
+    with ThreadPoolExecutor(jobs) as pool:
+        pending = collections.deque()
+        for entry in entries:
+            pending.append((entry, pool.submit(decode, index.read(entry))))
+            if len(pending) >= 2 * jobs:
+                entry, future = pending.popleft()
+                yield entry, future.result()
+        while pending:
+            entry, future = pending.popleft()
+            yield entry, future.result()
+
+
+def chunk_cache(var):
+    """
+    Sizes the chunk cache of var to the chunks touched by writing one field.
+    """
+    chunks = var.chunking()
+    if chunks == "contiguous":
+        return
+    count = math.ceil(var.shape[-2] / chunks[-2]) * math.ceil(var.shape[-1] / chunks[-1])
+    var.set_var_chunk_cache(size=count * math.prod(chunks) * var.dtype.itemsize, nelems=max(count, 1))
+
+
+def create_coordinates(ncfile, sample, times, vertical, levels):
+    """
+    Creates the coordinates time, lev, lat and lon and the hybrid
+    coefficients in ncfile.
+    """
+    ncfile.createDimension("time", None)
+    time_units = times[0].strftime("hours since %Y-%m-%d %H:%M:%S")
+    var = ncfile.createVariable("time", "f8", ("time",))
+    var.setncatts({"standard_name": "time", "units": time_units, "calendar": "proleptic_gregorian", "axis": "T"})
+    var[:] = netCDF4.date2num(times, time_units, "proleptic_gregorian")
+
+    for name, axis, standard_name, units in [("lon", "X", "longitude", "degrees_east"),
+                                             ("lat", "Y", "latitude", "degrees_north")]:
+        ncfile.createDimension(name, len(sample[name]))
+        var = ncfile.createVariable(name, "f8", (name,))
+        var.setncatts({"standard_name": standard_name, "long_name": standard_name, "units": units, "axis": axis})
+        var[:] = sample[name]
+
+    if vertical is None:
+        return
+    ncfile.createDimension("lev", len(levels))
+    var = ncfile.createVariable("lev", "f8", ("lev",))
+    var.setncatts(LEVELS[vertical])
+    var[:] = levels
+    if vertical == "hybrid" and sample["pv"] is not None:
+        half = len(sample["pv"]) // 2
+        coefficients = {"hyai": sample["pv"][:half], "hybi": sample["pv"][half:]}
+        coefficients["hyam"] = (coefficients["hyai"][1:] + coefficients["hyai"][:-1]) / 2
+        coefficients["hybm"] = (coefficients["hybi"][1:] + coefficients["hybi"][:-1]) / 2
+        for name, dim, long_name, units in HYBRID:
+            if dim not in ncfile.dimensions:
+                ncfile.createDimension(dim, len(coefficients[name]))
+            var = ncfile.createVariable(name, "f8", (dim,))
+            var.setncatts({"long_name": long_name, "units": units})
+            var[:] = coefficients[name]
+
+
+def convert(grib_filename, nc_filename, jobs=1):
+    """
+    Converts grib_filename to the NetCDF file nc_filename, decoding the
+    messages with jobs threads.
+    """
+    with grib_index.GribIndex([grib_filename]) as index:
+        params = {}
+        for entry in index.messages:
+            key = (entry["paramId"], entry["shortName"])
+            if key not in params:
+                params[key] = describe(index.read(entry))
+        if not params:
+            raise ValueError(f"{grib_filename} contains no messages")
+        sample = next(iter(params.values()))
+        for desc in params.values():
+            if not (np.array_equal(desc["lat"], sample["lat"]) and np.array_equal(desc["lon"], sample["lon"])):
+                raise ValueError(f"{desc['name']} of {grib_filename} is on a different grid")
+        vertical = {desc["level_type"] for desc in params.values() if desc["level_type"] in LEVELS}
+        if len(vertical) > 1:
+            raise ValueError(f"{grib_filename} mixes the level types {sorted(vertical)}")
+        vertical = vertical.pop() if vertical else None
+        if vertical == "hybrid":
+            sample = next(desc for desc in params.values() if desc["level_type"] == vertical)
+
+        def has_lev(entry):
+            return params[(entry["paramId"], entry["shortName"])]["level_type"] == vertical
+
+        times = sorted({valid_time(entry) for entry in index.messages})
+        levels = sorted({float(entry["level"]) for entry in index.messages if has_lev(entry)})
+
+        with netCDF4.Dataset(nc_filename, "w", format="NETCDF4_CLASSIC") as ncfile:
+            now = datetime.datetime.now().isoformat()
+            ncfile.setncatts({"Conventions": "CF-1.6", "institution": sample["institution"],
+                              "history": now + ":" + " ".join(sys.argv)})
+            create_coordinates(ncfile, sample, times, vertical, levels)
+            config = nc_encoding.load()
+            variables = {}
+            for key, desc in params.items():
+                dims = ("time", "lev", "lat", "lon") if desc["level_type"] == vertical else ("time", "lat", "lon")
+                shape = tuple(ncfile.dimensions[dim].size if dim != "time" else len(times) for dim in dims)
+                options = {"datatype": "f4"}
+                options.update(nc_encoding.create_options(nc_filename, desc["name"], dims, shape, config))
+                var = ncfile.createVariable(desc["name"], dimensions=dims, fill_value=np.nan, **options)
+                var.setncatts(desc["attrs"])
+                chunk_cache(var)
+                variables[key] = var
+
+            # write the fields of every variable in storage order to reuse cached chunks
+            order = {key: number for number, key in enumerate(params)}
+            time_index = {time: number for number, time in enumerate(times)}
+            level_index = {level: number for number, level in enumerate(levels)}
+
+            def position(entry):
+                slot = (time_index[valid_time(entry)],)
+                if has_lev(entry):
+                    slot += (level_index[float(entry["level"])],)
+                return slot
+
+            entries = sorted(index.messages,
+                             key=lambda entry: (order[(entry["paramId"], entry["shortName"])], position(entry)))
+            for entry, field in fields(index, entries, jobs):
+                variables[(entry["paramId"], entry["shortName"])][position(entry)] = field
+
+
+def convert_zarr(grib_filename, nc_filename, jobs=1):
+    """
+    Converts grib_filename like convert and writes the result to the Zarr
+    store of nc_filename (see zarr_output.py).
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(nc_filename))) as tmpdir:
+        tmpname = os.path.join(tmpdir, os.path.basename(nc_filename))
+        convert(grib_filename, tmpname, jobs)
+        ds = xr.load_dataset(tmpname)
+    time_encoding = {"units": ds["time"].encoding["units"], "calendar": "proleptic_gregorian", "dtype": "float64"}
+    for var in ds.variables.values():
+        var.encoding = {}
+    zarr_output.write(ds, nc_filename, {"time": time_encoding})
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("grib", help="GRIB file to convert")
+    parser.add_argument("netcdf", help="NetCDF file to write")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of threads decoding messages (default: 1)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if zarr_output.enabled():
+        convert_zarr(args.grib, args.netcdf, args.jobs)
+    else:
+        convert(args.grib, args.netcdf, args.jobs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+
+Content-addressed cache of retrieved GRIB files.
+
+Files are stored under the hash of the normalized retrieval request.
+Requests asking for a subset of the parameters or levels of a cached
+request are served by filtering the messages of the cached file. The
+least recently used files are evicted once the cache exceeds its size.
+The use of a file is recorded in the modification time of its request, so
+that the message index of the file (see grib_index.py) stays valid.
+
+Usage: grib_cache.py <fetch|store> <GRIB file> key=value [key=value ...]
+
+fetch copies a cached file for the request to the GRIB file and fails
+if there is none, store adds the GRIB file to the cache. The cache
+directory and size (MiB) are taken from GRIB_CACHE and GRIB_CACHE_SIZE.
+"""
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+import grib_index
+
+# request keys, whose values are lists that may be served from a superset
+LIST_KEYS = ("param", "levelist")
+
+# request keys not affecting the content of the retrieved file
+IGNORED_KEYS = ("target",)
+
+
+def expand_list(value):
+    """
+    Expands a MARS style list like 1/to/137/by/2 or t/u/v into a list.
+    """
+    items = str(value).lower().split("/")
+    if len(items) >= 3 and items[1] == "to":
+        step = int(items[4]) if len(items) == 5 and items[3] == "by" else 1
+        return [str(x) for x in range(int(items[0]), int(items[2]) + 1, step)]
+    return items
+
+
+def normalize(request):
+    """
+    Returns request with lower case keys and values, expanded and sorted
+    lists and without keys that do not affect the retrieved data.
+    """
+    result = {}
+    for key, value in request.items():
+        key = key.lower()
+        if key in IGNORED_KEYS:
+            continue
+        if key in LIST_KEYS:
+            values = set(expand_list(value))
+            result[key] = sorted(values, key=lambda x: (not x.isdigit(), int(x) if x.isdigit() else 0, x))
+        else:
+            result[key] = str(value).lower()
+    return result
+
+
+def request_key(request):
+    return hashlib.sha256(json.dumps(normalize(request), sort_keys=True).encode()).hexdigest()
+
+
+def is_subset(request, cached):
+    """
+    Checks whether the normalized request can be served from the normalized
+    cached request.
+    """
+    if request.keys() != cached.keys():
+        return False
+    for key, value in request.items():
+        if key in LIST_KEYS:
+            if not set(value) <= set(cached[key]):
+                return False
+        elif value != cached[key]:
+            return False
+    return True
+
+
+def link_or_copy(source, target):
+    """
+    Places source at target via a temporary file and an atomic rename.
+    """
+    if os.path.exists(target + ".tmp"):
+        os.remove(target + ".tmp")
+    try:
+        os.link(source, target + ".tmp")
+    except OSError:
+        shutil.copyfile(source, target + ".tmp")
+    os.replace(target + ".tmp", target)
+
+
+def filter_messages(source, target, request):
+    """
+    Writes the messages of source matching the param and levelist of
+    request into target. Returns False if the request is not fully
+    covered, e.g. because parameter names do not match the GRIB short
+    names.
+    """
+    params = set(request.get("param", []))
+    levels = set(request.get("levelist", []))
+    found_params, found_levels = set(), set()
+    with grib_index.GribIndex([source]) as index, open(target + ".tmp", "wb") as fout:
+        for entry in index.messages:
+            names = {entry["shortName"].lower(), entry["paramId"]}
+            level = entry["level"]
+            if params and not names & params:
+                continue
+            if levels and level not in levels:
+                continue
+            found_params |= names & params
+            found_levels.add(level)
+            fout.write(index.read(entry))
+    if found_params != params or not levels <= found_levels:
+        os.remove(target + ".tmp")
+        return False
+    os.replace(target + ".tmp", target)
+    return True
+
+
+class GribCache:
+    """
+    Cache of GRIB files in directory, limited to max_size MiB (0 for
+    no limit).
+    """
+
+    def __init__(self, directory, max_size=0):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".grib")
+
+    def fetch(self, request, target):
+        """
+        Places the data of request at target, if available. Returns
+        whether the request could be served from the cache.
+        """
+        request = normalize(request)
+        path = self.path(request_key(request))
+        if os.path.isfile(path):
+            link_or_copy(path, target)
+            self.touch(path)
+            print("Found", target, "in cache")
+            return True
+        for meta in sorted(glob.glob(os.path.join(self.directory, "*.json")), key=os.path.getmtime, reverse=True):
+            with open(meta) as fin:
+                cached = json.load(fin)
+            path = meta[:-len(".json")] + ".grib"
+            if os.path.isfile(path) and is_subset(request, cached) and filter_messages(path, target, request):
+                self.touch(path)
+                print("Extracted", target, "from cache")
+                return True
+        return False
+
+    def store(self, request, source):
+        request = normalize(request)
+        key = request_key(request)
+        link_or_copy(source, self.path(key))
+        with open(os.path.join(self.directory, key + ".json.tmp"), "w") as fout:
+            json.dump(request, fout, sort_keys=True)
+        os.replace(os.path.join(self.directory, key + ".json.tmp"), os.path.join(self.directory, key + ".json"))
+        self.evict()
+
+    def touch(self, path):
+        """
+        Marks the file path as used by touching its request.
+        """
+        meta = path[:-len(".grib")] + ".json"
+        os.utime(meta if os.path.exists(meta) else path)
+
+    def last_use(self, path):
+        meta = path[:-len(".grib")] + ".json"
+        return os.path.getmtime(meta if os.path.exists(meta) else path)
+
+    def evict(self):
+        if self.max_size <= 0:
+            return
+        entries = sorted((self.last_use(x), os.path.getsize(x), x)
+                         for x in glob.glob(os.path.join(self.directory, "*.grib")))
+        total = sum(x[1] for x in entries)
+        for _, size, path in entries[:-1]:
+            if total <= self.max_size * 2 ** 20:
+                break
+            for name in [path, path[:-len(".grib")] + ".json", grib_index.sidecar(path)]:
+                if os.path.exists(name):
+                    os.remove(name)
+            total -= size
+
+
+def from_environment(env=os.environ):
+    """
+    Returns the cache configured by GRIB_CACHE and GRIB_CACHE_SIZE or None.
+    """
+    if env.get("GRIB_CACHE", "") == "":
+        return None
+    return GribCache(os.path.expanduser(env["GRIB_CACHE"]), int(env.get("GRIB_CACHE_SIZE", "0")))
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ("fetch", "store"):
+        print(__doc__)
+        sys.exit(2)
+    cache = from_environment()
+    if cache is None:
+        sys.exit(1)
+    request = dict(x.split("=", 1) for x in sys.argv[3:])
+    if sys.argv[1] == "fetch":
+        if not cache.fetch(request, sys.argv[2]):
+            sys.exit(1)
+    else:
+        cache.store(request, sys.argv[2])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+
+Persistent index of the messages of GRIB files.
+
+Scanning large GRIB files for their messages takes a considerable part of
+the conversion. The index records the byte offset and length of every
+message together with the keys in KEYS in a sidecar file <file>.msgidx,
+so that the file is scanned only once. The sidecar is a JSON document
+
+    {"version": 1, "size": <file size>, "mtime_ns": <modification time>,
+     "keys": ["date", "time", "step", "shortName", "paramId", "level"],
+     "messages": [[offset, length, "20210129", "0000", "0", "t", "130", "1"], ...]}
+
+and is rebuilt when size or modification time of the file change. Keys are
+stored as the strings returned by eccodes. Messages are read through an
+mmap of the file and may be decoded with codes_new_from_message.
+
+Usage: grib_index.py <GRIB file> [<GRIB file> ...]
+
+builds or refreshes the indices of the given files.
+"""
+import json
+import mmap
+import os
+import sys
+
+KEYS = ("date", "time", "step", "shortName", "paramId", "level")
+
+SUFFIX = ".msgidx"
+
+VERSION = 1
+
+
+def sidecar(filename):
+    return filename + SUFFIX
+
+
+def scan(filename):
+    """
+    Returns the offset, length and keys of all messages of filename.
+    """
+    from eccodes import codes_grib_new_from_file, codes_get, codes_release
+
+    messages = []
+    with open(filename, "rb") as fin:
+        while True:
+            gid = codes_grib_new_from_file(fin)
+            if gid is None:
+                break
+            try:
+                messages.append([codes_get(gid, "offset", int), codes_get(gid, "totalLength", int)] +
+                                [codes_get(gid, key, str) for key in KEYS])
+            finally:
+                codes_release(gid)
+    return messages
+
+
+def read_sidecar(filename, stat):
+    """
+    Returns the messages recorded for filename or None if there is no
+    valid index for the current state of the file.
+    """
+    try:
+        with open(sidecar(filename)) as fin:
+            index = json.load(fin)
+    except (OSError, ValueError):
+        return None
+    if (index.get("version") != VERSION or index.get("size") != stat.st_size or
+            index.get("mtime_ns") != stat.st_mtime_ns or tuple(index.get("keys", ())) != KEYS):
+        return None
+    return index["messages"]
+
+
+def write_sidecar(filename, stat, messages):
+    """
+    Stores the index of filename. Failures, e.g. in read-only directories,
+    are ignored, as the index is only a cache.
+    """
+    index = {"version": VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+             "keys": list(KEYS), "messages": messages}
+    tmpname = f"{sidecar(filename)}.{os.getpid()}.tmp"
+    try:
+        with open(tmpname, "w") as fout:
+            json.dump(index, fout, separators=(",", ":"))
+        os.replace(tmpname, sidecar(filename))
+    except OSError as ex:
+        print("Cannot store GRIB index of", filename, ex, file=sys.stderr)
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+def messages(filename):
+    """
+    Returns the index entries of all messages of filename, building the
+    sidecar if required. Entries map the KEYS, "offset" and "length" to
+    their values.
+    """
+    stat = os.stat(filename)
+    records = read_sidecar(filename, stat)
+    if records is None:
+        records = scan(filename)
+        # the file must not have changed while it was scanned
+        if os.stat(filename).st_mtime_ns == stat.st_mtime_ns:
+            write_sidecar(filename, stat, records)
+    return [dict(zip(("offset", "length") + KEYS, record)) for record in records]
+
+
+class MessageReader:
+    """
+    Reads encoded messages of index entries from the given files through
+    an mmap, e.g. in worker processes that receive only the entries.
+    """
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self.maps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for fin, mapped in self.maps.values():
+            mapped.close()
+            fin.close()
+        self.maps = {}
+
+    def read(self, entry):
+        """
+        Returns the encoded message of entry.
+        """
+        if entry["file"] not in self.maps:
+            fin = open(self.filenames[entry["file"]], "rb")
+            self.maps[entry["file"]] = fin, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[entry["file"]][1][entry["offset"]:entry["offset"] + entry["length"]]
+
+
+class GribIndex(MessageReader):
+    """
+    Index of the messages of one or more GRIB files, whose encoded
+    messages are read through an mmap. Entries carry the number of their
+    file as "file".
+    """
+
+    def __init__(self, filenames):
+        super().__init__(filenames)
+        self.messages = []
+        for number, filename in enumerate(self.filenames):
+            for entry in messages(filename):
+                entry["file"] = number
+                self.messages.append(entry)
+
+    def select(self, **keys):
+        """
+        Returns the entries whose keys equal the given values.
+        """
+        keys = {key: str(value) for key, value in keys.items()}
+        return [entry for entry in self.messages if all(str(entry[key]) == value for key, value in keys.items())]
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    for filename in sys.argv[1:]:
+        print(filename, len(messages(filename)), "messages")
+
+
+if __name__ == "__main__":
+    main()
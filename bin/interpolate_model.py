@@ -3,32 +3,105 @@ Copyright (C) 2021 by Forschungszentrum Juelich GmbH
 Author(s): May Baer
 """
 
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import datetime
+import multiprocessing
 import sys
+import warnings
 
+import netCDF4
 import xarray as xr
 import numpy as np
 
-from metpy.interpolate import interpolate_1d
 from metpy.calc import geopotential_to_height
 from metpy.units import units
 
+import metrics
+import nc_encoding
 
-def interpolate_vertical(ml_file, new_file, vert_axis, vert_units, levels):
+# model data shared with forked workers of interpolate_targets
+_ML = None
+
+# rough ratio between the peak memory used for interpolating a chunk and
+# the size of its model data as stored on disk
+MEMORY_FACTOR = 6
+
+
+def interpolation_weights(x, xp, axis=1):
     """
-    Linearly interpolate all 4D variables of ml_file to the levels of
-    vert_axis and save it in new_file
+    Computes the bracketing indices and linear weights for interpolating
+    data given on the coordinate xp to the levels x along axis. The result
+    is identical to metpy.interpolate.interpolate_1d (including its NaN
+    and out-of-range handling), but can be applied to any number of
+    variables sharing xp with apply_interpolation_weights.
     """
+    x = np.asanyarray(x).reshape(-1)
+    sort_x = np.argsort(x)
+    sort_args = np.argsort(xp, axis=axis)
+    xp = np.take_along_axis(xp, sort_args, axis=axis)
+    nlev = xp.shape[axis]
+
+    shape = list(xp.shape)
+    shape[axis] = len(x)
+    expand = [np.newaxis] * xp.ndim
+    expand[axis] = slice(None)
+    x_array = x[sort_x][tuple(expand)]
+
+    # searchsorted for every column: number of (non-NaN) xp below each level
+    minv = np.empty(shape, dtype=np.intp)
+    for idx, level in enumerate(x[sort_x]):
+        index = [slice(None)] * xp.ndim
+        index[axis] = idx
+        minv[tuple(index)] = (xp < level).sum(axis=axis)
+
+    if minv.max() == nlev:
+        warnings.warn('Interpolation point out of data bounds encountered')
+    above = np.clip(minv, 1, nlev - 1)
+    below = above - 1
+    xp_below = np.take_along_axis(xp, below, axis=axis)
+    xp_above = np.take_along_axis(xp, above, axis=axis)
+    outside = (minv == nlev) | (x_array < xp_below)
+    if np.any(x_array < xp_below):
+        warnings.warn('Interpolation point out of data bounds encountered')
+
+    weight = (x_array - xp_below) / (xp_above - xp_below)
+    return {
+        "below": np.take_along_axis(sort_args, below, axis=axis),
+        "above": np.take_along_axis(sort_args, above, axis=axis),
+        "weight": weight,
+        "outside": outside,
+        "reverse": x[0] > x[-1],
+        "axis": axis,
+    }
+
+
+def apply_interpolation_weights(weights, y):
+    """
+    Interpolates y using weights determined by interpolation_weights.
+    """
+    axis = weights["axis"]
+    y_below = np.take_along_axis(y, weights["below"], axis=axis)
+    y_above = np.take_along_axis(y, weights["above"], axis=axis)
+    result = y_below + (y_above - y_below) * weights["weight"]
+    result[weights["outside"]] = np.nan
+    if weights["reverse"]:
+        result = np.flip(result, axis=axis)
+    return result
 
-    ml = xr.load_dataset(ml_file)
 
+def interpolate_dataset(ml, vert_axis, vert_units, levels):
+    """
+    Linearly interpolate all 4D variables of dataset ml to the levels of
+    vert_axis and return the resulting dataset
+    """
     interp = xr.Dataset(coords={
         "lon": ml.coords["lon"],
         "lat": ml.coords["lat"],
         "time": ml.coords["time"],
         vert_axis: levels})
-    interp.attrs = ml.attrs
-    interp.coords[vert_axis].attrs = ml.variables[vert_axis].attrs
+    interp.attrs = dict(ml.attrs)
+    interp.coords[vert_axis].attrs = dict(ml.variables[vert_axis].attrs)
     new_coords = ("time", vert_axis, "lat", "lon")
     xp = ml[vert_axis]
 
@@ -42,35 +115,157 @@ def interpolate_vertical(ml_file, new_file, vert_axis, vert_units, levels):
 
     xp = xp.data[:] * units(xp.attrs["units"]).to(vert_units).m
     interp.coords[vert_axis].attrs["units"] = vert_units
+    weights = interpolation_weights(levels, xp, axis=1)
 
     print("Interpolating ", end="")
     for var in list(ml.variables):
         if len(ml[var].dims) != 4:
-            del ml[var]
             continue
         if var == vert_axis:
             continue
         print(var, end=" ")
         y = ml[var].data[:]
-        interp[var] = (new_coords, interpolate_1d(levels, xp, y, axis=1))
-        interp[var].attrs = ml[var].attrs
+        interp[var] = (new_coords, apply_interpolation_weights(weights, y))
+        interp[var].attrs = dict(ml[var].attrs)
     print()
+    return interp
+
+
+def interpolate_recorded(ml, target):
+    """
+    Same as interpolate_dataset, but records the resource usage of the
+    (vert_axis, vert_units, levels) target.
+    """
+    with metrics.stage("interpolate." + target[0]):
+        return interpolate_dataset(ml, *target)
+
+
+def _interpolate_target(target):
+    return interpolate_recorded(_ML, target)
+
+
+def interpolate_targets(ml, targets, processes=1):
+    """
+    Interpolates dataset ml to several (vert_axis, vert_units, levels)
+    targets and returns the resulting datasets in the same order. With
+    processes > 1, targets are computed by forked workers that share the
+    already loaded model data.
+    """
+    global _ML
+    if processes <= 1 or len(targets) < 2:
+        return [interpolate_recorded(ml, target) for target in targets]
+    _ML = ml
+    try:
+        with ProcessPoolExecutor(min(processes, len(targets)),
+                                 mp_context=multiprocessing.get_context("fork")) as pool:
+            return list(pool.map(_interpolate_target, targets))
+    finally:
+        _ML = None
+
 
+def add_history(attrs):
     now = datetime.datetime.now().isoformat()
     history = now + ":" + " ".join(sys.argv)
-    if "history" in interp.attrs:
-        history += "\n" + interp.attrs["history"]
-    interp.attrs["history"] = history
-    interp.attrs["date_modified"] = now
+    if "history" in attrs:
+        history += "\n" + attrs["history"]
+    attrs["history"] = history
+    attrs["date_modified"] = now
 
+
+def write_interpolated(interp, new_file):
+    add_history(interp.attrs)
     interp.to_netcdf(
         new_file,
-        format="NETCDF4_CLASSIC")
+        format="NETCDF4_CLASSIC",
+        encoding=nc_encoding.encoding(interp, new_file))
+
+
+def memory_chunks(ml, max_memory):
+    """
+    Splits the domain into chunks of single time steps and latitude bands,
+    whose estimated memory requirement stays below max_memory (MiB).
+    """
+    ntime, nlat = ml.sizes["time"], ml.sizes["lat"]
+    row_bytes = MEMORY_FACTOR * sum(
+        var.nbytes for var in ml.data_vars.values() if len(var.dims) == 4) / (ntime * nlat)
+    nbands = min(nlat, max(1, -(-int(row_bytes * nlat) // (max_memory * 2 ** 20))))
+    bounds = np.linspace(0, nlat, nbands + 1).astype(int)
+    return [{"time": slice(iti, iti + 1), "lat": slice(start, stop)}
+            for iti in range(ntime) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def interpolate_chunked(ml_file, new_files, targets, max_memory):
+    """
+    Same as interpolating the loaded ml_file with interpolate_targets and
+    writing the results to new_files, but reads, interpolates and writes
+    the data chunk by chunk with bounded memory.
+    """
+    with xr.open_dataset(ml_file) as ml:
+        chunks = memory_chunks(ml, max_memory)
+        print(f"Interpolating in {len(chunks)} chunks")
+        for ichunk, chunk in enumerate(chunks):
+            part = ml.isel(chunk).load()
+            for new_file, target in zip(new_files, targets):
+                interp = interpolate_dataset(part, *target)
+                if ichunk == 0:
+                    # write the coordinates of the full domain like the in-memory path
+                    skeleton = interp.drop_vars(list(interp.data_vars)).assign_coords(
+                        time=ml["time"], lat=ml["lat"])
+                    write_interpolated(skeleton, new_file)
+                with netCDF4.Dataset(new_file, "a") as ncfile:
+                    for var in interp.data_vars:
+                        if var not in ncfile.variables:
+                            dims = interp[var].dims
+                            options = nc_encoding.create_options(
+                                new_file, var, dims, [len(ncfile.dimensions[dim]) for dim in dims])
+                            ncfile.createVariable(var, options.pop("datatype", interp[var].dtype), dims,
+                                                  fill_value=np.nan, **options)
+                            ncfile[var].setncatts(interp[var].attrs)
+                        ncfile[var][chunk["time"], :, chunk["lat"], :] = interp[var].values
+
+
+def interpolate_vertical(ml_file, new_file, vert_axis, vert_units, levels):
+    """
+    Linearly interpolate all 4D variables of ml_file to the levels of
+    vert_axis and save it in new_file
+    """
+
+    ml = xr.load_dataset(ml_file)
+    write_interpolated(interpolate_dataset(ml, vert_axis, vert_units, levels), new_file)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Interpolates model level data to one or more vertical axes. "
+                    "The model level file is read only once for all targets.",
+        epilog="Example: interpolate_model.py ml.nc pl.nc pres hPa 850/500/200 tl.nc pt K 330/350")
+    parser.add_argument("-j", "--processes", type=int, default=1,
+                        help="number of targets interpolated in parallel")
+    parser.add_argument("-m", "--max-memory", type=int, default=0,
+                        help="process the ml file chunk by chunk using about this much memory (MiB)")
+    parser.add_argument("ml_file", help="model level NetCDF file")
+    parser.add_argument("targets", nargs="+", metavar="target",
+                        help="groups of <new file> <vertical axis> <units> <slash separated levels>")
+    args = parser.parse_args(args)
+    if len(args.targets) % 4 != 0:
+        parser.error("targets must be given as groups of new_file vert_axis vert_units levels")
+    return args
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    groups = [args.targets[i:i + 4] for i in range(0, len(args.targets), 4)]
+    targets = [(vert_axis, vert_units, [float(x) for x in levels.split("/")])
+               for _, vert_axis, vert_units, levels in groups]
+
+    if args.max_memory > 0:
+        interpolate_chunked(args.ml_file, [group[0] for group in groups], targets, args.max_memory)
+        return
+
+    ml = xr.load_dataset(args.ml_file)
+    for group, interp in zip(groups, interpolate_targets(ml, targets, args.processes)):
+        write_interpolated(interp, group[0])
 
 
-ml_file = sys.argv[1]
-new_file = sys.argv[2]
-vert_axis = sys.argv[3]
-vert_units = sys.argv[4]
-levels = [float(x) for x in sys.argv[5].split("/")]
-interpolate_vertical(ml_file, new_file, vert_axis, vert_units, levels)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+
+Records wall time, CPU time, peak resident memory and bytes read and
+written of pipeline stages as JSON lines into the file named by the
+environment variable METRICS_FILE. Nothing is recorded if it is not set.
+
+Usage: metrics.py run <stage> <command> [arguments...]
+       metrics.py report [--base BASE] [--since SECONDS] [--prometheus FILE] <metrics file>
+
+run executes the command and records its resource usage as stage. report
+prints a summary of the recorded stages and optionally writes it as
+Prometheus textfile.
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time as timer
+
+
+def enabled():
+    return os.environ.get("METRICS_FILE", "") != ""
+
+
+def io_counters():
+    """
+    Returns the bytes read and written by this process and its waited-for
+    children through read/write system calls.
+    """
+    try:
+        with open("/proc/self/io") as fin:
+            counters = dict(line.split(":") for line in fin)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except OSError:
+        return 0, 0
+
+
+def usage():
+    """
+    Returns a snapshot of the resource usage of this process including its
+    waited-for children.
+    """
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = io_counters()
+    return {
+        "wall_seconds": timer.time(),
+        "cpu_seconds": own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        # ru_maxrss is given in KiB and is the peak over the process lifetime
+        "max_rss_bytes": max(own.ru_maxrss, children.ru_maxrss) * 1024,
+        "children_max_rss_bytes": children.ru_maxrss * 1024,
+        "read_bytes": read_bytes,
+        "write_bytes": write_bytes,
+    }
+
+
+def peak_memory():
+    """
+    Returns the peak resident set size of this process since the last
+    reset_peak_memory or None if it is not available.
+    """
+    try:
+        with open("/proc/self/status") as fin:
+            status = dict(line.split(":", 1) for line in fin)
+        return int(status["VmHWM"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def reset_peak_memory():
+    """
+    Resets the peak resident set size of this process to the current one.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fout:
+            fout.write("5")
+        return True
+    except OSError:
+        return False
+
+
+# peak memory of the enclosing stages from before the resets by nested stages
+_open_stages = []
+
+
+def record(stage, start=None, **values):
+    """
+    Appends a record for stage with the given values to METRICS_FILE.
+    """
+    if not enabled():
+        return
+    entry = {"base": os.environ.get("BASE", ""), "stage": stage, "pid": os.getpid(),
+             "start": timer.time() if start is None else start}
+    entry.update(values)
+    # a single write of a short line keeps concurrent appends intact
+    fd = os.open(os.environ["METRICS_FILE"], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(entry) + "\n").encode())
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Records the resource usage of the enclosed block as stage name. The
+    peak memory is that of the block itself if the peak of the process can
+    be reset, otherwise that of the process lifetime.
+    """
+    if not enabled():
+        yield
+        return
+    before = usage()
+    current = peak_memory()
+    if current is not None:
+        for peak in _open_stages:
+            peak[0] = max(peak[0], current)
+    reset = current is not None and reset_peak_memory()
+    peak = [0]
+    _open_stages.append(peak)
+    try:
+        yield
+    finally:
+        _open_stages.remove(peak)
+        after = usage()
+        max_rss = after["max_rss_bytes"]
+        own = peak_memory() if reset else None
+        if own is not None:
+            max_rss = max(own, peak[0])
+            # the lifetime peak of the children only grows by children of this stage
+            if after["children_max_rss_bytes"] > before["children_max_rss_bytes"]:
+                max_rss = max(max_rss, after["children_max_rss_bytes"])
+            for outer in _open_stages:
+                outer[0] = max(outer[0], max_rss)
+        values = {key: after[key] - before[key] for key in ["wall_seconds", "cpu_seconds", "read_bytes", "write_bytes"]}
+        record(name, start=before["wall_seconds"], max_rss_bytes=max_rss, **values)
+
+
+def read_records(filename, base=None, since=None):
+    records = []
+    with open(filename) as fin:
+        for line in fin:
+            entry = json.loads(line)
+            if (base is None or entry["base"] == base) and (since is None or entry["start"] >= since):
+                records.append(entry)
+    return records
+
+
+def aggregate(records):
+    """
+    Combines the records of each base and stage, summing up times and bytes
+    and taking the maximum of the peak memory. The order of first
+    appearance is kept.
+    """
+    result = {}
+    for entry in records:
+        key = (entry["base"], entry["stage"])
+        if key not in result:
+            result[key] = {"count": 0, "wall_seconds": 0., "cpu_seconds": 0., "max_rss_bytes": 0,
+                           "read_bytes": 0, "write_bytes": 0}
+        total = result[key]
+        total["count"] += 1
+        for name in ["wall_seconds", "cpu_seconds", "read_bytes", "write_bytes"]:
+            total[name] += entry.get(name, 0)
+        total["max_rss_bytes"] = max(total["max_rss_bytes"], entry.get("max_rss_bytes", 0))
+    return result
+
+
+def summary(records):
+    lines = [f"{'stage':32s} {'count':>5s} {'wall [s]':>9s} {'cpu [s]':>9s} {'rss [MiB]':>9s} "
+             f"{'read [MiB]':>10s} {'write [MiB]':>11s}"]
+    for (_, name), total in aggregate(records).items():
+        lines.append(
+            f"{name:32s} {total['count']:5d} {total['wall_seconds']:9.2f} {total['cpu_seconds']:9.2f} "
+            f"{total['max_rss_bytes'] / 2 ** 20:9.1f} {total['read_bytes'] / 2 ** 20:10.1f} "
+            f"{total['write_bytes'] / 2 ** 20:11.1f}")
+    return "\n".join(lines)
+
+
+def prometheus(records):
+    """
+    Returns the aggregated records in the Prometheus text exposition format.
+    """
+    metrics = [("wall_seconds", "Wall time of the pipeline stage"),
+               ("cpu_seconds", "CPU time of the pipeline stage"),
+               ("max_rss_bytes", "Peak resident memory of the pipeline stage"),
+               ("read_bytes", "Bytes read by the pipeline stage"),
+               ("write_bytes", "Bytes written by the pipeline stage")]
+    totals = aggregate(records)
+    lines = []
+    for name, description in metrics:
+        lines.append(f"# HELP mss_retrieval_stage_{name} {description}")
+        lines.append(f"# TYPE mss_retrieval_stage_{name} gauge")
+        for (base, stage_name), total in totals.items():
+            lines.append(f'mss_retrieval_stage_{name}{{base="{base}",stage="{stage_name}"}} {total[name]}')
+    return "\n".join(lines) + "\n"
+
+
+def run(stage_name, command):
+    """
+    Runs command and records its resource usage. Returns its exit status.
+    """
+    with stage(stage_name):
+        return subprocess.run(command).returncode
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run a command and record its resource usage")
+    run_parser.add_argument("stage")
+    run_parser.add_argument("args", nargs=argparse.REMAINDER)
+    report_parser = commands.add_parser("report", help="summarize recorded stages")
+    report_parser.add_argument("filename")
+    report_parser.add_argument("--base", help="only report stages of this base name")
+    report_parser.add_argument("--since", type=float, help="only report stages started after this epoch time")
+    report_parser.add_argument("--prometheus", help="write the summary also as Prometheus textfile")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "run":
+        sys.exit(run(args.stage, args.args))
+    records = read_records(args.filename, args.base, args.since)
+    print(summary(records))
+    if args.prometheus:
+        with open(args.prometheus + ".tmp", "w") as fout:
+            fout.write(prometheus(records))
+        os.replace(args.prometheus + ".tmp", args.prometheus)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+
+Chunking, compression and packing of the variables of the NetCDF
+products, applied when the files are written.
+
+The settings are read from the JSON file named by the environment variable
+NC_ENCODING and otherwise taken from DEFAULTS. They map patterns of
+"<product>.<variable>" to settings, later patterns overriding earlier ones:
+
+    {"*": {"chunks": "maps", "complevel": 4, "shuffle": true},
+     "ml.*": {"chunks": "sections", "pack": "float32"},
+     "*.pv": {"pack": "int16"}}
+
+chunks is the name of a layout in LAYOUTS or a mapping of dimension names
+to chunk sizes, complevel is the zlib compression level (0 disables
+compression) and pack is "float32" or "int16". The latter stores integers
+scaled to the value range of the variable. Coordinates and variables with
+less than two dimensions are written unchanged.
+"""
+import fnmatch
+import json
+import os
+
+import numpy as np
+
+# chunk sizes of time, vertical and horizontal dimensions, None spans the dimension
+LAYOUTS = {
+    # complete horizontal fields of single levels, as read for MSS maps
+    "maps": {"time": 1, "vertical": 1, "horizontal": None},
+    # complete columns of small horizontal blocks, as read for vertical cross-sections
+    "sections": {"time": 1, "vertical": None, "horizontal": 16},
+    # a compromise between both access patterns
+    "balanced": {"time": 1, "vertical": 8, "horizontal": 64},
+}
+
+DEFAULTS = {
+    "*": {"chunks": "maps", "complevel": 4, "shuffle": True},
+    "ml.*": {"chunks": "balanced"},
+    "pv.*": {"complevel": 7},
+}
+
+HORIZONTAL = ("lat", "lon")
+
+INT16_FILL = np.int16(-32768)
+
+
+def load(filename=None):
+    """
+    Returns the settings of filename, NC_ENCODING or the defaults.
+    """
+    filename = filename or os.environ.get("NC_ENCODING", "")
+    if not filename:
+        return DEFAULTS
+    with open(filename) as fin:
+        return json.load(fin)
+
+
+def product(filename):
+    """
+    Returns the product of a file name such as mss/<base>.ml.nc.
+    """
+    parts = os.path.basename(filename).split(".")
+    return parts[-2] if len(parts) > 1 else parts[0]
+
+
+def settings(config, prod, variable):
+    """
+    Returns the settings for variable of product prod, combining all
+    matching patterns in the order given.
+    """
+    result = {"chunks": None, "complevel": 0, "shuffle": False, "pack": None}
+    for pattern, values in config.items():
+        if fnmatch.fnmatchcase(f"{prod}.{variable}", pattern):
+            result.update(values)
+    return result
+
+
+def chunk_sizes(chunks, dims, shape):
+    """
+    Returns the chunk shape of a variable with dims and shape for a layout
+    name or a mapping of dimension names to chunk sizes.
+    """
+    if chunks is None:
+        return None
+    if isinstance(chunks, str):
+        layout = LAYOUTS[chunks]
+        chunks = {}
+        for dim in dims:
+            kind = "time" if dim == "time" else "horizontal" if dim in HORIZONTAL else "vertical"
+            chunks[dim] = layout[kind]
+    return tuple(size if chunks.get(dim) is None else max(1, min(chunks[dim], size))
+                 for dim, size in zip(dims, shape))
+
+
+def packing(values):
+    """
+    Returns the encoding storing values as int16 scaled to their range.
+    """
+    finite = values[np.isfinite(values)]
+    if finite.size == 0:
+        return {}
+    vmin, vmax = float(finite.min()), float(finite.max())
+    # the lowest integer is reserved for missing values
+    scale = (vmax - vmin) / (2 ** 16 - 2) if vmax > vmin else 1.
+    return {"dtype": "int16", "scale_factor": scale, "add_offset": (vmax + vmin) / 2, "_FillValue": INT16_FILL}
+
+
+def variable_encoding(values, dims, shape, setting, packed=True):
+    """
+    Returns the xarray encoding of a variable for setting. Integer packing
+    requires the values and is replaced by float32 if packed is False.
+    """
+    encoding = {}
+    chunks = chunk_sizes(setting["chunks"], dims, shape)
+    if chunks is not None:
+        encoding.update(chunksizes=chunks, contiguous=False)
+    if setting["complevel"] > 0:
+        encoding.update(zlib=True, complevel=setting["complevel"], shuffle=setting["shuffle"])
+    if setting["pack"] == "float32" or (setting["pack"] == "int16" and not packed):
+        encoding["dtype"] = "float32"
+    elif setting["pack"] == "int16":
+        encoding.update(packing(values))
+    elif setting["pack"] is not None:
+        raise ValueError(f"unknown packing {setting['pack']}")
+    return encoding
+
+
+def encoding(ds, filename, config=None):
+    """
+    Returns the encoding argument of to_netcdf for writing ds to filename.
+    """
+    config = load() if config is None else config
+    prod = product(filename)
+    result = {}
+    for var in ds.data_vars:
+        if ds[var].ndim < 2:
+            continue
+        setting = settings(config, prod, var)
+        result[var] = variable_encoding(
+            ds[var].values if setting["pack"] == "int16" else None, ds[var].dims, ds[var].shape, setting)
+    return result
+
+
+def create_options(filename, name, dims, shape, config=None):
+    """
+    Returns the keyword arguments of netCDF4.Dataset.createVariable for a
+    variable written piecewise to filename. As the value range is not known
+    in advance, int16 packing is replaced by float32.
+    """
+    config = load() if config is None else config
+    if len(dims) < 2:
+        return {}
+    encoding = variable_encoding(None, dims, shape, settings(config, product(filename), name), packed=False)
+    options = {"chunksizes": encoding.get("chunksizes")}
+    if "zlib" in encoding:
+        options.update(zlib=True, complevel=encoding["complevel"], shuffle=encoding["shuffle"])
+    if "dtype" in encoding:
+        options["datatype"] = encoding["dtype"]
+    return options
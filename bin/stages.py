@@ -0,0 +1,209 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+
+Make-like execution of the stages of a conversion, so that a rerun after a
+failure repeats only the stages whose inputs or parameters changed.
+
+Every stage names its input files, parameters and output files. Outputs
+are written to temporary files in the same directory, which are renamed
+into place once the stage succeeded. Afterwards the manifest
+<directory>/<prefix><stage>.json records the parameters and the
+fingerprints of inputs and outputs:
+
+    {"version": 1, "params": {"levels": [850.0, 500.0]},
+     "inputs": {"grib/x.ml.grib": {"size": 1024, "mtime_ns": 1611878400000000000, "sha256": "..."}},
+     "outputs": {"mss/x.pl.nc": {...}}}
+
+A stage is up to date if its manifest matches its parameters, inputs and
+outputs. Files are hashed only if size or modification time differ from
+the manifest, so touched but unchanged files do not trigger a rerun.
+Intermediate outputs, which are only read by later stages, are removed
+once all stages succeeded and are rebuilt only if a stage reading them
+has to run again.
+"""
+import hashlib
+import json
+import os
+
+VERSION = 1
+
+BLOCK = 1 << 20
+
+
+def digest(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(BLOCK), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def fingerprint(path, recorded=None):
+    """
+    Returns size, modification time and hash of path. The hash of recorded
+    is reused if size and modification time are unchanged.
+    """
+    stat = os.stat(path)
+    result = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if recorded is not None and all(recorded.get(key) == value for key, value in result.items()):
+        result["sha256"] = recorded["sha256"]
+    else:
+        result["sha256"] = digest(path)
+    return result
+
+
+def matches(path, recorded):
+    """
+    Returns whether the content of path is the one recorded.
+    """
+    if recorded is None or os.path.getsize(path) != recorded["size"]:
+        return False
+    return fingerprint(path, recorded)["sha256"] == recorded["sha256"]
+
+
+def temporary(path):
+    """
+    Returns the temporary name of output path. The name keeps the product
+    suffix of path, from which nc_encoding.py derives the encoding.
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".tmp{os.getpid()}.{name}")
+
+
+class Stage:
+    def __init__(self, name, function, inputs, outputs, params, intermediate):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        # parameters are compared in their JSON form
+        self.params = json.loads(json.dumps(params or {}))
+        self.intermediate = set(intermediate)
+
+
+class Pipeline:
+    """
+    Stages executed in the order they were added. Without directory, no
+    manifests are kept and all stages write their outputs in place.
+    """
+
+    def __init__(self, directory=None, prefix=""):
+        self.directory = directory
+        self.prefix = prefix
+        self.stages = {}
+        self.producers = {}
+        self.done = set()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        """
+        Returns the path of file name in the manifest directory or None.
+        """
+        if self.directory is None:
+            return None
+        return os.path.join(self.directory, self.prefix + name)
+
+    def add(self, name, function, inputs=(), outputs=(), params=None, intermediate=()):
+        """
+        Adds stage name, which is executed as function(outputs), where
+        outputs maps the given output files to the files to write.
+        """
+        stage = Stage(name, function, inputs, outputs, params, intermediate)
+        self.stages[name] = stage
+        for path in stage.outputs:
+            self.producers[path] = name
+
+    def manifest(self, name):
+        try:
+            with open(self.path(name + ".json")) as fin:
+                manifest = json.load(fin)
+        except (OSError, ValueError):
+            return None
+        return manifest if manifest.get("version") == VERSION else None
+
+    def outdated(self, name):
+        """
+        Returns whether stage name has to run, because its manifest does not
+        match its parameters, inputs or outputs.
+        """
+        if self.directory is None:
+            return True
+        stage = self.stages[name]
+        manifest = self.manifest(name)
+        if (manifest is None or manifest["params"] != stage.params or
+                sorted(manifest["inputs"]) != sorted(stage.inputs) or
+                sorted(manifest["outputs"]) != sorted(stage.outputs)):
+            return True
+        for path in stage.outputs:
+            if os.path.exists(path):
+                if not matches(path, manifest["outputs"][path]):
+                    return True
+            elif path not in stage.intermediate:
+                return True
+        for path in stage.inputs:
+            if os.path.exists(path):
+                if not matches(path, manifest["inputs"][path]):
+                    return True
+            elif path not in self.producers or self.outdated(self.producers[path]):
+                return True
+            elif self.manifest(self.producers[path])["outputs"][path] != manifest["inputs"][path]:
+                return True
+        return False
+
+    def build(self, name):
+        """
+        Runs stage name if it is outdated, after the stages producing its
+        inputs.
+        """
+        if name in self.done:
+            return
+        stage = self.stages[name]
+        if not self.outdated(name):
+            print("Stage", name, "is up to date")
+            self.done.add(name)
+            return
+        for path in stage.inputs:
+            if path in self.producers:
+                self.build(self.producers[path])
+                if not os.path.exists(path):
+                    # an intermediate output removed after a former run
+                    self.execute(self.producers[path])
+        self.execute(name)
+
+    def execute(self, name):
+        stage = self.stages[name]
+        if self.directory is None:
+            stage.function({path: path for path in stage.outputs})
+            self.done.add(name)
+            return
+        old = self.manifest(name) or {"inputs": {}, "outputs": {}}
+        inputs = {path: fingerprint(path, old["inputs"].get(path)) for path in stage.inputs}
+        outputs = {path: temporary(path) for path in stage.outputs}
+        try:
+            stage.function(outputs)
+            for path, tmpname in outputs.items():
+                os.replace(tmpname, path)
+        finally:
+            for tmpname in outputs.values():
+                if os.path.exists(tmpname):
+                    os.remove(tmpname)
+        manifest = {"version": VERSION, "params": stage.params, "inputs": inputs,
+                    "outputs": {path: fingerprint(path) for path in stage.outputs}}
+        tmpname = temporary(self.path(name + ".json"))
+        with open(tmpname, "w") as fout:
+            json.dump(manifest, fout, indent=1)
+        os.replace(tmpname, self.path(name + ".json"))
+        self.done.add(name)
+
+    def run(self):
+        """
+        Builds all stages and removes the intermediate outputs.
+        """
+        for name in self.stages:
+            self.build(name)
+        for stage in self.stages.values():
+            for path in stage.intermediate:
+                if os.path.exists(path):
+                    os.remove(path)
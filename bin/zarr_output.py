@@ -0,0 +1,114 @@
+"""
+Copyright (C) 2021 by Forschungszentrum Juelich GmbH
+Author(s): Joern Ungermann, May Baer
+
+Writes the products as Zarr stores with consolidated metadata instead of
+NetCDF files if the environment variable OUTPUT_FORMAT is "zarr".
+
+Without ZARR_STORE, every product is written to a store named like its
+NetCDF file with the suffix .zarr. Otherwise the time steps of all
+conversions are collected in the stores ${ZARR_STORE}<product>.zarr:
+new times are inserted in time order like in append_steps.py and times
+already present are overwritten. The updates of a store are serialized by
+a lock file, so that conversions may run in parallel.
+
+The stores are chunked like the NetCDF files (see nc_encoding.py) and use
+the default compressor of zarr. As appended steps keep the encoding of
+the store, int16 packing is replaced by float32.
+"""
+import os
+
+import numpy as np
+import xarray as xr
+
+import append_steps
+import nc_encoding
+
+
+def enabled():
+    return os.environ.get("OUTPUT_FORMAT", "netcdf") == "zarr"
+
+
+def store_name(filename):
+    """
+    Returns the store receiving the product that would be written to filename.
+    """
+    prefix = os.environ.get("ZARR_STORE", "")
+    if prefix:
+        return f"{prefix}{nc_encoding.product(filename)}.zarr"
+    return (filename[:-3] if filename.endswith(".nc") else filename) + ".zarr"
+
+
+def encoding(ds, filename, config=None):
+    """
+    Returns the encoding argument of to_zarr for writing ds to filename.
+    """
+    config = nc_encoding.load() if config is None else config
+    prod = nc_encoding.product(filename)
+    result = {}
+    for var in ds.data_vars:
+        if ds[var].ndim < 2:
+            continue
+        setting = nc_encoding.settings(config, prod, var)
+        var_encoding = nc_encoding.variable_encoding(None, ds[var].dims, ds[var].shape, setting, packed=False)
+        result[var] = {}
+        if "chunksizes" in var_encoding:
+            result[var]["chunks"] = var_encoding["chunksizes"]
+        if "dtype" in var_encoding:
+            result[var]["dtype"] = var_encoding["dtype"]
+    return result
+
+
+def write(ds, filename, extra_encoding=None):
+    """
+    Writes ds to the store of filename. extra_encoding is merged into the
+    encoding of a newly created store.
+    """
+    store = store_name(filename)
+    print("Writing", store)
+    new_encoding = encoding(ds, filename)
+    for var, values in (extra_encoding or {}).items():
+        new_encoding[var] = dict(new_encoding.get(var, {}), **values)
+    if not os.environ.get("ZARR_STORE", ""):
+        ds.to_zarr(store, mode="w", encoding=new_encoding, consolidated=True)
+        return
+    directory = os.path.dirname(store)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with append_steps.locked(store):
+        if not os.path.exists(store):
+            ds.to_zarr(store, mode="w", encoding=new_encoding, consolidated=True)
+            return
+        with xr.open_zarr(store, consolidated=True) as existing:
+            times = existing["time"].values
+        present = np.isin(ds["time"].values, times)
+        for index in np.nonzero(present)[0]:
+            step = ds.isel(time=[index])
+            step = step.drop_vars([var for var in step.variables if "time" not in step[var].dims])
+            position = int(np.nonzero(times == step["time"].values[0])[0][0])
+            step.to_zarr(store, region={"time": slice(position, position + 1)})
+        if present.all():
+            return
+        new = ds.isel(time=np.nonzero(~present)[0])
+        merged = np.union1d(times, new["time"].values)
+        # the leading steps not moved by inserting new steps
+        first = 0
+        while first < len(times) and times[first] == merged[first]:
+            first += 1
+        if first == len(times):
+            new.sortby("time").to_zarr(store, append_dim="time", consolidated=True)
+            return
+        with xr.open_zarr(store, consolidated=True) as existing:
+            tail = existing.isel(time=slice(first, None)).load()
+        tail = xr.concat([tail, new], dim="time", data_vars="minimal", coords="minimal",
+                         compat="override", join="override").sortby("time")
+        for var in tail.variables.values():
+            var.encoding = {}
+        # extend the store by the number of new steps, then rewrite the moved ones
+        moved = len(times) - first
+        tail.isel(time=slice(moved, None)).to_zarr(store, append_dim="time", consolidated=True)
+        tail = tail.isel(time=slice(None, moved))
+        tail = tail.drop_vars([var for var in tail.variables if "time" not in tail[var].dims])
+        # without its index, region writes include the moved time coordinate
+        tail = tail.drop_indexes("time")
+        tail.to_zarr(store, region={"time": slice(first, first + moved)}, consolidated=True)